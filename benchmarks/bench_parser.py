@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Throughput benchmark of the sans-IO RTSP parser in messages per second.
+
+A stream of pipelined keep-alive requests, SET_PARAMETER requests with bodies and
+responses is fed to RtspParser in chunks of the given size.
+
+    $ python benchmarks/bench_parser.py [chunk_size] [messages]
+"""
+
+import sys
+import time
+
+from picast.rtspparser import RtspParser
+
+MESSAGES = [
+    b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 4\r\n\r\n",
+    b"RTSP/1.0 200 OK\r\nCSeq: 101\r\nSession: 7C9C5678;timeout=30\r\n"
+    b"Transport: RTP/AVP/UDP;unicast;client_port=1028;server_port=5000\r\n\r\n",
+    b"SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 2\r\nContent-Type: text/parameters\r\n"
+    b"Content-Length: 249\r\n\r\n"
+    b"wfd_video_formats: 00 00 01 01 00000001 00000000 00000000 00 0000 0000 00 none none\r\n"
+    b"wfd_audio_codecs: LPCM 00000002 00\r\n"
+    b"wfd_presentation_URL: rtsp://192.168.173.80/wfd1.0/streamid=0 none\r\n"
+    b"wfd_client_rtp_ports: RTP/AVP/UDP;unicast 1028 0 mode=play\r\n",
+]
+
+
+def main():
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1460
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 30000
+    stream = b"".join(MESSAGES[i % len(MESSAGES)] for i in range(count))
+    chunks = [stream[i : i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    best = None
+    for _ in range(5):
+        parser = RtspParser()
+        parsed = 0
+        start = time.perf_counter()
+        for chunk in chunks:
+            parsed += len(parser.feed(chunk))
+        elapsed = time.perf_counter() - start
+        assert parsed == count
+        best = elapsed if best is None else min(best, elapsed)
+    print("chunk {:6d} bytes: {:10.0f} msg/s  {:8.1f} MB/s".format(chunk_size, count / best, len(stream) / best / 1e6))
+
+
+if __name__ == "__main__":
+    main()
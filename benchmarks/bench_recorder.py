@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Throughput benchmark of the record player.
+
+RTP packets with seven MPEG-TS packets each are sent over loopback at the given rate
+for the given time, and the datagrams received, lost in the kernel and dropped by
+the recorder are reported. 20 Mbit/s is about 1900 packets per second.
+
+    $ python benchmarks/bench_recorder.py [mbit_per_second] [seconds] [directory]
+"""
+
+import socket
+import sys
+import tempfile
+import time
+
+from picast.players.recorder import RecordingPlayer
+
+PAYLOAD = (b"\x47" + bytes(187)) * 7
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    directory = sys.argv[3] if len(sys.argv) > 3 else tempfile.mkdtemp()
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    player = RecordingPlayer(rtp_port=port, directory=directory)
+    player.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packet = bytearray(b"\x80\x21" + bytes(10) + PAYLOAD)
+    interval = len(packet) * 8 / (rate * 1e6)
+    count = int(seconds / interval)
+    start = time.perf_counter()
+    for seq in range(count):
+        packet[2:4] = (seq & 0xFFFF).to_bytes(2, "big")
+        sender.sendto(packet, ("127.0.0.1", port))
+        # send in bursts of 10 packets, as a source does for one video frame slice
+        if seq % 10 == 9:
+            delay = start + (seq + 1) * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)
+    player.stop()
+    stats = player.rtp_stats()
+    print(
+        "sent {} packets at {:.1f} Mbit/s: received {received}, lost {lost}, dropped {dropped}, "
+        "written {written} bytes in {files} file(s)".format(count, count * len(packet) * 8 / elapsed / 1e6, **stats)
+    )
+
+
+if __name__ == "__main__":
+    main()
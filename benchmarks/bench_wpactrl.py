@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Latency benchmark of wpa_supplicant control requests against a fake control interface.
+
+The command sequence of creating a P2P interface is sent the given number of times
+over the persistent sockets of WpaCtrl and the time per command is reported. For
+comparison, one wpa_cli process per command costs its start-up, hundreds of
+milliseconds on a Raspberry Pi Zero.
+
+    $ python benchmarks/bench_wpactrl.py [rounds]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from picast.wpactrl import WpaCtrl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tests"))
+from fake_supplicant import FakeSupplicant  # noqa: E402
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ctrl_dir = tempfile.mkdtemp()
+    supplicant = FakeSupplicant(ctrl_dir)
+    supplicant.start()
+    wpa = WpaCtrl(ctrl_dir=ctrl_dir)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        wpa.set_device_name("picast")
+        wpa.set_device_type("7-0050F204-4")
+        wpa.set_p2p_go_ht40()
+        wpa.set_p2p_ssid_postfix("picast")
+        for key in (0, 1, 6, 7):
+            wpa.wfd_subelem_set(key, "00060151022a012c")
+        wpa.get_persistent_group_network_id("picast")
+    elapsed = time.perf_counter() - start
+    wpa.close()
+    supplicant.stop()
+    count = len(supplicant.requests)
+    print("{} commands in {:.3f} s: {:.1f} us per command".format(count, elapsed, elapsed / count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
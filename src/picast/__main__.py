@@ -33,9 +33,9 @@ gi.require_version("GstVideo", "1.0")  # noqa: E402 # isort:skip
 gi.require_version("GdkX11", "3.0")  # noqa: E402 # isort:skip
 
 from .rtspsink import RtspSink  # noqa: E402 # isort:skip
-from .players.gst import GstPlayer  # noqa: E402 # isort:skip
-from .players.vlc import VlcPlayer  # noqa: E402 # isort:skip
-from .players.nop import NopPlayer  # noqa: E402 # isort:skip
+from .players import create_player  # noqa: E402 # isort:skip
+from .metrics import MetricsServer  # noqa: E402 # isort:skip
+from .sessions import SessionManager  # noqa: E402 # isort:skip
 from .settings import Settings  # noqa: E402 # isort:skip
 from .wifip2p import WifiP2PServer  # noqa: E402 # isort:skip
 
@@ -73,20 +73,22 @@ def main(arg: Optional[Any] = None):
     if args.debug:
         logger.setLevel("DEBUG")
 
-    if config.player == "gst":
-        player: Optional[Union[GstPlayer, VlcPlayer, NopPlayer]] = GstPlayer()
-    elif config.player == "vlc":
-        player = VlcPlayer()
-    elif config.player == "nop":
-        player = NopPlayer()
-    else:
-        player = None
+    if config.player not in ("gst", "vlc", "libvlc", "nop", "record"):
         logger.fatal("FATAL: Unknown player name option!: {}".format(config.player))
         exit(1)
     # ------------------- end of configurations
 
+    metrics = MetricsServer.from_settings()
+    if metrics is not None:
+        metrics.start()
+
     wifip2p = WifiP2PServer()
-    rtspsink = RtspSink(player)
+    if config.max_sessions > 1:
+        rtspsink = SessionManager()  # type: Union[SessionManager, RtspSink]
+    else:
+        rtspsink = RtspSink(create_player(config.player))
+    # connect to a source as soon as the DHCP server leases it an address
+    wifip2p.subscribe_leases(rtspsink.on_lease)
 
     wifip2p.start()
     rtspsink.start()
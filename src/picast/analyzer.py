@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import socket
+import sys
+import time
+from array import array
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from .rtp import rtp_payload
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+NULL_PID = 0x1FFF
+PCR_HZ = 27000000
+PTS_HZ = 90000
+PCR_WRAP = (1 << 33) * 300
+PTS_WRAP = 1 << 33
+# bytes of a PES start gathered to parse its header and find the first NAL units
+PES_WINDOW = 96
+
+if np is not None:
+    # the 13-bit PID shares a big-endian 16-bit field with the error, unit start and priority bits.
+    TS_DTYPE = np.dtype([("sync", "u1"), ("pid", ">u2"), ("flags", "u1"), ("payload", "u1", (184,))])
+
+
+def find_sync(data: bytes, start: int = 0) -> int:
+    """Offset of the first packet boundary from `start` confirmed by the next two packets, or -1."""
+    for offset in range(start, min(start + TS_PACKET_SIZE, len(data))):
+        if all(data[o] == SYNC_BYTE for o in range(offset, min(offset + 3 * TS_PACKET_SIZE, len(data)), TS_PACKET_SIZE)):
+            return offset
+    return -1
+
+
+def iter_packets(f: BinaryIO, batch: int = 65536) -> Iterator["np.ndarray"]:
+    """Read a TS file as structured arrays of up to `batch` packets."""
+    rest = b""
+    while True:
+        chunk = f.read(batch * TS_PACKET_SIZE)
+        if not chunk:
+            break
+        data = rest + chunk
+        offset = find_sync(data)
+        if offset < 0:
+            rest = data[-2 * TS_PACKET_SIZE :]
+            continue
+        count = (len(data) - offset) // TS_PACKET_SIZE
+        if count:
+            yield np.frombuffer(data, TS_DTYPE, count, offset)
+        rest = data[offset + count * TS_PACKET_SIZE :]
+
+
+def _timestamp(b: "np.ndarray") -> "np.ndarray":
+    """Decode 33-bit PTS or DTS fields from rows of 5 bytes."""
+    b = b.astype(np.int64)
+    return ((b[:, 0] >> 1) & 7) << 30 | b[:, 1] << 22 | (b[:, 2] >> 1) << 15 | b[:, 3] << 7 | b[:, 4] >> 1
+
+
+def _gather(payload: "np.ndarray", rows: "np.ndarray", start: "np.ndarray", width: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Bytes `start` to `start + width` of each payload row, and a mask of those inside the packet."""
+    columns = start[:, None] + np.arange(width)
+    inside = columns < payload.shape[1]
+    return payload[rows[:, None], np.minimum(columns, payload.shape[1] - 1)], inside
+
+
+def _unwrap(values: "np.ndarray", modulo: int) -> "np.ndarray":
+    if values.size == 0:
+        return values
+    steps = np.diff(values) % modulo
+    return values[0] + np.concatenate(([0], np.cumsum(steps)))
+
+
+def _spread(values: "np.ndarray") -> Optional[Dict[str, float]]:
+    if values.size == 0:
+        return None
+    return {
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def _delay_variation(media: "np.ndarray", arrival: "np.ndarray") -> Optional[float]:
+    """Peak to peak arrival delay in ms against media time, after removing a clock drift."""
+    ok = ~np.isnan(arrival)
+    if ok.sum() < 3:
+        return None
+    media, arrival = media[ok], arrival[ok]
+    slope, intercept = np.polyfit(media - media[0], arrival - arrival[0], 1)
+    residual = arrival - arrival[0] - (slope * (media - media[0]) + intercept)
+    return float((residual.max() - residual.min()) * 1000)
+
+
+class TsAnalyzer:
+    """Accumulate MPEG-TS statistics from batches of packets.
+
+    Each batch is a structured array of :data:`TS_DTYPE`, processed with array operations
+    only. Per-packet state needed across batches, such as the last continuity counter
+    of each PID, is carried over, and only sparse events (PCRs and PES starts) are kept.
+    """
+
+    def __init__(self):
+        if np is None:
+            raise RuntimeError("TsAnalyzer needs numpy; install picast[analyze]")
+        self.packets = 0
+        self.sync_errors = 0
+        self.transport_errors = 0
+        self.pid_packets = {}  # type: Dict[int, int]
+        self.cc_errors = {}  # type: Dict[int, int]
+        self._last_cc = {}  # type: Dict[int, int]
+        self._pcr = []  # type: List[Tuple[np.ndarray, ...]]
+        self._pes = []  # type: List[Tuple[np.ndarray, ...]]
+
+    def feed(self, packets: "np.ndarray", arrival: Optional["np.ndarray"] = None) -> None:
+        """Account a batch of packets; `arrival` holds the receive time of each packet in seconds."""
+        index = self.packets + np.arange(len(packets), dtype=np.int64)
+        self.packets += len(packets)
+        if arrival is None:
+            arrival = np.full(len(packets), np.nan)
+        valid = packets["sync"] == SYNC_BYTE
+        self.sync_errors += int(len(packets) - valid.sum())
+        packets, index, arrival = packets[valid], index[valid], arrival[valid]
+        if not len(packets):
+            return
+
+        field = packets["pid"].astype(np.int32)
+        pid = field & 0x1FFF
+        pusi = (field & 0x4000) != 0
+        self.transport_errors += int(np.count_nonzero(field & 0x8000))
+        flags = packets["flags"]
+        has_payload = (flags & 0x10) != 0
+        has_af = (flags & 0x20) != 0
+        cc = (flags & 0x0F).astype(np.int8)
+        payload = packets["payload"]
+        af_len = np.where(has_af, payload[:, 0], 0).astype(np.int32)
+        af_flags = np.where(has_af & (af_len > 0), payload[:, 1], 0)
+
+        for p, n in zip(*np.unique(pid, return_counts=True)):
+            self.pid_packets[int(p)] = self.pid_packets.get(int(p), 0) + int(n)
+        self._continuity(pid, cc, has_payload & (pid != NULL_PID), (af_flags & 0x80) != 0)
+
+        rows = np.flatnonzero(((af_flags & 0x10) != 0) & (af_len >= 7))
+        if rows.size:
+            b = payload[rows, 2:8].astype(np.int64)
+            base = b[:, 0] << 25 | b[:, 1] << 17 | b[:, 2] << 9 | b[:, 3] << 1 | b[:, 4] >> 7
+            pcr = base * 300 + ((b[:, 4] & 1) << 8 | b[:, 5])
+            self._pcr.append((pid[rows], index[rows], pcr, arrival[rows]))
+
+        start = np.where(has_af, af_len + 1, 0)
+        rows = np.flatnonzero(pusi & has_payload & (start <= 184 - 14))
+        if rows.size:
+            self._pes_starts(payload, rows, start[rows], pid, index, arrival, (af_flags[rows] & 0x40) != 0)
+
+    def _continuity(self, pid, cc, counted, discontinuity) -> None:
+        carried = np.array(list(self._last_cc.keys()), dtype=np.int32)
+        p = np.concatenate((carried, pid[counted]))
+        c = np.concatenate((np.array(list(self._last_cc.values()), dtype=np.int8), cc[counted]))
+        d = np.concatenate((np.zeros(carried.size, dtype=bool), discontinuity[counted]))
+        order = np.argsort(p, kind="stable")
+        p, c, d = p[order], c[order], d[order]
+        same = p[1:] == p[:-1]
+        # a packet may be sent twice with the same counter
+        error = same & (c[1:] != (c[:-1] + 1) % 16) & (c[1:] != c[:-1]) & ~d[1:]
+        for e, n in zip(*np.unique(p[1:][error], return_counts=True)):
+            self.cc_errors[int(e)] = self.cc_errors.get(int(e), 0) + int(n)
+        last = np.concatenate((p[1:] != p[:-1], [True])) if p.size else np.zeros(0, dtype=bool)
+        self._last_cc.update(zip(p[last].tolist(), c[last].tolist()))
+
+    def _pes_starts(self, payload, rows, start, pid, index, arrival, random_access) -> None:
+        w, inside = _gather(payload, rows, start, PES_WINDOW)
+        is_pes = (w[:, 0] == 0) & (w[:, 1] == 0) & (w[:, 2] == 1)
+        pts_flags = w[:, 7] >> 6
+        pts = np.where(pts_flags & 2, _timestamp(w[:, 9:14]), -1)
+        dts = np.where(pts_flags == 3, _timestamp(w[:, 14:19]), pts)
+        # an IDR slice or a sequence parameter set in the first bytes of the elementary stream marks a key frame.
+        es = 9 + w[:, 8].astype(np.int64)
+        column = np.arange(PES_WINDOW - 4)
+        in_es = (column >= es[:, None]) & inside[:, 3:-1]
+        start_code = (w[:, :-4] == 0) & (w[:, 1:-3] == 0) & (w[:, 2:-2] == 1) & in_es
+        nal_type = w[:, 3:-1] & 0x1F
+        key = random_access | np.any(start_code & ((nal_type == 5) | (nal_type == 7)), axis=1)
+        ok = is_pes & (pts >= 0)
+        self._pes.append((pid[rows][ok], index[rows][ok], w[:, 3][ok], dts[ok], key[ok], arrival[rows][ok]))
+
+    def _events(self, events: List[Tuple["np.ndarray", ...]], fields: int) -> List["np.ndarray"]:
+        if not events:
+            return [np.zeros(0)] * fields
+        return [np.concatenate([e[i] for e in events]) for i in range(fields)]
+
+    def pcr_report(self) -> Optional[Dict[str, object]]:
+        pids, index, pcr, arrival = self._events(self._pcr, 4)
+        if pids.size < 2:
+            return None
+        values, counts = np.unique(pids, return_counts=True)
+        pcr_pid = int(values[np.argmax(counts)])
+        sel = pids == pcr_pid
+        index, pcr, arrival = index[sel], _unwrap(pcr[sel], PCR_WRAP), arrival[sel]
+        seconds = (pcr - pcr[0]) / PCR_HZ
+        step = np.diff(seconds)
+        moving = step > 0
+        bits = np.diff(index)[moving] * TS_PACKET_SIZE * 8
+        duration = float(seconds[-1])
+        return {
+            "pid": pcr_pid,
+            "count": int(pcr.size),
+            "duration": duration,
+            "bitrate": float((index[-1] - index[0]) * TS_PACKET_SIZE * 8 / duration) if duration > 0 else None,
+            "interval_bitrate": _spread(bits / step[moving]),
+            "interval_ms": _spread(step * 1000),
+            "jitter_ms": _delay_variation(seconds, arrival),
+        }
+
+    def pes_report(self) -> Dict[int, Dict[str, object]]:
+        pids, index, stream_id, dts, key, arrival = self._events(self._pes, 6)
+        report = {}  # type: Dict[int, Dict[str, object]]
+        for p in np.unique(pids):
+            sel = pids == p
+            times = _unwrap(dts[sel], PTS_WRAP) / PTS_HZ
+            frame = np.diff(times)
+            keys = np.flatnonzero(key[sel])
+            kind = int(stream_id[sel][0])
+            entry = {
+                "stream_id": kind,
+                "video": 0xE0 <= kind <= 0xEF,
+                "pes": int(sel.sum()),
+                "frame_ms": _spread(frame * 1000),
+                "frame_rate": float(1 / frame.mean()) if frame.size and frame.mean() > 0 else None,
+                "arrival_jitter_ms": _delay_variation(times, arrival[sel]),
+            }  # type: Dict[str, object]
+            if entry["video"]:
+                entry["key_frames"] = int(keys.size)
+                entry["key_interval_s"] = _spread(np.diff(times[keys]))
+                entry["key_interval_frames"] = _spread(np.diff(keys).astype(np.float64))
+            report[int(p)] = entry
+        return report
+
+    def report(self) -> Dict[str, object]:
+        return {
+            "packets": self.packets,
+            "sync_errors": self.sync_errors,
+            "transport_errors": self.transport_errors,
+            "pids": {p: {"packets": n, "cc_errors": self.cc_errors.get(p, 0)} for p, n in sorted(self.pid_packets.items())},
+            "pcr": self.pcr_report(),
+            "pes": self.pes_report(),
+        }
+
+
+def analyze_file(path: str, batch: int = 65536) -> Dict[str, object]:
+    analyzer = TsAnalyzer()
+    with open(path, "rb") as f:
+        for packets in iter_packets(f, batch):
+            analyzer.feed(packets)
+    return analyzer.report()
+
+
+def capture(port: int, seconds: float, host: str = "0.0.0.0") -> Tuple[bytes, "np.ndarray"]:
+    """Receive the RTP stream on `port` for `seconds`; return the TS payload and the arrival time of each packet."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    data = bytearray()
+    arrivals = array("d")
+    counts = array("l")
+    buf = bytearray(65535)
+    end = time.monotonic() + seconds
+    try:
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                size = sock.recv_into(buf)
+            except socket.timeout:
+                break
+            start, length = rtp_payload(buf, 0, size)
+            if length < TS_PACKET_SIZE:
+                continue
+            length -= length % TS_PACKET_SIZE
+            data += buf[start : start + length]
+            arrivals.append(time.monotonic())
+            counts.append(length // TS_PACKET_SIZE)
+    finally:
+        sock.close()
+    return bytes(data), np.repeat(np.array(arrivals), np.array(counts, dtype=np.int64))
+
+
+def analyze_capture(port: int, seconds: float, host: str = "0.0.0.0") -> Dict[str, object]:
+    data, arrival = capture(port, seconds, host)
+    analyzer = TsAnalyzer()
+    if arrival.size:
+        analyzer.feed(np.frombuffer(data, TS_DTYPE), arrival)
+    return analyzer.report()
+
+
+def _format_spread(spread: Optional[Dict[str, float]], unit: str = "") -> str:
+    if spread is None:
+        return "-"
+    return "mean {mean:.2f}{u} std {std:.2f}{u} min {min:.2f}{u} max {max:.2f}{u}".format(u=unit, **spread)
+
+
+def format_report(report: Dict[str, object]) -> str:
+    lines = ["packets {packets}, sync errors {sync_errors}, transport errors {transport_errors}".format(**report)]
+    for p, entry in report["pids"].items():  # type: ignore
+        lines.append("PID 0x{:04x}: {packets} packets, {cc_errors} continuity errors".format(p, **entry))
+    pcr = report["pcr"]  # type: Any
+    if pcr is not None:
+        lines.append("PCR PID 0x{:04x}: {} PCRs over {:.2f} s".format(pcr["pid"], pcr["count"], pcr["duration"]))
+        if pcr["bitrate"] is not None:
+            lines.append("  bitrate {:.2f} Mbit/s".format(pcr["bitrate"] / 1e6))
+        lines.append("  interval {}".format(_format_spread(pcr["interval_ms"], " ms")))
+        if pcr["jitter_ms"] is not None:
+            lines.append("  arrival jitter {:.2f} ms peak to peak".format(pcr["jitter_ms"]))
+    for p, entry in report["pes"].items():  # type: ignore
+        lines.append("PES PID 0x{:04x} stream 0x{:02x}: {} PES".format(p, entry["stream_id"], entry["pes"]))
+        lines.append("  frame interval {}".format(_format_spread(entry["frame_ms"], " ms")))
+        if entry["arrival_jitter_ms"] is not None:
+            lines.append("  arrival jitter {:.2f} ms peak to peak".format(entry["arrival_jitter_ms"]))
+        if entry["video"]:
+            lines.append(
+                "  {} key frames, interval {}".format(entry["key_frames"], _format_spread(entry["key_interval_s"], " s"))
+            )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="picast-analyze", description="Analyze MPEG-TS streams received by picast")
+    parser.add_argument("files", nargs="*", help="recorded TS files")
+    parser.add_argument("--port", type=int, help="capture the RTP stream on this port instead")
+    parser.add_argument("--seconds", type=float, default=10.0, help="capture duration")
+    parser.add_argument("--batch", type=int, default=65536, help="packets analyzed at once")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if np is None:
+        print("picast-analyze needs numpy; install picast[analyze]", file=sys.stderr)
+        return 1
+    if args.port is not None:
+        reports = [("rtp port {}".format(args.port), analyze_capture(args.port, args.seconds))]
+    elif args.files:
+        reports = [(path, analyze_file(path, args.batch)) for path in args.files]
+    else:
+        parser.error("give TS files or --port")
+    for name, report in reports:
+        if args.json:
+            print(json.dumps({"source": name, **report}))
+        else:
+            print("== {}".format(name))
+            print(format_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
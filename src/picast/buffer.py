@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import socket
+from typing import Optional
+
+
+class RecvBuffer:
+    """Receive buffer backed by a single bytearray.
+
+    Data is received in place with ``recv_into`` and consumed by moving a read offset,
+    so taking a line or a body out of the buffer does not copy the remaining bytes.
+    Lines and bodies are returned as memoryview slices of the buffer; they stay valid
+    until the next call that receives or appends data.
+    """
+
+    def __init__(self, size: int = 65536):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def _reserve(self, size: int) -> None:
+        """Make room for `size` more bytes at the tail."""
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if len(self._buf) >= pending + size:
+            # compact in place; slice assignment of equal length never resizes the bytearray.
+            self._buf[:pending] = self._buf[self._start : self._end]
+        else:
+            capacity = len(self._buf) * 2
+            while capacity < pending + size:
+                capacity *= 2
+            # allocate a new array instead of resizing so already returned views keep their data.
+            buf = bytearray(capacity)
+            buf[:pending] = self._buf[self._start : self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._scan -= self._start
+        self._start = 0
+        self._end = pending
+
+    def recv_into(self, sock: socket.socket, size: int = 16384) -> int:
+        """Receive up to `size` bytes from `sock`; return the number of bytes received."""
+        self._reserve(size)
+        nbytes = sock.recv_into(self._view[self._end : self._end + size], size)
+        self._end += nbytes
+        return nbytes
+
+    def feed(self, data: bytes) -> None:
+        self._reserve(len(data))
+        self._buf[self._end : self._end + len(data)] = data
+        self._end += len(data)
+
+    def readline(self) -> Optional[memoryview]:
+        """Return the next CRLF terminated line without terminator, or None when incomplete."""
+        pos = self._buf.find(b"\r\n", self._scan, self._end)
+        if pos < 0:
+            # keep the last byte for the next scan, it may be a CR of a split terminator.
+            if self._end > self._start:
+                self._scan = self._end - 1
+            return None
+        line = self._view[self._start : pos]
+        self._start = self._scan = pos + 2
+        return line
+
+    def read(self, size: int) -> memoryview:
+        """Consume and return at most `size` bytes."""
+        start = self._start
+        self._start = min(start + size, self._end)
+        if self._scan < self._start:
+            self._scan = self._start
+        return self._view[start : self._start]
+
+    def read_all(self) -> memoryview:
+        return self.read(self._end - self._start)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import errno
+import random
+import select
+import socket
+import threading
+import time
+from logging import getLogger
+from typing import Iterator, Optional, Tuple
+
+
+class Connector:
+    """Connect a TCP control channel to a source that may not be reachable yet.
+
+    Every attempt is a non-blocking connect bounded by `attempt_timeout`. Failed attempts
+    are retried after a jittered exponential backoff capped at `max_delay`, until the
+    overall `deadline` expires. :meth:`cancel` aborts a pending connect immediately from
+    another thread; the asyncio variant is also cancelled with its task. A cancel only
+    aborts the connect in progress, so the connector can connect again afterwards.
+    The time to connect of the last successful connect is kept in :attr:`elapsed`.
+    """
+
+    def __init__(
+        self,
+        deadline: float = 300.0,
+        attempt_timeout: float = 1.0,
+        initial_delay: float = 0.05,
+        max_delay: float = 1.0,
+        logger="picast",
+    ):
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.logger = getLogger(logger)
+        self.elapsed = None  # type: Optional[float]
+        self.attempts = 0
+        self._cancelled = threading.Event()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _reset(self) -> None:
+        self._cancelled.clear()
+        try:
+            while self._wakeup_r.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def delays(self) -> Iterator[float]:
+        """Backoff delays with full jitter."""
+        ceiling = self.initial_delay
+        while True:
+            yield random.uniform(0, ceiling)
+            ceiling = min(ceiling * 2, self.max_delay)
+
+    def _check_cancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise ConnectionAbortedError("Connect cancelled")
+
+    def _attempt(self, host: str, port: int, timeout: float) -> Optional[socket.socket]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        err = sock.connect_ex((host, port))
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            readable, writable, _ = select.select([self._wakeup_r], [sock], [], timeout)
+            if self._wakeup_r in readable:
+                sock.close()
+                self._check_cancelled()
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) if writable else errno.ETIMEDOUT
+        if err != 0:
+            sock.close()
+            return None
+        sock.setblocking(True)
+        return sock
+
+    def _connected(self, host: str, port: int, start: float) -> None:
+        self.elapsed = time.monotonic() - start
+        self.logger.info(
+            "Connected to {}:{} in {:.3f} sec after {} attempt(s)".format(host, port, self.elapsed, self.attempts)
+        )
+
+    def connect(self, host: str, port: int) -> socket.socket:
+        start = time.monotonic()
+        limit = start + self.deadline
+        self.attempts = 0
+        self._reset()
+        for delay in self.delays():
+            self._check_cancelled()
+            remaining = limit - time.monotonic()
+            if remaining <= 0:
+                break
+            self.attempts += 1
+            sock = self._attempt(host, port, min(self.attempt_timeout, remaining))
+            if sock is not None:
+                self._connected(host, port, start)
+                return sock
+            if self._cancelled.wait(min(delay, max(limit - time.monotonic(), 0))):
+                self._check_cancelled()
+        raise TimeoutError("Cannot connect to {}:{} within {} sec".format(host, port, self.deadline))
+
+    async def connect_async(self, host: str, port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        start = time.monotonic()
+        limit = start + self.deadline
+        self.attempts = 0
+        self._reset()
+        for delay in self.delays():
+            self._check_cancelled()
+            remaining = limit - time.monotonic()
+            if remaining <= 0:
+                break
+            self.attempts += 1
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), min(self.attempt_timeout, remaining)
+                )
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(min(delay, max(limit - time.monotonic(), 0)))
+                continue
+            sock = writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connected(host, port, start)
+            return reader, writer
+        raise TimeoutError("Cannot connect to {}:{} within {} sec".format(host, port, self.deadline))
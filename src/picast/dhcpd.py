@@ -19,16 +19,56 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import ipaddress
+import json
 import os
+import socket
+import struct
 import subprocess
 import tempfile
+import threading
+import time
 from logging import getLogger
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
+from .metrics import DHCP_LEASES
 from .settings import Settings
 
+DHCP_SERVER_PORT = 67
+DHCP_CLIENT_PORT = 68
+
+BOOTREQUEST = 1
+BOOTREPLY = 2
+MAGIC_COOKIE = b"\x63\x82\x53\x63"
+# op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, file
+BOOTP_FORMAT = "!BBBBIHH4s4s4s4s16s64s128s"
+BOOTP_SIZE = struct.calcsize(BOOTP_FORMAT)
+
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+DHCPINFORM = 8
+
+OPTION_PAD = 0
+OPTION_SUBNET_MASK = 1
+OPTION_REQUESTED_ADDRESS = 50
+OPTION_LEASE_TIME = 51
+OPTION_MESSAGE_TYPE = 53
+OPTION_SERVER_ID = 54
+OPTION_RENEWAL_TIME = 58
+OPTION_REBINDING_TIME = 59
+OPTION_END = 255
+
+ZERO_ADDRESS = "0.0.0.0"
+
 
 class Dhcpd:
-    """DHCP server daemon running in background."""
+    """udhcpd DHCP server daemon running in background, leasing 'peeraddress' only."""
 
     def __init__(self, interface: str, logger="picast"):
         """Constructor accept an interface to listen."""
@@ -72,3 +112,420 @@ class Dhcpd:
             os.unlink(self.conf_path)
             # FIXME: workaround for sudo process killing.
             os.system("sudo pkill udhcpd")
+
+
+class DhcpMessage(NamedTuple):
+    """A DHCP message of RFC 2131 with its options by code."""
+
+    op: int
+    xid: int
+    flags: int
+    ciaddr: str
+    yiaddr: str
+    giaddr: str
+    chaddr: bytes
+    options: Dict[int, bytes]
+
+    @classmethod
+    def parse(cls, data: bytes) -> "DhcpMessage":
+        """Parse a message; raise ValueError when it is not DHCP."""
+        if len(data) < BOOTP_SIZE + len(MAGIC_COOKIE) or data[BOOTP_SIZE : BOOTP_SIZE + 4] != MAGIC_COOKIE:
+            raise ValueError("Not a DHCP message")
+        op, _, hlen, _, xid, _, flags, ciaddr, yiaddr, _, giaddr, chaddr, _, _ = struct.unpack_from(BOOTP_FORMAT, data)
+        options = {}  # type: Dict[int, bytes]
+        offset = BOOTP_SIZE + 4
+        while offset < len(data):
+            code = data[offset]
+            if code == OPTION_END:
+                break
+            if code == OPTION_PAD:
+                offset += 1
+                continue
+            if offset + 2 > len(data):
+                raise ValueError("Truncated DHCP option {}".format(code))
+            length = data[offset + 1]
+            options[code] = data[offset + 2 : offset + 2 + length]
+            offset += 2 + length
+        return cls(
+            op,
+            xid,
+            flags,
+            socket.inet_ntoa(ciaddr),
+            socket.inet_ntoa(yiaddr),
+            socket.inet_ntoa(giaddr),
+            chaddr[: min(hlen, 16)],
+            options,
+        )
+
+    def to_bytes(self) -> bytes:
+        header = struct.pack(
+            BOOTP_FORMAT,
+            self.op,
+            1,
+            len(self.chaddr),
+            0,
+            self.xid,
+            0,
+            self.flags,
+            socket.inet_aton(self.ciaddr),
+            socket.inet_aton(self.yiaddr),
+            socket.inet_aton(ZERO_ADDRESS),
+            socket.inet_aton(self.giaddr),
+            self.chaddr,
+            b"",
+            b"",
+        )
+        options = b"".join(bytes((code, len(value))) + value for code, value in self.options.items())
+        return header + MAGIC_COOKIE + options + bytes((OPTION_END,))
+
+    @property
+    def message_type(self) -> Optional[int]:
+        value = self.options.get(OPTION_MESSAGE_TYPE)
+        return value[0] if value else None
+
+    @property
+    def mac(self) -> str:
+        return ":".join("{:02x}".format(b) for b in self.chaddr)
+
+    def address_option(self, code: int) -> Optional[str]:
+        value = self.options.get(code)
+        return socket.inet_ntoa(value) if value is not None and len(value) == 4 else None
+
+
+class Lease(NamedTuple):
+    """An address leased to a client until `expires`, a wall clock time."""
+
+    mac: str
+    address: str
+    expires: float
+
+
+class LeasePool:
+    """Addresses of a pool and their leases, kept in `path` across restarts.
+
+    A client gets back its last address when it is free, so a source keeps its address
+    over reconnections and restarts of picast. Offers reserve an address for a short
+    time until the client requests it.
+    """
+
+    # seconds an offered address is kept for the client
+    offer_time = 30.0
+
+    def __init__(self, start: str, size: int, lease_time: int, path: Optional[str] = None, exclude=(), logger="picast"):
+        first = ipaddress.IPv4Address(start)
+        self.addresses = [str(first + i) for i in range(size) if str(first + i) not in exclude]
+        self.lease_time = lease_time
+        self.path = path
+        self.logger = getLogger(logger)
+        self._lock = threading.Lock()
+        self._leases = {}  # type: Dict[str, Lease]
+        self._offers = {}  # type: Dict[str, Lease]
+        # declined addresses are in use by some other host until the time
+        self._declined = {}  # type: Dict[str, float]
+        self.load()
+
+    def load(self) -> None:
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for entry in entries:
+            try:
+                lease = Lease(str(entry["mac"]), str(entry["address"]), float(entry["expires"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if lease.address in self.addresses:
+                self._leases[lease.mac] = lease
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "w") as f:
+                json.dump([lease._asdict() for lease in self._leases.values()], f)
+        except OSError as e:
+            self.logger.info("Cannot write DHCP leases {}: {}".format(self.path, e))
+
+    def lookup(self, mac: str) -> Optional[Lease]:
+        """The lease of `mac` which has not expired."""
+        with self._lock:
+            lease = self._leases.get(mac)
+        return lease if lease is not None and lease.expires > time.time() else None
+
+    def leases(self) -> List[Lease]:
+        """Leases which have not expired."""
+        now = time.time()
+        with self._lock:
+            return [lease for lease in self._leases.values() if lease.expires > now]
+
+    def _holder(self, address: str, now: float) -> Optional[str]:
+        """MAC address holding `address` by a lease or an offer, or "" when it is declined."""
+        if self._declined.get(address, 0) > now:
+            return ""
+        for holders in (self._leases, self._offers):
+            for mac, lease in holders.items():
+                if lease.address == address and lease.expires > now:
+                    return mac
+        return None
+
+    def _available(self, mac: str, address: Optional[str], now: float) -> bool:
+        return address in self.addresses and self._holder(address, now) in (None, mac)
+
+    def offer(self, mac: str, requested: Optional[str] = None) -> Optional[str]:
+        """Reserve an address for `mac`; None when the pool is exhausted."""
+        now = time.time()
+        with self._lock:
+            candidates = [requested] if requested is not None else []
+            for holders in (self._offers, self._leases):
+                if mac in holders:
+                    candidates.append(holders[mac].address)
+            # prefer addresses nobody had, so that others get back theirs
+            previous = set(lease.address for lease in self._leases.values())
+            candidates += [a for a in self.addresses if a not in previous] + [a for a in self.addresses if a in previous]
+            for address in candidates:
+                if self._available(mac, address, now):
+                    self._offers[mac] = Lease(mac, address, now + self.offer_time)
+                    return address
+        return None
+
+    def grant(self, mac: str, address: Optional[str]) -> Optional[Lease]:
+        """Lease `address` to `mac`; None when it is not in the pool or held by another client."""
+        now = time.time()
+        with self._lock:
+            if address is None or not self._available(mac, address, now):
+                return None
+            lease = Lease(mac, address, now + self.lease_time)
+            self._offers.pop(mac, None)
+            self._leases[mac] = lease
+            self.save()
+        return lease
+
+    def cancel_offer(self, mac: str) -> None:
+        with self._lock:
+            self._offers.pop(mac, None)
+
+    def release(self, mac: str, address: str) -> None:
+        """End the lease; the address stays recorded as the last one of `mac`."""
+        with self._lock:
+            lease = self._leases.get(mac)
+            if lease is not None and lease.address == address:
+                self._leases[mac] = lease._replace(expires=time.time())
+                self.save()
+
+    def decline(self, mac: str, address: Optional[str]) -> None:
+        """Take out an address that the client found in use by another host."""
+        with self._lock:
+            if address in self.addresses:
+                self._declined[address] = time.time() + self.lease_time
+                if mac in self._leases and self._leases[mac].address == address:
+                    del self._leases[mac]
+                    self.save()
+                self._offers.pop(mac, None)
+
+
+def open_dhcp_socket(interface: Optional[str], port: int = DHCP_SERVER_PORT, host: str = "") -> socket.socket:
+    """Bind the DHCP server port on `interface`; needs privileges for port 67."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if interface is not None:
+            # receive broadcasts of the P2P group only, and send replies out of it
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode("ASCII"))
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+class AsyncDhcpServer(asyncio.DatagramProtocol):
+    """DHCP server for the sources joining the P2P group, on an asyncio event loop.
+
+    It leases addresses of a :class:`LeasePool` and calls the callbacks of
+    :meth:`subscribe` with each new :class:`Lease`, on the loop thread.
+    Replies are broadcast to `broadcast` unless the client already has an address.
+    """
+
+    def __init__(
+        self,
+        pool: LeasePool,
+        server_address: str,
+        netmask: str,
+        logger="picast",
+        client_port: int = DHCP_CLIENT_PORT,
+        broadcast: str = "255.255.255.255",
+    ):
+        self.pool = pool
+        self.server_address = server_address
+        self.netmask = netmask
+        self.logger = getLogger(logger)
+        self.client_port = client_port
+        self.broadcast = broadcast
+        self.transport = None  # type: Optional[asyncio.DatagramTransport]
+        self._subscribers = []  # type: List[Callable[[Lease], None]]
+
+    def subscribe(self, callback: Callable[[Lease], None]) -> None:
+        self._subscribers.append(callback)
+
+    async def open(self, sock: socket.socket) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(lambda: self, sock=sock)
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        try:
+            request = DhcpMessage.parse(data)
+        except ValueError as e:
+            self.logger.debug("Ignore a datagram from {}:{}: {}".format(addr[0], addr[1], e))
+            return
+        reply = self.handle(request)
+        if reply is not None and self.transport is not None:
+            self.transport.sendto(reply.to_bytes(), (self.destination(request, reply), self.client_port))
+
+    def destination(self, request: DhcpMessage, reply: DhcpMessage) -> str:
+        if request.ciaddr != ZERO_ADDRESS and reply.message_type != DHCPNAK:
+            return request.ciaddr
+        return self.broadcast
+
+    def _reply(self, request: DhcpMessage, message_type: int, address: str = ZERO_ADDRESS) -> DhcpMessage:
+        options = {
+            OPTION_MESSAGE_TYPE: bytes((message_type,)),
+            OPTION_SERVER_ID: socket.inet_aton(self.server_address),
+        }
+        if message_type in (DHCPOFFER, DHCPACK):
+            options[OPTION_SUBNET_MASK] = socket.inet_aton(self.netmask)
+        if address != ZERO_ADDRESS:
+            lease_time = self.pool.lease_time
+            options[OPTION_LEASE_TIME] = struct.pack("!I", lease_time)
+            options[OPTION_RENEWAL_TIME] = struct.pack("!I", lease_time // 2)
+            options[OPTION_REBINDING_TIME] = struct.pack("!I", lease_time * 7 // 8)
+        ciaddr = request.ciaddr if message_type != DHCPNAK else ZERO_ADDRESS
+        return DhcpMessage(BOOTREPLY, request.xid, request.flags, ciaddr, address, request.giaddr, request.chaddr, options)
+
+    def _notify(self, lease: Lease) -> None:
+        self.logger.info("Lease {} to {}".format(lease.address, lease.mac))
+        DHCP_LEASES.inc()
+        for callback in self._subscribers:
+            try:
+                callback(lease)
+            except Exception:
+                self.logger.exception("Error in DHCP lease callback")
+
+    def handle(self, request: DhcpMessage) -> Optional[DhcpMessage]:
+        """Update the leases by `request` and return the reply, if any."""
+        if request.op != BOOTREQUEST:
+            return None
+        mac = request.mac
+        message_type = request.message_type
+        requested = request.address_option(OPTION_REQUESTED_ADDRESS)
+        if message_type == DHCPDISCOVER:
+            address = self.pool.offer(mac, requested)
+            if address is None:
+                self.logger.error("No free address to offer {}".format(mac))
+                return None
+            return self._reply(request, DHCPOFFER, address)
+        if message_type == DHCPREQUEST:
+            server_id = request.address_option(OPTION_SERVER_ID)
+            if server_id is not None and server_id != self.server_address:
+                # the client took an offer of another server
+                self.pool.cancel_offer(mac)
+                return None
+            previous = self.pool.lookup(mac)
+            lease = self.pool.grant(mac, requested if requested is not None else request.ciaddr)
+            if lease is None:
+                self.logger.info("Refuse address {} to {}".format(requested or request.ciaddr, mac))
+                return self._reply(request, DHCPNAK)
+            # a client renewing from its bound address is not a new lease
+            if request.ciaddr != ZERO_ADDRESS and previous is not None and previous.address == lease.address:
+                self.logger.debug("Renew {} of {}".format(lease.address, mac))
+            else:
+                self._notify(lease)
+            return self._reply(request, DHCPACK, lease.address)
+        if message_type == DHCPRELEASE:
+            self.pool.release(mac, request.ciaddr)
+        elif message_type == DHCPDECLINE:
+            self.logger.info("{} declined address {}".format(mac, requested))
+            self.pool.decline(mac, requested)
+        elif message_type == DHCPINFORM:
+            return self._reply(request, DHCPACK)
+        return None
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class DhcpServer(threading.Thread):
+    """Threaded front-end of :class:`AsyncDhcpServer` with the interface of :class:`Dhcpd`.
+
+    The pool starts at 'peeraddress' and leases are kept in 'lease_file'. :meth:`start`
+    binds the server port before the thread starts and waits until the server runs,
+    so a missing privilege or a failure to start is raised to the caller.
+    """
+
+    def __init__(self, interface: Optional[str], logger="picast", port: int = DHCP_SERVER_PORT, **kwargs):
+        super(DhcpServer, self).__init__(name="dhcp-server", daemon=True)
+        self.config = Settings()
+        self.logger = getLogger(logger)
+        self.interface = interface
+        self.port = port
+        pool = LeasePool(
+            self.config.peeraddress,
+            self.config.dhcp_pool_size,
+            self.config.dhcp_lease_time,
+            path=self.config.dhcp_lease_file or None,
+            exclude=(self.config.myaddress,),
+            logger=logger,
+        )
+        self.server = AsyncDhcpServer(pool, self.config.myaddress, self.config.netmask, logger=logger, **kwargs)
+        self.sock = None  # type: Optional[socket.socket]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._stopped = None  # type: Optional[asyncio.Event]
+        self._ready = threading.Event()
+        self._error = None  # type: Optional[BaseException]
+
+    def subscribe(self, callback: Callable[[Lease], None]) -> None:
+        """Call `callback` with each lease granted, from the server thread."""
+        self.server.subscribe(callback)
+
+    def start(self) -> None:
+        self.logger.debug("Start DHCP server on {}.".format(self.interface))
+        self.sock = open_dhcp_socket(self.interface, self.port)
+        super(DhcpServer, self).start()
+        self._ready.wait()
+        if self._error is not None:
+            self.join()
+            raise self._error
+
+    def run(self) -> None:
+        asyncio.run(self._serve())
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._stopped = asyncio.Event()
+        assert self.sock is not None
+        try:
+            await self.server.open(self.sock)
+        except Exception as e:
+            self.sock.close()
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            self.server.close()
+
+    def stop(self) -> None:
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+            self.join()
@@ -4,3 +4,7 @@ class PiCastException(Exception):
 
 class WpaException(Exception):
     pass
+
+
+class RtspException(PiCastException):
+    pass
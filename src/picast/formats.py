@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Resolution tables of the Wi-Fi Display specification, indexed by bit position:
+# (width, height, frame rate, progressive)
+CEA_RESOLUTIONS = (
+    (640, 480, 60, True),
+    (720, 480, 60, True),
+    (720, 480, 60, False),
+    (720, 576, 50, True),
+    (720, 576, 50, False),
+    (1280, 720, 30, True),
+    (1280, 720, 60, True),
+    (1920, 1080, 30, True),
+    (1920, 1080, 60, True),
+    (1920, 1080, 60, False),
+    (1280, 720, 25, True),
+    (1280, 720, 50, True),
+    (1920, 1080, 25, True),
+    (1920, 1080, 50, True),
+    (1920, 1080, 50, False),
+    (1280, 720, 24, True),
+    (1920, 1080, 24, True),
+)
+
+VESA_RESOLUTIONS = tuple(
+    (w, h, rate, True)
+    for w, h in (
+        (800, 600),
+        (1024, 768),
+        (1152, 864),
+        (1280, 768),
+        (1280, 800),
+        (1360, 768),
+        (1366, 768),
+        (1280, 1024),
+        (1400, 1050),
+        (1440, 900),
+        (1600, 900),
+        (1600, 1200),
+        (1680, 1024),
+        (1680, 1050),
+        (1920, 1200),
+    )
+    for rate in (30, 60)
+)
+
+HH_RESOLUTIONS = tuple(
+    (w, h, rate, True)
+    for w, h in ((800, 480), (854, 480), (864, 480), (640, 360), (960, 540), (848, 480))
+    for rate in (30, 60)
+)
+
+H264_PROFILES = {0x01: "constrained-baseline", 0x02: "high"}
+H264_LEVELS = {0x01: "3.1", 0x02: "3.2", 0x04: "4", 0x08: "4.1", 0x10: "4.2"}
+
+# (sampling rate, channels) for each bit of the audio modes bitmap.
+AUDIO_MODES = {
+    "LPCM": ((44100, 2), (48000, 2)),
+    "AAC": ((48000, 2), (48000, 4), (48000, 6), (48000, 8)),
+    "AC3": ((48000, 2), (48000, 4), (48000, 6)),
+}
+
+
+def _lowest_bit(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+
+class VideoFormat(NamedTuple):
+    """H.264 video format selected by the source in ``wfd_video_formats``."""
+
+    native: int
+    preferred: int
+    profile: int
+    level: int
+    cea: int
+    vesa: int
+    hh: int
+    latency: int = 0
+    max_hres: Optional[int] = None
+    max_vres: Optional[int] = None
+
+    @classmethod
+    def parse(cls, value: str) -> Optional["VideoFormat"]:
+        value = value.strip()
+        if not value or value == "none":
+            return None
+        fields = value.split()
+        if len(fields) < 7:
+            raise ValueError("Malformed wfd_video_formats: {}".format(value))
+        # only the first codec entry counts; the source selects a single one.
+        codec = " ".join(fields[2:]).split(",")[0].split()
+        if len(codec) < 5:
+            raise ValueError("Malformed wfd_video_formats: {}".format(value))
+
+        def optional_hex(index: int) -> Optional[int]:
+            if len(codec) <= index or codec[index] == "none":
+                return None
+            return int(codec[index], 16)
+
+        return cls(
+            native=int(fields[0], 16),
+            preferred=int(fields[1], 16),
+            profile=int(codec[0], 16),
+            level=int(codec[1], 16),
+            cea=int(codec[2], 16),
+            vesa=int(codec[3], 16),
+            hh=int(codec[4], 16),
+            latency=optional_hex(5) or 0,
+            max_hres=optional_hex(9),
+            max_vres=optional_hex(10),
+        )
+
+    @property
+    def resolution(self) -> Optional[Tuple[int, int, int, bool]]:
+        """(width, height, frame rate, progressive) of the selected mode, or None when unknown."""
+        for mask, table in ((self.cea, CEA_RESOLUTIONS), (self.vesa, VESA_RESOLUTIONS), (self.hh, HH_RESOLUTIONS)):
+            if mask:
+                index = _lowest_bit(mask)
+                return table[index] if index < len(table) else None
+        return None
+
+    def gst_caps(self) -> str:
+        """Caps of the H.264 elementary stream for a GStreamer capsfilter.
+
+        Only the frame size is fixed. h264parse reports a frame rate of 0/1 for an SPS
+        without timing, and sources may send any profile of those negotiated, so the
+        frame rate, interlacing and profile are left to the stream.
+        """
+        caps = ["video/x-h264"]
+        resolution = self.resolution
+        if resolution is not None:
+            width, height, _, _ = resolution
+            caps.append("width=(int){}".format(width))
+            caps.append("height=(int){}".format(height))
+        return ", ".join(caps)
+
+    @property
+    def h264_profile(self) -> Optional[str]:
+        return H264_PROFILES.get(self.profile & -self.profile)
+
+    @property
+    def h264_level(self) -> Optional[str]:
+        return H264_LEVELS.get(self.level & -self.level)
+
+
+class AudioFormat(NamedTuple):
+    """Audio codec selected by the source in ``wfd_audio_codecs``."""
+
+    codec: str
+    modes: int
+    latency: int = 0
+
+    @classmethod
+    def parse(cls, value: str) -> Optional["AudioFormat"]:
+        value = value.strip()
+        if not value or value == "none":
+            return None
+        fields = value.split(",")[0].split()
+        if len(fields) < 2:
+            raise ValueError("Malformed wfd_audio_codecs: {}".format(value))
+        latency = int(fields[2], 16) if len(fields) > 2 else 0
+        return cls(codec=fields[0], modes=int(fields[1], 16), latency=latency)
+
+    def _mode(self) -> Optional[Tuple[int, int]]:
+        table = AUDIO_MODES.get(self.codec, ())
+        index = _lowest_bit(self.modes) if self.modes else -1
+        return table[index] if 0 <= index < len(table) else None
+
+    @property
+    def rate(self) -> Optional[int]:
+        mode = self._mode()
+        return mode[0] if mode is not None else None
+
+    @property
+    def channels(self) -> Optional[int]:
+        mode = self._mode()
+        return mode[1] if mode is not None else None
+
+
+class SelectedFormat(NamedTuple):
+    """Formats and stream parameters the source set with M4 ``SET_PARAMETER``."""
+
+    video: Optional[VideoFormat] = None
+    audio: Optional[AudioFormat] = None
+    presentation_url: Optional[str] = None
+    rtp_port: Optional[int] = None
+
+    @classmethod
+    def parse(cls, params: Dict[str, str]) -> "SelectedFormat":
+        """Build from parameters as returned by ``parse_parameters``; absent entries are None."""
+        url = params.get("wfd_presentation_URL", "").split()
+        ports = params.get("wfd_client_rtp_ports", "").split()
+        return cls(
+            video=VideoFormat.parse(params.get("wfd_video_formats", "")),
+            audio=AudioFormat.parse(params.get("wfd_audio_codecs", "")),
+            presentation_url=url[0] if url and url[0] != "none" else None,
+            rtp_port=int(ports[1]) if len(ports) > 1 and ports[1].isdigit() else None,
+        )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from typing import Optional
+
+from .settings import Settings
+
+PROFILES = ("interactive", "balanced", "smooth")
+
+
+class LatencyController:
+    """Jitter buffer latency that follows the measured jitter of the link.
+
+    The latency grows at once to `factor` times the jitter, and by half again when
+    packets are lost or arrive late, but shrinks only by `decay` of the excess per
+    update, so a single quiet interval does not undo the headroom of a bad one.
+    All values are in milliseconds and kept between `minimum` and `maximum`.
+    """
+
+    def __init__(self, minimum: int, maximum: int, factor: float = 4.0, decay: float = 0.1):
+        if not 0 < minimum <= maximum:
+            raise ValueError("Invalid latency range {}-{}".format(minimum, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.decay = decay
+        self._latency = float(minimum)
+
+    @classmethod
+    def from_settings(cls, profile: Optional[str] = None) -> "LatencyController":
+        config = Settings()
+        minimum, maximum = config.get_latency_range(profile or config.latency_profile)
+        return cls(minimum, maximum)
+
+    @property
+    def latency(self) -> int:
+        return int(round(self._latency))
+
+    def update(self, jitter: float, lost: int = 0, late: int = 0) -> int:
+        """Take the jitter and the lost and late packets since the last update; return the latency."""
+        target = max(float(self.minimum), jitter * self.factor)
+        if lost or late:
+            target = max(target, self._latency * 1.5)
+        if target >= self._latency:
+            self._latency = min(target, float(self.maximum))
+        else:
+            self._latency -= (self._latency - target) * self.decay
+        return self.latency
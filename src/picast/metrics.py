@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import socket
+import threading
+from logging import getLogger
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from .settings import Settings
+from .timing import DEFAULT_BUCKETS, Histogram, negotiation_stats
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    def dec(self, amount: int = 1) -> None:
+        self.inc(-amount)
+
+    def set(self, value: int) -> None:
+        with self._lock:
+            self.value = value
+
+
+class MetricsRegistry:
+    """Metrics rendered in the Prometheus text exposition format.
+
+    Updating a metric only touches an integer or a histogram bucket; the text is built
+    when a scraper asks for it.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # type: Dict[str, Tuple[str, str, Union[Counter, Histogram]]]
+        self._collectors = []  # type: List[Callable[[], List[str]]]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(name, "counter", help, Counter())  # type: ignore
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._register(name, "gauge", help, Gauge())  # type: ignore
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(name, "histogram", help, Histogram(buckets))  # type: ignore
+
+    def _register(self, name: str, kind: str, help: str, metric: Union[Counter, Histogram]):
+        if name in self._metrics:
+            return self._metrics[name][2]
+        self._metrics[name] = (kind, help, metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[str]]) -> None:
+        """Add a callable returning exposition lines of metrics kept elsewhere."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []  # type: List[str]
+        for name, (kind, help, metric) in self._metrics.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if isinstance(metric, Histogram):
+                lines.extend(histogram_lines(name, metric))
+            else:
+                lines.append("{} {}".format(name, metric.value))
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def histogram_lines(name: str, h: Histogram, labels: str = "") -> List[str]:
+    sep = "," if labels else ""
+    lines = ['{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, _format_bound(b), c) for b, c in h.cumulative()]
+    suffix = "{{{}}}".format(labels) if labels else ""
+    lines.append("{}_sum{} {}".format(name, suffix, h.sum))
+    lines.append("{}_count{} {}".format(name, suffix, h.count))
+    return lines
+
+
+def _negotiation_lines() -> List[str]:
+    stats = negotiation_stats()
+    lines = [
+        "# HELP picast_negotiation_time_to_play_seconds Time from connecting to the player start.",
+        "# TYPE picast_negotiation_time_to_play_seconds histogram",
+    ]
+    lines.extend(histogram_lines("picast_negotiation_time_to_play_seconds", stats.time_to_play))
+    lines.append("# HELP picast_negotiation_step_seconds Time since the previous negotiation event.")
+    lines.append("# TYPE picast_negotiation_step_seconds histogram")
+    for event, h in stats.steps.items():
+        lines.extend(histogram_lines("picast_negotiation_step_seconds", h, 'event="{}"'.format(event)))
+    return lines
+
+
+REGISTRY = MetricsRegistry()
+SESSIONS_ACTIVE = REGISTRY.gauge("picast_sessions_active", "Sessions in playing state.")
+NEGOTIATIONS_SUCCEEDED = REGISTRY.counter("picast_negotiations_succeeded_total", "Negotiations reaching PLAY.")
+NEGOTIATIONS_FAILED = REGISTRY.counter("picast_negotiations_failed_total", "Negotiations failed or aborted.")
+KEEPALIVES = REGISTRY.counter("picast_keepalive_total", "Keep-alive requests received.")
+KEEPALIVE_REPLY_SECONDS = REGISTRY.histogram("picast_keepalive_reply_seconds", "Time to reply to a keep-alive.")
+WATCHDOG_TIMEOUTS = REGISTRY.counter("picast_watchdog_timeouts_total", "Read timeouts while playing.")
+PLAYER_STARTS = REGISTRY.counter("picast_player_starts_total", "Player starts.")
+PLAYER_STOPS = REGISTRY.counter("picast_player_stops_total", "Player stops.")
+PLAYER_CRASHES = REGISTRY.counter("picast_player_crashes_total", "Players exited or failed while playing.")
+IDR_REQUESTS = REGISTRY.counter("picast_idr_requests_total", "IDR requests sent to the source.")
+IDR_SUPPRESSED = REGISTRY.counter("picast_idr_suppressed_total", "IDR requests dropped by the rate limit.")
+RTCP_REPORTS = REGISTRY.counter("picast_rtcp_reports_total", "RTCP receiver reports sent for players without RTCP.")
+WPA_CLI_SECONDS = REGISTRY.histogram("picast_wpa_cli_seconds", "Latency of wpa_supplicant commands.")
+DHCP_LEASES = REGISTRY.counter("picast_dhcp_leases_total", "Addresses newly leased by the DHCP server.")
+REGISTRY.add_collector(_negotiation_lines)
+
+
+def parse_listen(listen: str) -> Optional[Tuple[str, int]]:
+    """Parse ``host:port``; an empty value disables the endpoint."""
+    listen = listen.strip()
+    if not listen:
+        return None
+    host, sep, port = listen.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("Invalid metrics listen address: {}".format(listen))
+    return host.strip("[]") or "0.0.0.0", int(port)
+
+
+class MetricsServer(threading.Thread):
+    """HTTP endpoint serving ``GET /metrics`` from an asyncio loop in its own thread.
+
+    The loop sleeps in the selector until a scraper connects, so an idle endpoint costs nothing.
+    """
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = REGISTRY, logger="picast"):
+        threading.Thread.__init__(self, name="metrics", daemon=True)
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.logger = getLogger(logger)
+        self.ready = threading.Event()
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+
+    @classmethod
+    def from_settings(cls) -> Optional["MetricsServer"]:
+        config = Settings()
+        address = parse_listen(config.metrics_listen)
+        if address is None:
+            return None
+        return cls(address[0], address[1], logger=config.logger)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            request = head.split(b"\r\n", 1)[0].split()
+            if len(request) >= 2 and request[0] == b"GET" and request[1].split(b"?")[0] == b"/metrics":
+                status, ctype, body = "200 OK", "text/plain; version=0.0.4", self.registry.render().encode("UTF-8")
+            else:
+                status, ctype, body = "404 Not Found", "text/plain", b"Not Found\n"
+            writer.write(
+                "HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                    status, ctype, len(body)
+                ).encode("ASCII")
+            )
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        sockets = self._server.sockets or []  # type: Sequence[socket.socket]
+        if sockets:
+            self.port = sockets[0].getsockname()[1]
+        self.logger.info("Serve metrics on {}:{}".format(self.host, self.port))
+        self.ready.set()
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.ready.set()
+
+    def stop(self) -> None:
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
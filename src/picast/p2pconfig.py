@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+from .exceptions import WpaException
+from .wpactrl import WpaCtrl
+
+
+def _is_value(reply: str) -> bool:
+    return reply not in ("FAIL", "UNKNOWN COMMAND") and not reply.startswith("FAIL-")
+
+
+class P2PConfig:
+    """Desired P2P and WFD state of wpa_supplicant, applied by sending only what differs.
+
+    `values` are global parameters of ``SET`` and `subelements` are WFD sub-elements
+    of ``WFD_SUBELEM_SET`` by id, as hex strings with their length. Current values are
+    read back in one pipelined batch, and the changes are sent in another. A value
+    that cannot be read is sent.
+    """
+
+    def __init__(self, values: Dict[str, str], subelements: Dict[int, str], logger="picast"):
+        self.values = values
+        self.subelements = subelements
+        self.logger = getLogger(logger)
+
+    def _items(self) -> List[Tuple[str, str, str]]:
+        """(name, GET command, SET command) of each desired value."""
+        items = [(key, "GET {}".format(key), "SET {} {}".format(key, value)) for key, value in self.values.items()]
+        for key, value in self.subelements.items():
+            items.append(
+                ("wfd_subelem {}".format(key), "WFD_SUBELEM_GET {}".format(key), "WFD_SUBELEM_SET {} {}".format(key, value))
+            )
+        return items
+
+    def desired(self) -> Dict[str, str]:
+        result = dict(self.values)
+        result.update({"wfd_subelem {}".format(key): value.lower() for key, value in self.subelements.items()})
+        return result
+
+    def read(self, wpa: WpaCtrl, interface: Optional[str] = None) -> Dict[str, Optional[str]]:
+        """Current value of each desired item, None when wpa_supplicant cannot tell it."""
+        items = self._items()
+        replies = wpa.request_many([get for _, get, _ in items], interface)
+        current = {}  # type: Dict[str, Optional[str]]
+        for (name, _, _), reply in zip(items, replies):
+            value = reply.strip()
+            if name.startswith("wfd_subelem"):
+                value = value.lower()
+            current[name] = value if _is_value(value) else None
+        return current
+
+    def diff(self, current: Dict[str, Optional[str]]) -> List[str]:
+        """SET commands of the items whose current value differs from the desired one."""
+        desired = self.desired()
+        return [set_cmd for name, _, set_cmd in self._items() if current.get(name) != desired[name]]
+
+    def apply(self, wpa: WpaCtrl, interface: Optional[str] = None) -> List[str]:
+        """Send the differences; return the commands sent, or raise one WpaException naming every failure."""
+        commands = self.diff(self.read(wpa, interface))
+        if not commands:
+            self.logger.debug("wpa_supplicant P2P configuration is up to date.")
+            return []
+        self.logger.debug("Update wpa_supplicant: {}".format(", ".join(c.split(" ", 2)[1] for c in commands)))
+        replies = wpa.request_many(commands, interface)
+        failed = [
+            "{} ({})".format(command, reply.strip()) for command, reply in zip(commands, replies) if reply.strip() != "OK"
+        ]
+        if failed:
+            raise WpaException("Fail to configure wpa_supplicant: {}".format("; ".join(failed)))
+        return commands
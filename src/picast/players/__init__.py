@@ -0,0 +1,26 @@
+from typing import Optional
+
+
+def create_player(name: str, logger="picast", rtp_port: Optional[int] = None):
+    """Create a player by its settings name; the GStreamer binding is imported only when used."""
+    if name == "gst":
+        from .gst import GstPlayer
+
+        return GstPlayer(logger=logger, rtp_port=rtp_port)
+    elif name == "vlc":
+        from .vlc import VlcPlayer
+
+        return VlcPlayer(logger=logger, rtp_port=rtp_port)
+    elif name == "libvlc":
+        from .libvlc import LibVlcPlayer
+
+        return LibVlcPlayer(logger=logger, rtp_port=rtp_port)
+    elif name == "nop":
+        from .nop import NopPlayer
+
+        return NopPlayer(logger=logger, rtp_port=rtp_port)
+    elif name == "record":
+        from .recorder import RecordingPlayer
+
+        return RecordingPlayer(logger=logger, rtp_port=rtp_port)
+    raise ValueError("Unknown player name: {}".format(name))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from logging import getLogger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ..settings import Settings
+
+# H.264 decoders in order of preference, with element properties to set.
+CANDIDATES = (
+    ("v4l2h264dec", {}),
+    ("omxh264dec", {}),
+    ("avdec_h264", {"max-threads": 0}),
+    ("openh264dec", {}),
+)  # type: Tuple[Tuple[str, Dict[str, object]], ...]
+
+# video sinks in order of preference: KMS and GL take decoder output without a CPU
+# colorspace conversion, X11 and the automatic choice are fallbacks.
+VIDEO_SINKS = ("kmssink", "glimagesink", "xvimagesink", "autovideosink")
+
+
+class _BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def u(self, nbits: int, value: int) -> None:
+        for i in range(nbits - 1, -1, -1):
+            self._acc = (self._acc << 1) | ((value >> i) & 1)
+            self._bits += 1
+            if self._bits == 8:
+                self.data.append(self._acc)
+                self._acc = 0
+                self._bits = 0
+
+    def ue(self, value: int) -> None:
+        code = value + 1
+        self.u(code.bit_length() * 2 - 1, code)
+
+    def se(self, value: int) -> None:
+        self.ue(2 * value - 1 if value > 0 else -2 * value)
+
+    def align_zero(self) -> None:
+        if self._bits:
+            self.u(8 - self._bits, 0)
+
+    def trailing(self) -> bytes:
+        self.u(1, 1)
+        self.align_zero()
+        return bytes(self.data)
+
+
+def _nal(header: int, rbsp: bytes) -> bytes:
+    """Annex B NAL unit with emulation prevention."""
+    out = bytearray(b"\x00\x00\x00\x01")
+    out.append(header)
+    zeros = 0
+    for byte in rbsp:
+        if zeros == 2 and byte <= 3:
+            out.append(3)
+            zeros = 0
+        out.append(byte)
+        zeros = zeros + 1 if byte == 0 else 0
+    return bytes(out)
+
+
+def h264_sample(width: int = 320, height: int = 240, frames: int = 10) -> bytes:
+    """Build a constrained baseline H.264 stream of IDR frames with I_PCM macroblocks.
+
+    The stream needs no encoder to create and every decoder must support it.
+    """
+    mbs_w, mbs_h = width // 16, height // 16
+    sps = _BitWriter()
+    sps.u(8, 66)  # profile_idc: baseline
+    sps.u(8, 0xC0)  # constraint_set0 and 1
+    sps.u(8, 30)  # level 3.0
+    sps.ue(0)  # seq_parameter_set_id
+    sps.ue(0)  # log2_max_frame_num_minus4
+    sps.ue(2)  # pic_order_cnt_type
+    sps.ue(1)  # max_num_ref_frames
+    sps.u(1, 0)  # gaps_in_frame_num_value_allowed_flag
+    sps.ue(mbs_w - 1)
+    sps.ue(mbs_h - 1)
+    sps.u(1, 1)  # frame_mbs_only_flag
+    sps.u(1, 1)  # direct_8x8_inference_flag
+    sps.u(1, 0)  # frame_cropping_flag
+    sps.u(1, 0)  # vui_parameters_present_flag
+    pps = _BitWriter()
+    pps.ue(0)  # pic_parameter_set_id
+    pps.ue(0)  # seq_parameter_set_id
+    pps.u(1, 0)  # entropy_coding_mode_flag: CAVLC
+    pps.u(1, 0)  # bottom_field_pic_order_in_frame_present_flag
+    pps.ue(0)  # num_slice_groups_minus1
+    pps.ue(0)  # num_ref_idx_l0_default_active_minus1
+    pps.ue(0)  # num_ref_idx_l1_default_active_minus1
+    pps.u(1, 0)  # weighted_pred_flag
+    pps.u(2, 0)  # weighted_bipred_idc
+    pps.se(0)  # pic_init_qp_minus26
+    pps.se(0)  # pic_init_qs_minus26
+    pps.se(0)  # chroma_qp_index_offset
+    pps.u(1, 0)  # deblocking_filter_control_present_flag
+    pps.u(1, 0)  # constrained_intra_pred_flag
+    pps.u(1, 0)  # redundant_pic_cnt_present_flag
+    stream = [_nal(0x67, sps.trailing()), _nal(0x68, pps.trailing())]
+    chroma = bytes([128]) * 128
+    for n in range(frames):
+        s = _BitWriter()
+        s.ue(0)  # first_mb_in_slice
+        s.ue(7)  # slice_type: I, all slices
+        s.ue(0)  # pic_parameter_set_id
+        s.u(4, 0)  # frame_num
+        s.ue(n & 1)  # idr_pic_id, differs between consecutive IDR pictures
+        s.u(1, 0)  # no_output_of_prior_pics_flag
+        s.u(1, 0)  # long_term_reference_flag
+        s.se(0)  # slice_qp_delta
+        for mb in range(mbs_w * mbs_h):
+            s.ue(25)  # mb_type: I_PCM
+            s.align_zero()
+            # a gradient moving with the frame number; samples stay in the video range.
+            s.data.extend(bytes([16 + (mb + n * 8) % 220]) * 256)
+            s.data.extend(chroma)
+        stream.append(_nal(0x65, s.trailing()))
+    return b"".join(stream)
+
+
+def registry_key(version: str, plugins: Iterable[str]) -> str:
+    """Key of a GStreamer version and the set of installed plugins."""
+    digest = hashlib.sha256(version.encode("UTF-8"))
+    for plugin in sorted(plugins):
+        digest.update(b"\0" + plugin.encode("UTF-8"))
+    return digest.hexdigest()[:32]
+
+
+def rank(timings: Dict[str, Optional[float]]) -> List[str]:
+    """Names of working decoders, fastest first; a None timing is a failed probe."""
+    return sorted((name for name, t in timings.items() if t is not None), key=lambda name: timings[name])  # type: ignore
+
+
+class DecoderProbe:
+    """Select the fastest working H.264 decoder and remember the choice on disk.
+
+    The cache is keyed by the GStreamer version and installed plugins, so a probe runs
+    once after an install or upgrade instead of on every boot.
+    """
+
+    def __init__(self, cache_file: str, logger="picast", timeout: float = 10.0):
+        self.cache_file = cache_file
+        self.logger = getLogger(logger)
+        self.timeout = timeout
+
+    @classmethod
+    def from_settings(cls) -> "DecoderProbe":
+        config = Settings()
+        return cls(config.gst_decoder_cache, logger=config.logger)
+
+    def load(self, key: str) -> Optional[str]:
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cache.get("key") != key:
+            return None
+        return cache.get("decoder")
+
+    def store(self, key: str, decoder: str, timings: Dict[str, Optional[float]]) -> None:
+        try:
+            with open(self.cache_file, "w") as f:
+                json.dump({"key": key, "decoder": decoder, "timings": timings}, f)
+        except OSError as e:
+            self.logger.info("Cannot write decoder cache {}: {}".format(self.cache_file, e))
+
+    def registry(self) -> Tuple[str, List[str]]:
+        """Return the GStreamer version and 'name:version' of each plugin."""
+        from gi.repository import Gst  # type: ignore
+
+        plugins = ["{}:{}".format(p.get_name(), p.get_version()) for p in Gst.Registry.get().get_plugin_list()]
+        return Gst.version_string(), plugins
+
+    def installed(self, names: Iterable[str]) -> List[str]:
+        from gi.repository import Gst  # type: ignore
+
+        return [name for name in names if Gst.ElementFactory.find(name) is not None]
+
+    def time_decode(self, name: str, sample: str) -> Optional[float]:
+        """Decode the `sample` file with decoder `name`; return the seconds taken or None on failure."""
+        from gi.repository import Gst  # type: ignore
+
+        try:
+            pipeline = Gst.parse_launch(
+                "filesrc location={} ! h264parse ! {} name=decoder ! fakesink sync=false".format(sample, name)
+            )
+        except Exception as e:
+            self.logger.debug("Cannot build probe pipeline with {}: {}".format(name, e))
+            return None
+        for key, value in properties(name).items():
+            pipeline.get_by_name("decoder").set_property(key, value)
+        start = time.monotonic()
+        pipeline.set_state(Gst.State.PLAYING)
+        msg = pipeline.get_bus().timed_pop_filtered(
+            int(self.timeout * Gst.SECOND), Gst.MessageType.EOS | Gst.MessageType.ERROR
+        )
+        elapsed = time.monotonic() - start
+        pipeline.set_state(Gst.State.NULL)
+        if msg is None or msg.type != Gst.MessageType.EOS:
+            return None
+        return elapsed
+
+    def probe(self, candidates: List[str]) -> Dict[str, Optional[float]]:
+        fd, path = tempfile.mkstemp(suffix=".h264")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(h264_sample())
+            return {name: self.time_decode(name, path) for name in candidates}
+        finally:
+            os.unlink(path)
+
+    def video_sink(self, configured: str = "auto") -> str:
+        """Return `configured`, or the first installed of :data:`VIDEO_SINKS` when it is `auto`."""
+        if configured != "auto":
+            return configured
+        found = self.installed(VIDEO_SINKS)
+        return found[0] if found else VIDEO_SINKS[-1]
+
+    def select(self, configured: str = "auto") -> Optional[str]:
+        """Return `configured` when it is installed, otherwise the fastest working decoder, or None."""
+        if configured != "auto":
+            if self.installed([configured]):
+                return configured
+            self.logger.info("Decoder {} is not installed, probe others.".format(configured))
+        version, plugins = self.registry()
+        key = registry_key(version, plugins)
+        cached = self.load(key)
+        if cached is not None:
+            return cached
+        timings = self.probe(self.installed(name for name, _ in CANDIDATES))
+        self.logger.info("Decoder probe: {}".format(", ".join("{}={}".format(n, t) for n, t in timings.items())))
+        ranked = rank(timings)
+        if not ranked:
+            self.logger.error("No working H.264 decoder found.")
+            return None
+        self.store(key, ranked[0], timings)
+        return ranked[0]
+
+
+def properties(name: str) -> Dict[str, object]:
+    return dict(CANDIDATES).get(name, {})
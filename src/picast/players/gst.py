@@ -19,7 +19,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import threading
+import time
 from logging import getLogger
+from typing import Callable, Dict, Optional, Tuple
 
 import gi
 
@@ -30,44 +33,314 @@ gi.require_version("GstVideo", "1.0")  # noqa: E402 # isort:skip
 gi.require_version("GdkX11", "3.0")  # noqa: E402 # isort:skip
 from gi.repository import Gst  # noqa: E402 # isort:skip
 
+from ..exceptions import PiCastException  # noqa: E402 # isort:skip
+from ..formats import SelectedFormat  # noqa: E402 # isort:skip
+from ..latency import LatencyController  # noqa: E402 # isort:skip
+from ..metrics import PLAYER_CRASHES, PLAYER_STARTS, PLAYER_STOPS  # noqa: E402 # isort:skip
+from ..rtp import ReceiveStats, SequenceTracker, rtp_sequence  # noqa: E402 # isort:skip
 from ..settings import Settings  # noqa: E402 # isort:skip
+from .decoders import DecoderProbe, properties  # noqa: E402 # isort:skip
 
 
 class GstPlayer:
-    def __init__(self, logger="picast"):
+    """Player of the RTP MPEG-TS stream of a WFD source built on a GStreamer pipeline.
+
+    The transport stream is demultiplexed into an H.264 video branch and an audio
+    branch decoding AAC or LPCM to `audio_sink`; both sinks synchronize on the pipeline
+    clock. The decoder output goes to the video sink without a conversion when the sink
+    accepts it, as KMS and GL sinks do for hardware decoders.
+
+    With `keep_warm`, the pipeline is built once and kept in READY between sessions,
+    so plugins are loaded and the decoder is created before the first session. It is
+    set to NULL, releasing the hardware decoder, after `release_after` idle seconds
+    and prepared again on the next start.
+
+    When RTCP is enabled, an ``rtpsession`` in front of the jitter buffer receives sender
+    reports on the port after the RTP port and sends receiver reports to `rtcp_peer`.
+    """
+
+    def __init__(self, logger="picast", rtp_port: Optional[int] = None, keep_warm: Optional[bool] = None):
         self.config = Settings()
         self.logger = getLogger(logger)
+        self.rtp_port = rtp_port if rtp_port is not None else self.config.rtp_port
+        # called with a reason from a streaming thread when a key frame is needed to recover.
+        self.on_idr_request = None  # type: Optional[Callable[[str], None]]
+        # RTCP address of the source, set by the sink before start
+        self.rtcp_peer = None  # type: Optional[Tuple[str, int]]
+        self.sends_rtcp = self.config.rtcp_enabled
+        self.sequence = SequenceTracker()
+        self.receive = ReceiveStats()
+        self.latency_profile = self.config.latency_profile
+        # interval in seconds to adapt the jitter buffer latency
+        self.adapt_interval = 0.5
+        self.keep_warm = keep_warm if keep_warm is not None else self.config.gst_keep_warm
+        self.release_after = self.config.gst_release_after
+        self.pipeline = None  # type: Optional[Gst.Pipeline]
+        self._lock = threading.Lock()
+        self._release_timer = None  # type: Optional[threading.Timer]
         Gst.init(None)
+        probe = DecoderProbe.from_settings()
+        decoder = probe.select(self.config.gst_decoder)
+        if decoder is None:
+            raise PiCastException("No working H.264 decoder for the gst player")
+        self.decoder = decoder
+        self.video_sink = probe.video_sink(self.config.gst_video_sink)
+        self.audio_sink = self.config.gst_audio_sink
+        self.play_audio = self.audio_sink != "none"
+        self.logger.info("Use decoder {} and video sink {}".format(self.decoder, self.video_sink))
+        if self.keep_warm:
+            self.build().set_state(Gst.State.READY)
 
-    def start(self):
-        self.pipeline = Gst.Pipeline()
+    def build(self) -> "Gst.Pipeline":
+        self.pipeline = pipeline = Gst.Pipeline()
 
-        src = Gst.ElementFactory.make("udpsrc")
-        src.set_property("port", self.config.rtp_port)
-        src.set_property("caps", "application/x-rtp, media=video")
+        self.src = Gst.ElementFactory.make("udpsrc")
+        self.src.set_property(
+            "caps", Gst.Caps.from_string("application/x-rtp, media=video, clock-rate=90000, encoding-name=MP2T")
+        )
+        # udpsrc binds its socket on NULL to READY, so the port is set before the first READY.
+        self.src.set_property("port", self.rtp_port)
 
-        h264 = Gst.ElementFactory.make("rtph264depay")
-        omxdecode = Gst.ElementFactory.make(self.config.gst_decoder)
-        vconv = Gst.ElementFactory.make("videoconvert")
-        sink = Gst.ElementFactory.make("autovideosink")
+        self.latency = LatencyController.from_settings(self.latency_profile)
+        self.jitterbuffer = Gst.ElementFactory.make("rtpjitterbuffer")
+        self.jitterbuffer.set_property("drop-on-latency", self.latency_profile == "interactive")
 
-        for ele in [src, h264, omxdecode, vconv, sink]:
-            self.pipeline.add(ele)
+        depay = Gst.ElementFactory.make("rtpmp2tdepay")
+        self.demux = Gst.ElementFactory.make("tsdemux")
+        self.demux.connect("pad-added", self.on_demux_pad)
 
-        src.link(h264)
-        h264.link(omxdecode)
-        omxdecode.link(vconv)
-        vconv.link(sink)
+        self.video_queue = Gst.ElementFactory.make("queue")
+        h264 = Gst.ElementFactory.make("h264parse")
+        # fix the frame size to the mode selected in M4 so the decoder is configured up front.
+        self.h264caps = Gst.ElementFactory.make("capsfilter")
+        omxdecode = Gst.ElementFactory.make(self.decoder)
+        for key, value in properties(self.decoder).items():
+            omxdecode.set_property(key, value)
+        sink = Gst.ElementFactory.make(self.video_sink)
+
+        self.recovery_elements = (self.demux, h264, omxdecode)
+        depay.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_rtp_buffer)
+        self.jitterbuffer.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_rtp_arrival)
+
+        for ele in [self.src, self.jitterbuffer, depay, self.demux, self.video_queue, h264, self.h264caps, omxdecode, sink]:
+            pipeline.add(ele)
 
-        self.bus = self.pipeline.get_bus()
+        if self.sends_rtcp:
+            self.session = Gst.ElementFactory.make("rtpsession")
+            self.session.set_property("rtcp-min-interval", int(self.config.rtcp_interval * Gst.SECOND))
+            self.rtcpsrc = Gst.ElementFactory.make("udpsrc")
+            self.rtcpsrc.set_property("port", self.rtp_port + 1)
+            self.rtcpsink = Gst.ElementFactory.make("udpsink")
+            self.rtcpsink.set_property("sync", False)
+            self.rtcpsink.set_property("async", False)
+            for ele in [self.session, self.rtcpsrc, self.rtcpsink]:
+                pipeline.add(ele)
+            self.src.link_pads("src", self.session, "recv_rtp_sink")
+            self.session.link_pads("recv_rtp_src", self.jitterbuffer, "sink")
+            self.rtcpsrc.link_pads("src", self.session, "recv_rtcp_sink")
+            self.session.link_pads("send_rtcp_src", self.rtcpsink, "sink")
+        else:
+            self.src.link(self.jitterbuffer)
+        self.jitterbuffer.link(depay)
+        depay.link(self.demux)
+        self.video_queue.link(h264)
+        h264.link(self.h264caps)
+        self.h264caps.link(omxdecode)
+        self._link_video_sink(omxdecode, sink)
+        self.audio_queue = None  # type: Optional[Gst.Element]
+        if self.audio_sink != "none":
+            self._build_audio()
+
+        self.bus = pipeline.get_bus()
         self.bus.add_signal_watch()
         self.bus.connect("message", self.on_message)
-        self.logger.debug("Start gst player...")
-        self.pipeline.set_state(Gst.State.PLAYING)
+        # sync messages are emitted in the posting streaming thread and need no main loop.
+        self.bus.enable_sync_message_emission()
+        self.bus.connect("sync-message::error", self.on_decode_error)
+        self.bus.connect("sync-message::warning", self.on_decode_error)
+        return pipeline
+
+    def _link_video_sink(self, decoder, sink) -> None:
+        """Link the decoder to the sink, through videoconvert only when the sink cannot take its output."""
+        decoded = decoder.get_static_pad("src").query_caps(None)
+        accepted = sink.get_static_pad("sink").query_caps(None)
+        # a bin like autovideosink accepts ANY until it has picked a sink; convert for it.
+        if not accepted.is_any() and decoded.can_intersect(accepted) and decoder.link(sink):
+            self.logger.debug("Link {} to {} without conversion.".format(self.decoder, self.video_sink))
+            return
+        vconv = Gst.ElementFactory.make("videoconvert")
+        assert self.pipeline is not None
+        self.pipeline.add(vconv)
+        decoder.link(vconv)
+        vconv.link(sink)
+
+    def _build_audio(self) -> None:
+        """Audio branch: the codec of the demultiplexed stream, AAC or LPCM, is found by decodebin."""
+        self.audio_queue = Gst.ElementFactory.make("queue")
+        decode = Gst.ElementFactory.make("decodebin")
+        self.audio_convert = Gst.ElementFactory.make("audioconvert")
+        resample = Gst.ElementFactory.make("audioresample")
+        sink = Gst.ElementFactory.make(self.audio_sink)
+        assert self.pipeline is not None
+        for ele in [self.audio_queue, decode, self.audio_convert, resample, sink]:
+            self.pipeline.add(ele)
+        self.audio_queue.link(decode)
+        decode.connect("pad-added", self.on_audio_pad)
+        self.audio_convert.link(resample)
+        resample.link(sink)
+
+    def on_demux_pad(self, demux, pad) -> None:
+        """Link a stream found by tsdemux to its branch; extra streams of the same kind stay unlinked."""
+        name = pad.get_name()
+        if name.startswith("video"):
+            branch = self.video_queue
+        elif name.startswith("audio") and self.play_audio and self.audio_queue is not None:
+            branch = self.audio_queue
+        else:
+            self.logger.debug("Ignore stream {}".format(name))
+            return
+        sinkpad = branch.get_static_pad("sink")
+        if sinkpad.is_linked():
+            self.logger.debug("Ignore extra stream {}".format(name))
+        elif pad.link(sinkpad) != Gst.PadLinkReturn.OK:
+            self.logger.error("Cannot link stream {}".format(name))
+
+    def on_audio_pad(self, decodebin, pad) -> None:
+        sinkpad = self.audio_convert.get_static_pad("sink")
+        if not sinkpad.is_linked():
+            pad.link(sinkpad)
+
+    def destroy(self) -> None:
+        """Set the pipeline to NULL and drop it with its bus watch."""
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.bus.remove_signal_watch()
+            self.pipeline = None
+
+    def _set_ports(self) -> None:
+        """Set the receive ports; a pipeline above NULL keeps its bound sockets, so drop it to NULL first."""
+        if self.src.get_property("port") == self.rtp_port:
+            return
+        assert self.pipeline is not None
+        self.pipeline.set_state(Gst.State.NULL)
+        self.src.set_property("port", self.rtp_port)
+        if self.sends_rtcp:
+            self.rtcpsrc.set_property("port", self.rtp_port + 1)
+
+    def _reset(self, selected: Optional[SelectedFormat]) -> None:
+        """Prepare the built pipeline for a new session."""
+        self._set_ports()
+        if self.sends_rtcp:
+            # without a known source port, reports go to the local discard port.
+            host, port = self.rtcp_peer if self.rtcp_peer is not None else ("127.0.0.1", 9)
+            self.rtcpsink.set_property("host", host)
+            self.rtcpsink.set_property("port", port)
+        caps = Gst.Caps.new_any()
+        if selected is not None and selected.video is not None:
+            self.logger.debug("Selected video {}, caps: {}".format(selected.video, selected.video.gst_caps()))
+            caps = Gst.Caps.from_string(selected.video.gst_caps())
+        self.h264caps.set_property("caps", caps)
+        # a source that selected no audio codec sends no audio stream
+        self.play_audio = self.audio_queue is not None and (selected is None or selected.audio is not None)
+        self.latency = LatencyController.from_settings(self.latency_profile)
+        self.jitterbuffer.set_property("latency", self.latency.latency)
+        self.receive = ReceiveStats()
+        self.sequence = SequenceTracker()
+        self._adapted = (time.monotonic(), 0, 0)
+
+    def _cancel_release(self) -> None:
+        if self._release_timer is not None:
+            self._release_timer.cancel()
+            self._release_timer = None
+
+    def close(self) -> None:
+        """Drop the pipeline at shutdown, warm or not; a later start builds it again."""
+        with self._lock:
+            self._cancel_release()
+            self.destroy()
+
+    def release(self) -> None:
+        """Release the decoder of an idle warm pipeline; it is prepared again on the next start."""
+        with self._lock:
+            self._release_timer = None
+            if self.pipeline is not None and self.pipeline.get_state(0)[1] != Gst.State.PLAYING:
+                self.logger.debug("Release idle gst pipeline.")
+                self.pipeline.set_state(Gst.State.NULL)
+
+    def start(self, selected: Optional[SelectedFormat] = None):
+        with self._lock:
+            self._cancel_release()
+            pipeline = self.pipeline
+            if pipeline is None:
+                pipeline = self.build()
+            else:
+                # leaves PLAYING or PAUSED data of a previous session flushed
+                pipeline.set_state(Gst.State.READY)
+            self._reset(selected)
+            self.logger.debug("Start gst player...")
+            pipeline.set_state(Gst.State.PLAYING)
+        PLAYER_STARTS.inc()
 
     def stop(self):
         self.logger.debug("Stop gst player...")
-        self.pipeline.set_state(Gst.State.NULL)
+        with self._lock:
+            if self.pipeline is None:
+                return
+            if self.keep_warm:
+                # READY flushes all data but keeps the elements and the bound sockets;
+                # the sockets are closed on READY to NULL.
+                self.pipeline.set_state(Gst.State.READY)
+                if self.release_after > 0:
+                    self._release_timer = threading.Timer(self.release_after, self.release)
+                    self._release_timer.daemon = True
+                    self._release_timer.start()
+            else:
+                self.destroy()
+        PLAYER_STOPS.inc()
+
+    def request_idr(self, reason: str) -> None:
+        if self.on_idr_request is not None:
+            self.on_idr_request(reason)
+
+    def on_rtp_buffer(self, pad, info):
+        header = info.get_buffer().extract_dup(0, 4)
+        if len(header) == 4:
+            lost = self.sequence.update(rtp_sequence(header))
+            if lost:
+                self.request_idr("{} RTP packet(s) lost".format(lost))
+        return Gst.PadProbeReturn.OK
+
+    def on_decode_error(self, bus, message):
+        if message.src in self.recovery_elements:
+            self.request_idr("{} from {}".format(Gst.MessageType.get_name(message.type), message.src.get_name()))
+
+    def on_rtp_arrival(self, pad, info):
+        buffer = info.get_buffer()
+        header = buffer.extract_dup(0, 12)
+        if len(header) == 12:
+            now = time.monotonic()
+            self.receive.update(header, buffer.get_size(), now)
+            last, lost, late = self._adapted
+            if now - last >= self.adapt_interval:
+                self.adapt_latency(now, self.sequence.lost - lost, self.receive.sequence.late - late)
+        return Gst.PadProbeReturn.OK
+
+    def adapt_latency(self, now: float, lost: int, late: int) -> None:
+        """Set the jitter buffer latency from the jitter and the lost and late packets of the last interval."""
+        current = self.latency.latency
+        latency = self.latency.update(self.receive.jitter.jitter * 1000, lost, late)
+        if latency != current:
+            self.logger.debug("Jitter buffer latency {} ms -> {} ms".format(current, latency))
+            self.jitterbuffer.set_property("latency", latency)
+        self._adapted = (now, self.sequence.lost, self.receive.sequence.late)
+
+    @property
+    def receive_stats(self) -> ReceiveStats:
+        return self.receive
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        """RTP receive statistics at the jitter buffer input of the current or last session."""
+        return self.receive.snapshot()
 
     def on_message(self, bus, message):
         mtype = message.type
@@ -77,7 +350,10 @@ class GstPlayer:
             if message.get_structure().get_name() == "prepare-window-handle":
                 if hasattr(self, "xid"):
                     message.src.set_window_handle(self.xid)
+            else:
+                self.logger.error("Pipeline error: {}".format(message.parse_error()))
+                PLAYER_CRASHES.inc()
         elif mtype == Gst.MessageType.WARNING:
-            self.logger.debug("on_error():{}".format(message.parse_error()))
+            self.logger.debug("on_error():{}".format(message.parse_warning()))
 
         return True
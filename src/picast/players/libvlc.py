@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+from logging import getLogger
+from typing import Callable, Dict, List, Optional
+
+import vlc
+
+os.putenv("DISPLAY", ":0")  # noqa: E402 # isort:skip
+
+from ..formats import SelectedFormat  # noqa: E402 # isort:skip
+from ..metrics import PLAYER_CRASHES, PLAYER_STARTS, PLAYER_STOPS  # noqa: E402 # isort:skip
+from ..settings import Settings  # noqa: E402 # isort:skip
+
+
+def media_options(caching: int) -> List[str]:
+    """Input options to buffer `caching` milliseconds and absorb clock jitter up to it before resynchronizing."""
+    return [":network-caching={}".format(caching), ":clock-jitter={}".format(caching)]
+
+
+class LibVlcPlayer:
+    """Player on a libvlc instance kept across sessions.
+
+    The instance and its media player are created once, so plugin loading and the
+    video output setup are paid at start-up instead of by every session. Each session
+    only opens new media with the options of the latency profile. Playback state
+    changes are passed to `on_state_change` from a libvlc thread.
+    """
+
+    def __init__(self, logger="picast", rtp_port: Optional[int] = None):
+        self.config = Settings()
+        self.logger = getLogger(logger)
+        self.rtp_port = rtp_port if rtp_port is not None else self.config.rtp_port
+        self.on_idr_request = None  # type: Optional[Callable[[str], None]]
+        # called with "playing", "error" or "ended" when the playback state changes.
+        self.on_state_change = None  # type: Optional[Callable[[str], None]]
+        self.latency_profile = self.config.latency_profile
+        self.state = "stopped"
+        args = ["--no-video-title-show", "--file-logging", "--logfile", self.config.player_log_file]
+        self.instance = vlc.Instance(args + list(self.config.player_custom_args))
+        if self.instance is None:
+            raise RuntimeError("Cannot create a libvlc instance.")
+        self.player = self.instance.media_player_new()
+        self.player.set_fullscreen(True)
+        events = self.player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerPlaying, self._on_event, "playing")
+        events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._on_event, "error")
+        events.event_attach(vlc.EventType.MediaPlayerEndReached, self._on_event, "ended")
+
+    def start(self, selected: Optional[SelectedFormat] = None):
+        self.logger.debug("Start libvlc player.")
+        if selected is not None:
+            self.logger.info("Selected format: {}".format(selected))
+        media = self.instance.media_new("rtp://@:{}".format(self.rtp_port))
+        # VLC has no adaptive buffer, so it takes the largest latency of the profile.
+        _, maximum = self.config.get_latency_range(self.latency_profile)
+        for option in media_options(maximum):
+            media.add_option(option)
+        self.player.set_media(media)
+        media.release()
+        self.state = "opening"
+        if self.player.play() < 0:
+            self.logger.error("libvlc cannot play RTP port {}".format(self.rtp_port))
+            self._on_event(None, "error")
+        PLAYER_STARTS.inc()
+
+    def stop(self):
+        if self.state == "stopped":
+            return
+        self.logger.debug("Stop libvlc player.")
+        # stopping keeps the instance and the video output for the next session
+        self.player.stop()
+        self.state = "stopped"
+        PLAYER_STOPS.inc()
+
+    def _on_event(self, event, state: str) -> None:
+        if self.state == "stopped":
+            return
+        self.state = state
+        if state == "error":
+            PLAYER_CRASHES.inc()
+        if self.on_state_change is not None:
+            self.on_state_change(state)
+
+    def close(self) -> None:
+        """Release the libvlc instance; the player cannot be started again."""
+        self.stop()
+        self.player.release()
+        self.instance.release()
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        # libvlc owns the RTP socket and does not export its input statistics.
+        return None
@@ -22,20 +22,54 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import subprocess
 from logging import getLogger
+from typing import Callable, Dict, Optional
 
 os.putenv("DISPLAY", ":0")  # noqa: E402 # isort:skip
 
+from ..formats import SelectedFormat  # noqa: E402 # isort:skip
+from ..metrics import PLAYER_STARTS, PLAYER_STOPS  # noqa: E402 # isort:skip
+from ..rtp import ReceiveStats, RtpMonitor  # noqa: E402 # isort:skip
+from ..settings import Settings  # noqa: E402 # isort:skip
+
 
 class NopPlayer:
-    def __init__(self, logger="picast"):
+    def __init__(self, logger="picast", rtp_port: Optional[int] = None, rtp_monitor: Optional[bool] = None):
+        self.config = Settings()
         self.logger = getLogger(logger)
-        self.proc = None
+        self.rtp_port = rtp_port if rtp_port is not None else self.config.rtp_port
+        self.rtp_monitor = rtp_monitor if rtp_monitor is not None else self.config.rtp_monitor
+        self.monitor = None  # type: Optional[RtpMonitor]
+        self.proc = None  # type: Optional[subprocess.Popen]
+        self.on_idr_request = None  # type: Optional[Callable[[str], None]]
 
-    def start(self):
+    def start(self, selected: Optional[SelectedFormat] = None):
         self.logger.debug("Start nop client.")
-        self.proc = subprocess.Popen(["echo", "rtp://0.0.0.0:1028/wfd1.0/streamid=0"])
+        if selected is not None:
+            self.logger.info("Selected format: {}".format(selected))
+        PLAYER_STARTS.inc()
+        self.proc = subprocess.Popen(["echo", "rtp://0.0.0.0:{}/wfd1.0/streamid=0".format(self.rtp_port)])
+        if self.rtp_monitor:
+            try:
+                self.monitor = RtpMonitor(self.rtp_port, logger=self.logger.name)
+            except OSError as e:
+                self.logger.error("Cannot monitor RTP port {}: {}".format(self.rtp_port, e))
+            else:
+                self.monitor.start()
 
     def stop(self):
+        if self.monitor is not None:
+            self.monitor.stop()
         if self.proc is not None:
             self.logger.debug("Stop nop client.")
             self.proc.terminate()
+            PLAYER_STOPS.inc()
+
+    @property
+    def receive_stats(self) -> Optional[ReceiveStats]:
+        return self.monitor.stats if self.monitor is not None else None
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        """RTP receive statistics of the current or last session, None without a monitor."""
+        if self.monitor is None:
+            return None
+        return self.monitor.stats.snapshot()
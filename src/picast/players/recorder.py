@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import queue
+import socket
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ..formats import SelectedFormat
+from ..metrics import PLAYER_STARTS, PLAYER_STOPS
+from ..rtp import SequenceTracker, rtp_payload, rtp_sequence
+from ..settings import Settings
+
+# largest UDP datagram; a buffer is handed to the writer when less than this is left.
+MAX_DATAGRAM = 65535
+
+
+class RecordingPlayer:
+    """Record the MPEG-TS payload of the RTP stream into a rotating set of files.
+
+    Datagrams are received straight into large buffers allocated at start, where the
+    RTP header is stripped in place. A writer thread flushes each full buffer with one
+    sequential write. When the disk falls behind and no buffer is free, datagrams are
+    dropped and counted, so memory stays at `buffers` times `buffer_size`.
+    """
+
+    def __init__(self, logger="picast", rtp_port: Optional[int] = None, directory: Optional[str] = None):
+        self.config = Settings()
+        self.logger = getLogger(logger)
+        self.rtp_port = rtp_port if rtp_port is not None else self.config.rtp_port
+        self.directory = directory if directory is not None else self.config.record_directory
+        self.file_size = self.config.record_file_size
+        self.file_count = self.config.record_files
+        self.buffer_size = max(self.config.record_buffer_size, 2 * MAX_DATAGRAM)
+        self.buffer_count = max(self.config.record_buffers, 2)
+        self.on_idr_request = None  # type: Optional[Callable[[str], None]]
+        self.files = []  # type: List[str]
+        self._file_index = 0
+        self.sock = None  # type: Optional[socket.socket]
+        self._threads = []  # type: List[threading.Thread]
+        self._stopped = threading.Event()
+        self._free = queue.Queue()  # type: queue.Queue
+        self._full = queue.Queue()  # type: queue.Queue
+        self._reset_counters()
+
+    def _reset_counters(self) -> None:
+        self.sequence = SequenceTracker()
+        self.received = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.written = 0
+        self.write_errors = 0
+
+    def start(self, selected: Optional[SelectedFormat] = None):
+        self.logger.debug("Start recording RTP port {} into {}.".format(self.rtp_port, self.directory))
+        if selected is not None:
+            self.logger.info("Selected format: {}".format(selected))
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # a large socket buffer covers short stalls of the receive thread; the kernel caps it at rmem_max.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.buffer_size)
+        self.sock.bind(("0.0.0.0", self.rtp_port))
+        # wake up regularly to see a stop request
+        self.sock.settimeout(0.5)
+        self._reset_counters()
+        self._stopped.clear()
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for _ in range(self.buffer_count):
+            self._free.put(bytearray(self.buffer_size))
+        self._prefix = os.path.join(self.directory, time.strftime("picast-%Y%m%d-%H%M%S"))
+        self._file_index = 0
+        self._threads = [
+            threading.Thread(target=self._receive, name="recorder-receive", daemon=True),
+            threading.Thread(target=self._write, name="recorder-write", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        PLAYER_STARTS.inc()
+
+    def stop(self):
+        if not self._threads:
+            return
+        self.logger.debug("Stop recording.")
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.dropped:
+            self.logger.warning("Recorder dropped {} datagram(s); the disk is too slow.".format(self.dropped))
+        PLAYER_STOPS.inc()
+
+    def _receive(self) -> None:
+        assert self.sock is not None
+        sock = self.sock
+        scratch = bytearray(MAX_DATAGRAM)
+        buffer = None  # type: Optional[bytearray]
+        view = memoryview(scratch)
+        offset = 0
+        try:
+            while not self._stopped.is_set():
+                if buffer is None:
+                    try:
+                        buffer = self._free.get_nowait()
+                    except queue.Empty:
+                        pass
+                    else:
+                        view = memoryview(buffer)
+                        offset = 0
+                try:
+                    if buffer is None:
+                        # no free buffer: drain the socket and account the loss
+                        sock.recv_into(scratch)
+                        self.dropped += 1
+                        continue
+                    size = sock.recv_into(view[offset:], MAX_DATAGRAM)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    self.logger.error("Recorder receive failed: {}".format(e))
+                    break
+                self.received += 1
+                start, length = rtp_payload(buffer, offset, size)
+                if length < 0:
+                    self.invalid += 1
+                    continue
+                self.sequence.update(rtp_sequence(buffer, offset))
+                # strip the header in place; memoryview assignment moves overlapping data safely.
+                view[offset : offset + length] = view[offset + start : offset + start + length]
+                offset += length
+                if len(buffer) - offset < MAX_DATAGRAM:
+                    self._full.put((buffer, offset))
+                    buffer = None
+        finally:
+            if buffer is not None and offset:
+                self._full.put((buffer, offset))
+            # wake the writer to finish
+            self._full.put(None)
+            sock.close()
+            self.sock = None
+
+    def _next_file(self):
+        name = "{}-{:03d}.ts".format(self._prefix, self._file_index)
+        self._file_index += 1
+        self.files.append(name)
+        while len(self.files) > self.file_count:
+            try:
+                os.unlink(self.files.pop(0))
+            except OSError:
+                pass
+        self.logger.debug("Record into {}".format(name))
+        return open(name, "wb", buffering=0)
+
+    def _write(self) -> None:
+        f = None
+        in_file = 0
+        try:
+            while True:
+                item = self._full.get()  # type: Optional[Tuple[bytearray, int]]
+                if item is None:
+                    break
+                buffer, length = item
+                try:
+                    if f is None or (in_file and in_file + length > self.file_size):
+                        if f is not None:
+                            f.close()
+                        f = self._next_file()
+                        in_file = 0
+                    view = memoryview(buffer)
+                    done = 0
+                    while done < length:
+                        done += f.write(view[done:length])
+                    in_file += length
+                    self.written += length
+                except OSError as e:
+                    self.write_errors += 1
+                    self.logger.error("Recorder write failed: {}".format(e))
+                self._free.put(buffer)
+        finally:
+            if f is not None:
+                f.close()
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        """Counters of the current or last recording."""
+        return {
+            "received": self.received,
+            "lost": self.sequence.lost,
+            "late": self.sequence.late,
+            "dropped": self.dropped,
+            "invalid": self.invalid,
+            "written": self.written,
+            "files": self._file_index,
+        }
@@ -22,33 +22,52 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import subprocess
 from logging import getLogger
+from typing import Callable, Dict, Optional
 
 os.putenv("DISPLAY", ":0")  # noqa: E402 # isort:skip
 
+from ..formats import SelectedFormat  # noqa: E402 # isort:skip
+from ..metrics import PLAYER_CRASHES, PLAYER_STARTS, PLAYER_STOPS  # noqa: E402 # isort:skip
 from ..settings import Settings  # noqa: E402 # isort:skip
 
 
 class VlcPlayer:
-    def __init__(self, logger="picast"):
+    def __init__(self, logger="picast", rtp_port: Optional[int] = None):
         self.config = Settings()
         self.logger = getLogger(logger)
-        self.vlc = None
+        self.rtp_port = rtp_port if rtp_port is not None else self.config.rtp_port
+        self.vlc = None  # type: Optional[subprocess.Popen]
+        self.on_idr_request = None  # type: Optional[Callable[[str], None]]
 
-    def start(self):
+    def start(self, selected: Optional[SelectedFormat] = None):
         self.logger.debug("Start vlc client.")
+        args = list(self.config.player_custom_args)
+        if selected is not None and selected.video is not None and selected.video.resolution is not None:
+            width, height, _, _ = selected.video.resolution
+            # open the video output with the selected size instead of adapting it to the first frames.
+            args += ["--width={}".format(width), "--height={}".format(height)]
+        PLAYER_STARTS.inc()
         self.vlc = subprocess.Popen(
             [
                 "cvlc",
                 "--fullscreen",
-                *self.config.player_custom_args,
+                *args,
                 "--file-logging",
                 "--logfile",
                 self.config.player_log_file,
-                "rtp://0.0.0.0:1028/wfd1.0/streamid=0",
+                "rtp://0.0.0.0:{}/wfd1.0/streamid=0".format(self.rtp_port),
             ]
         )
 
     def stop(self):
         if self.vlc is not None:
             self.logger.debug("Stop vlc client.")
+            if self.vlc.poll() is not None:
+                self.logger.info("vlc exited while playing with code {}".format(self.vlc.returncode))
+                PLAYER_CRASHES.inc()
             self.vlc.terminate()
+            PLAYER_STOPS.inc()
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        # vlc owns the RTP socket and does not export its input statistics.
+        return None
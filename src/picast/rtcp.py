@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import random
+import socket
+import struct
+import time
+from logging import getLogger
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from .metrics import RTCP_REPORTS
+from .rtp import ReceiveStats
+
+RTCP_SR = 200
+RTCP_RR = 201
+RTCP_SDES = 202
+RTCP_BYE = 203
+SDES_CNAME = 1
+
+
+class ReportBlock(NamedTuple):
+    """Reception report block of RFC 3550 6.4.1."""
+
+    ssrc: int
+    fraction_lost: int
+    cumulative_lost: int
+    highest_seq: int
+    jitter: int
+    lsr: int = 0
+    dlsr: int = 0
+
+    def to_bytes(self) -> bytes:
+        # cumulative loss is a 24-bit signed value
+        lost = max(-(1 << 23), min(self.cumulative_lost, (1 << 23) - 1)) & 0xFFFFFF
+        return struct.pack(
+            "!IIIIII",
+            self.ssrc,
+            self.fraction_lost << 24 | lost,
+            self.highest_seq & 0xFFFFFFFF,
+            self.jitter & 0xFFFFFFFF,
+            self.lsr,
+            self.dlsr & 0xFFFFFFFF,
+        )
+
+
+def _header(count: int, packet_type: int, length: int) -> bytes:
+    """Common header; `length` is the packet size in bytes."""
+    return struct.pack("!BBH", 0x80 | count, packet_type, length // 4 - 1)
+
+
+def receiver_report(ssrc: int, blocks: List[ReportBlock]) -> bytes:
+    body = b"".join(block.to_bytes() for block in blocks)
+    return _header(len(blocks), RTCP_RR, 8 + len(body)) + struct.pack("!I", ssrc) + body
+
+
+def source_description(ssrc: int, cname: str) -> bytes:
+    item = bytes([SDES_CNAME, len(cname)]) + cname.encode("UTF-8")
+    # the item list ends with a null octet and is padded to 32 bits
+    chunk = struct.pack("!I", ssrc) + item + b"\0" * (4 - len(item) % 4)
+    return _header(1, RTCP_SDES, 4 + len(chunk)) + chunk
+
+
+def goodbye(ssrc: int) -> bytes:
+    return _header(1, RTCP_BYE, 8) + struct.pack("!I", ssrc)
+
+
+def parse_sender_reports(data: bytes) -> List[Tuple[int, int]]:
+    """Return (sender SSRC, middle 32 bits of the NTP timestamp) of each SR in a compound packet."""
+    reports = []
+    offset = 0
+    while offset + 4 <= len(data):
+        first, packet_type, length = struct.unpack_from("!BBH", data, offset)
+        size = (length + 1) * 4
+        if first >> 6 != 2 or offset + size > len(data):
+            break
+        if packet_type == RTCP_SR and size >= 28:
+            ssrc, ntp_sec, ntp_frac = struct.unpack_from("!III", data, offset + 4)
+            reports.append((ssrc, (ntp_sec & 0xFFFF) << 16 | ntp_frac >> 16))
+        offset += size
+    return reports
+
+
+class ReceptionState:
+    """Interval accounting of RFC 3550 A.3 to build report blocks from :class:`ReceiveStats`."""
+
+    def __init__(self, clock_rate: int = 90000):
+        self.clock_rate = clock_rate
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.lsr = 0
+        self.sr_arrival = None  # type: Optional[float]
+        self._stats = None  # type: Optional[ReceiveStats]
+
+    def on_sender_report(self, lsr: int, arrival: float) -> None:
+        self.lsr = lsr
+        self.sr_arrival = arrival
+
+    def block(self, stats: Optional[ReceiveStats], now: float) -> Optional[ReportBlock]:
+        if stats is None or stats.ssrc is None:
+            return None
+        if stats is not self._stats:
+            # a new stream, as a player creates its statistics per session
+            self._stats = stats
+            self.expected_prior = self.received_prior = 0
+        expected = stats.sequence.packets_expected
+        expected_interval = expected - self.expected_prior
+        lost_interval = expected_interval - (stats.received - self.received_prior)
+        self.expected_prior = expected
+        self.received_prior = stats.received
+        fraction = 0
+        if expected_interval > 0 and lost_interval > 0:
+            fraction = min(255, (lost_interval << 8) // expected_interval)
+        dlsr = 0
+        if self.sr_arrival is not None:
+            dlsr = int((now - self.sr_arrival) * 65536)
+        return ReportBlock(
+            ssrc=stats.ssrc,
+            fraction_lost=fraction,
+            cumulative_lost=expected - stats.received,
+            highest_seq=stats.sequence.highest,
+            jitter=int(stats.jitter.jitter * self.clock_rate),
+            lsr=self.lsr,
+            dlsr=dlsr,
+        )
+
+
+class RtcpReporter(asyncio.DatagramProtocol):
+    """Send RTCP receiver reports from the port paired with the RTP port.
+
+    It serves players which do not send RTCP themselves. The statistics come from
+    `stats_source`, called for every report, so a player may replace them between
+    sessions. Without statistics, reports carry no block and only tell the source that
+    the receiver is alive. Sender reports received on the port give LSR and DLSR, and
+    their origin replaces `peer` as the destination.
+    """
+
+    def __init__(
+        self,
+        peer: Optional[Tuple[str, int]],
+        stats_source: Callable[[], Optional[ReceiveStats]],
+        interval: float = 5.0,
+        logger="picast",
+    ):
+        self.peer = peer
+        self.stats_source = stats_source
+        self.interval = interval
+        self.logger = getLogger(logger)
+        self.ssrc = random.getrandbits(32)
+        self.cname = "picast@{}".format(socket.gethostname())
+        self.state = ReceptionState()
+        self.transport = None  # type: Optional[asyncio.DatagramTransport]
+        self._task = None  # type: Optional[asyncio.Task]
+
+    async def open(self, port: int, host: str = "0.0.0.0") -> None:
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        self._task = asyncio.ensure_future(self._run())
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        reports = parse_sender_reports(data)
+        if reports:
+            self.state.on_sender_report(reports[-1][1], time.monotonic())
+            if self.peer != addr:
+                self.logger.debug("RTCP peer is {}:{}".format(*addr))
+                self.peer = addr
+
+    def report(self, now: Optional[float] = None) -> bytes:
+        block = self.state.block(self.stats_source(), time.monotonic() if now is None else now)
+        blocks = [block] if block is not None else []
+        return receiver_report(self.ssrc, blocks) + source_description(self.ssrc, self.cname)
+
+    def send(self, packet: bytes) -> None:
+        if self.transport is not None and self.peer is not None:
+            self.transport.sendto(packet, self.peer)
+            RTCP_REPORTS.inc()
+
+    async def _run(self) -> None:
+        while True:
+            # randomized as in RFC 3550 6.3.1, not to synchronize with other receivers
+            await asyncio.sleep(self.interval * random.uniform(0.5, 1.5))
+            self.send(self.report())
+
+    def close(self) -> None:
+        """Stop reporting and say goodbye to the source."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.transport is not None:
+            self.send(self.report() + goodbye(self.ssrc))
+            self.transport.close()
+            self.transport = None
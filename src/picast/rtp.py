@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import socket
+import threading
+import time
+from logging import getLogger
+from typing import Deque, Dict, Optional, Set, Tuple, Union
+
+RTP_SEQ_MOD = 1 << 16
+# RFC 3550 A.1: a larger forward jump is taken as a restart of the sender.
+MAX_DROPOUT = 3000
+
+
+def rtp_sequence(header: Union[bytes, bytearray], offset: int = 0) -> int:
+    """Sequence number of an RTP packet starting at `offset` of `header`."""
+    return (header[offset + 2] << 8) | header[offset + 3]
+
+
+def rtp_payload(packet: Union[bytes, bytearray], offset: int, size: int) -> Tuple[int, int]:
+    """Return (start, length) of the payload of the `size` bytes RTP packet at `offset` of `packet`.
+
+    The length is -1 when the packet is not a valid RTP packet.
+    """
+    if size < 12 or packet[offset] >> 6 != 2:
+        return 0, -1
+    start = 12 + 4 * (packet[offset] & 0x0F)
+    if packet[offset] & 0x10:
+        # header extension: 16-bit profile, 16-bit length in 32-bit words
+        if size < start + 4:
+            return 0, -1
+        start += 4 + 4 * ((packet[offset + start + 2] << 8) | packet[offset + start + 3])
+    end = size
+    if packet[offset] & 0x20:
+        end -= packet[offset + size - 1]
+    if end < start:
+        return 0, -1
+    return start, end - start
+
+
+class SequenceTracker:
+    """Detect gaps in the 16-bit RTP sequence numbers of a stream."""
+
+    def __init__(self):
+        self.expected = None  # type: Optional[int]
+        self.lost = 0
+        self.late = 0
+        # extended sequence numbers, counting the wrap arounds, of the first and the highest packet.
+        self.base = 0
+        self.highest = 0
+
+    @property
+    def packets_expected(self) -> int:
+        """Packets expected since the first one, as defined in RFC 3550 A.3."""
+        return 0 if self.expected is None else self.highest - self.base + 1
+
+    def update(self, seq: int) -> int:
+        """Account packet `seq`; return the number of packets missing right before it."""
+        if self.expected is None:
+            self.expected = (seq + 1) % RTP_SEQ_MOD
+            self.base = self.highest = seq
+            return 0
+        delta = (seq - self.expected) % RTP_SEQ_MOD
+        if delta == 0:
+            self.expected = (seq + 1) % RTP_SEQ_MOD
+            self.highest += 1
+            return 0
+        if delta >= RTP_SEQ_MOD - MAX_DROPOUT:
+            # duplicate or reordered packet behind the expected one
+            self.late += 1
+            return 0
+        self.expected = (seq + 1) % RTP_SEQ_MOD
+        self.highest += delta + 1
+        if delta > MAX_DROPOUT:
+            # the jump of a restart is not expected packets
+            self.base += delta
+            return 0
+        self.lost += delta
+        return delta
+
+
+def rtp_timestamp(header: bytes) -> int:
+    """Media timestamp of an RTP packet from its first 8 bytes."""
+    return int.from_bytes(header[4:8], "big")
+
+
+def rtp_ssrc(header: bytes) -> int:
+    """Synchronization source of an RTP packet from its first 12 bytes."""
+    return int.from_bytes(header[8:12], "big")
+
+
+class JitterEstimator:
+    """Interarrival jitter of RFC 3550 6.4.1, in seconds."""
+
+    def __init__(self, clock_rate: int = 90000):
+        self.clock_rate = clock_rate
+        self.jitter = 0.0
+        self._transit = None  # type: Optional[float]
+
+    def update(self, timestamp: int, arrival: float) -> float:
+        """Account a packet with RTP `timestamp` received at `arrival` seconds; return the jitter."""
+        transit = arrival - timestamp / self.clock_rate
+        if self._transit is not None:
+            d = abs(transit - self._transit)
+            # a timestamp wrap around shows up as a huge step; skip it.
+            if d < (1 << 31) / self.clock_rate:
+                self.jitter += (d - self.jitter) / 16
+        self._transit = transit
+        return self.jitter
+
+
+class ReceiveStats:
+    """Receive statistics of one RTP stream: loss, jitter, reordering and bitrate.
+
+    A packet filling a gap late is counted as reordered and no longer as lost, so `lost`
+    follows the cumulative number of packets lost of RFC 3550 6.4.1.
+    """
+
+    # sequence numbers remembered to tell a duplicate from a reordered packet
+    RECENT = 1024
+
+    def __init__(self, clock_rate: int = 90000, window: float = 1.0):
+        self.sequence = SequenceTracker()
+        self.jitter = JitterEstimator(clock_rate)
+        self.window = window
+        self.received = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.bitrate = 0.0
+        self.ssrc = None  # type: Optional[int]
+        self.first = None  # type: Optional[float]
+        self.last = None  # type: Optional[float]
+        self._window_start = None  # type: Optional[float]
+        self._window_bytes = 0
+        self._recent = collections.deque()  # type: Deque[int]
+        self._seen = set()  # type: Set[int]
+
+    def update(self, header: bytes, size: int, arrival: float) -> None:
+        """Account a packet of `size` bytes starting with the RTP `header`, received at `arrival` seconds.
+
+        The source is taken from the header when it holds the first 12 bytes.
+        """
+        seq = rtp_sequence(header)
+        if len(header) >= 12:
+            self.ssrc = rtp_ssrc(header)
+        late = self.sequence.late
+        self.sequence.update(seq)
+        if self.sequence.late != late:
+            if seq in self._seen:
+                self.duplicates += 1
+            else:
+                self.reordered += 1
+        if seq not in self._seen:
+            if len(self._recent) >= self.RECENT:
+                self._seen.discard(self._recent.popleft())
+            self._recent.append(seq)
+            self._seen.add(seq)
+        self.jitter.update(rtp_timestamp(header), arrival)
+        self.received += 1
+        self.bytes += size
+        if self.first is None:
+            self.first = arrival
+            self._window_start = arrival
+        self.last = arrival
+        self._window_bytes += size
+        elapsed = arrival - self._window_start  # type: ignore
+        if elapsed >= self.window:
+            self.bitrate = self._window_bytes * 8 / elapsed
+            self._window_start = arrival
+            self._window_bytes = 0
+
+    @property
+    def lost(self) -> int:
+        return max(0, self.sequence.lost - self.reordered)
+
+    @property
+    def average_bitrate(self) -> float:
+        if self.first is None or self.last is None or self.last <= self.first:
+            return 0.0
+        return self.bytes * 8 / (self.last - self.first)
+
+    def snapshot(self) -> Dict[str, object]:
+        """Return the current values as plain data for export."""
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "duplicates": self.duplicates,
+            "reordered": self.reordered,
+            "jitter_ms": self.jitter.jitter * 1000,
+            "bitrate": self.bitrate,
+            "average_bitrate": self.average_bitrate,
+            "bytes": self.bytes,
+        }
+
+
+def stats_summary(stats: Dict[str, object]) -> str:
+    """One line of receive statistics, such as a :meth:`ReceiveStats.snapshot`, for the log."""
+    parts = []
+    for key, value in stats.items():
+        if key.endswith("bitrate"):
+            parts.append("{} {:.2f} Mbps".format(key.replace("_", " "), value / 1e6))  # type: ignore
+        elif key.endswith("_ms"):
+            parts.append("{} {:.1f} ms".format(key[:-3], value))  # type: ignore
+        else:
+            parts.append("{} {}".format(key, value))
+    return "RTP " + ", ".join(parts)
+
+
+class RtpMonitor(threading.Thread):
+    """Receive an RTP stream on a UDP port only to account :class:`ReceiveStats`.
+
+    Players that do not decode in-process use it to tell network trouble from decoding
+    trouble.
+    """
+
+    def __init__(self, port: int, host: str = "0.0.0.0", logger="picast"):
+        threading.Thread.__init__(self, name="rtp-monitor", daemon=True)
+        self.logger = getLogger(logger)
+        self.stats = ReceiveStats()
+        self._stopped = threading.Event()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind((host, port))
+        except OSError:
+            self.sock.close()
+            raise
+        # wake up regularly to see a stop request
+        self.sock.settimeout(0.5)
+
+    def run(self):
+        buf = bytearray(2048)
+        view = memoryview(buf)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    size = self.sock.recv_into(buf)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    self.logger.debug("RTP monitor stopped: {}".format(e))
+                    break
+                if size >= 12:
+                    self.stats.update(view[:12], size, time.monotonic())
+        finally:
+            self.sock.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self.is_alive():
+            self.join(1)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from typing import List, Union
+
+
+class MessageTemplate:
+    """RTSP message encoded once, with `{}` slots filled per message.
+
+    :meth:`render` returns the static parts and the slot values as a list of bytes,
+    ready for a scatter write without joining them into a new string.
+    """
+
+    def __init__(self, text: str):
+        self.parts = tuple(p.encode("ASCII") for p in text.split("{}"))
+
+    def render(self, *values: Union[str, bytes]) -> List[bytes]:
+        if len(values) != len(self.parts) - 1:
+            raise ValueError("Template expects {} values".format(len(self.parts) - 1))
+        result = [self.parts[0]]
+        for value, part in zip(values, self.parts[1:]):
+            result.append(value.encode("ASCII") if isinstance(value, str) else value)
+            result.append(part)
+        return result
+
+    def to_bytes(self, *values: Union[str, bytes]) -> bytes:
+        return b"".join(self.render(*values))
+
+
+RESPONSE_OK = MessageTemplate("RTSP/1.0 200 OK\r\nCSeq: {}\r\n\r\n")
+RESPONSE_BAD_REQUEST = MessageTemplate("RTSP/1.0 400 Bad Request\r\nCSeq: {}\r\n\r\n")
+RESPONSE_NOT_VALID = MessageTemplate("RTSP/1.0 455 Method Not Valid In This State\r\nCSeq: {}\r\n\r\n")
+RESPONSE_OPTIONS = MessageTemplate(
+    "RTSP/1.0 200 OK\r\nCSeq: {}\r\nPublic: org.wfa.wfd1.0, SET_PARAMETER, GET_PARAMETER\r\n\r\n"
+)
+REQUEST_TEARDOWN = MessageTemplate("TEARDOWN rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: {}\r\n\r\n")
+REQUEST_IDR = MessageTemplate(
+    "SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: {}\r\nSession: {}\r\n"
+    "Content-Type: text/parameters\r\nContent-Length: 17\r\n\r\nwfd_idr_request\r\n"
+)
+
+
+def session_request(method: str, url: str) -> MessageTemplate:
+    """Template of a request carrying a session, with CSeq and Session slots."""
+    return MessageTemplate("{} {} RTSP/1.0\r\nCSeq: {{}}\r\nSession: {{}}\r\n\r\n".format(method, url))
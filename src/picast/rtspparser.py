@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+from typing import Dict, Iterator, List, MutableMapping, Optional, Tuple
+
+from .buffer import RecvBuffer
+from .exceptions import RtspException
+
+STATUS_LINE = re.compile(r"RTSP/1\.0 ([0-9]{3})(?: (.*))?$")
+RTSP_VERSION = "RTSP/1.0"
+
+
+class RtspHeaders(MutableMapping[str, Optional[str]]):
+    """Case-insensitive header map that keeps the spelling of the first occurrence."""
+
+    def __init__(self, *args, **kwargs):
+        self._store = {}  # type: Dict[str, Tuple[str, Optional[str]]]
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key: str, value: Optional[str]) -> None:
+        lkey = key.lower()
+        if lkey in self._store:
+            key = self._store[lkey][0]
+        self._store[lkey] = (key, value)
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        return self._store[key.lower()][1]
+
+    def __delitem__(self, key: str) -> None:
+        del self._store[key.lower()]
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key, _ in self._store.values())
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, dict(self.items()))
+
+
+class RtspMessage:
+    """Base of a parsed RTSP request or response."""
+
+    def __init__(self, headers: RtspHeaders, body: bytes = b""):
+        self.headers = headers
+        self.body = body
+        self._text = None  # type: Optional[str]
+
+    @property
+    def cseq(self) -> Optional[str]:
+        return self.headers.get("CSeq")
+
+    @property
+    def text(self) -> str:
+        """Body decoded as UTF-8, decoded on first access."""
+        if self._text is None:
+            self._text = self.body.decode("UTF-8")
+        return self._text
+
+
+class RtspRequest(RtspMessage):
+    def __init__(self, method: str, url: str, headers: RtspHeaders, body: bytes = b""):
+        super(RtspRequest, self).__init__(headers, body)
+        self.method = method
+        self.url = url
+
+    def __repr__(self):
+        return "RtspRequest({} {} CSeq={})".format(self.method, self.url, self.cseq)
+
+
+class RtspResponse(RtspMessage):
+    def __init__(self, status: int, reason: str, headers: RtspHeaders, body: bytes = b""):
+        super(RtspResponse, self).__init__(headers, body)
+        self.status = status
+        self.reason = reason
+
+    def __repr__(self):
+        return "RtspResponse({} {} CSeq={})".format(self.status, self.reason, self.cseq)
+
+
+class RtspParser:
+    """Incremental RTSP message parser that does no I/O by itself.
+
+    Bytes are given with :meth:`feed`, or received directly into :attr:`buffer` by a
+    transport, and complete messages are taken out with :meth:`next_message`.
+    Several pipelined messages in one chunk and bodies split over chunks are handled.
+    """
+
+    def __init__(self, buffer: Optional[RecvBuffer] = None):
+        self.buffer = buffer if buffer is not None else RecvBuffer()
+        self._lines = []  # type: List[str]
+        self._pending = None  # type: Optional[RtspMessage]
+        self._length = 0
+
+    def feed(self, data: bytes) -> List[RtspMessage]:
+        """Append `data` and return the messages completed by it."""
+        self.buffer.feed(data)
+        return list(self.messages())
+
+    def messages(self) -> Iterator[RtspMessage]:
+        msg = self.next_message()
+        while msg is not None:
+            yield msg
+            msg = self.next_message()
+
+    def next_message(self) -> Optional[RtspMessage]:
+        if self._pending is None and not self._read_header_block():
+            return None
+        assert self._pending is not None
+        if len(self.buffer) < self._length:
+            return None
+        msg = self._pending
+        if self._length > 0:
+            msg.body = bytes(self.buffer.read(self._length))
+        self._pending = None
+        self._length = 0
+        return msg
+
+    def _read_header_block(self) -> bool:
+        while True:
+            line = self.buffer.readline()
+            if line is None:
+                return False
+            if not line:
+                if not self._lines:
+                    # ignore empty lines between messages
+                    continue
+                break
+            self._lines.append(str(line, "UTF-8"))
+        lines, self._lines = self._lines, []
+        headers = RtspHeaders()
+        for h in lines[1:]:
+            key, sep, val = h.partition(":")
+            if not sep:
+                raise RtspException("Malformed header line: {}".format(h))
+            headers[key.strip()] = val.strip()
+        self._pending = self._start_line(lines[0], headers)
+        try:
+            self._length = int(headers.get("Content-Length") or 0)
+        except ValueError:
+            raise RtspException("Malformed Content-Length: {}".format(headers["Content-Length"]))
+        return True
+
+    @staticmethod
+    def _start_line(line: str, headers: RtspHeaders) -> RtspMessage:
+        if line.startswith(RTSP_VERSION):
+            m = STATUS_LINE.match(line)
+            if m is None:
+                raise RtspException("Malformed status line: {}".format(line))
+            return RtspResponse(int(m.group(1)), m.group(2) or "", headers)
+        parts = line.split(" ")
+        if len(parts) != 3 or parts[2] != RTSP_VERSION:
+            raise RtspException("Malformed request line: {}".format(line))
+        return RtspRequest(parts[0], parts[1], headers)
@@ -19,148 +19,128 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import errno
-import re
-import socket
+import asyncio
+import collections
+import enum
 import threading
-from logging import getLogger
-from time import sleep
-from typing import Dict, List, Optional, Tuple
+import time
+from logging import DEBUG, getLogger
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
 
+from .connector import Connector
+from .dhcpd import Lease
 from .discovery import ServiceDiscovery
+from .exceptions import RtspException
+from .formats import SelectedFormat
+from .metrics import (
+    IDR_REQUESTS,
+    IDR_SUPPRESSED,
+    KEEPALIVE_REPLY_SECONDS,
+    KEEPALIVES,
+    NEGOTIATIONS_FAILED,
+    NEGOTIATIONS_SUCCEEDED,
+    SESSIONS_ACTIVE,
+    WATCHDOG_TIMEOUTS,
+)
+from .rtcp import RtcpReporter
+from .rtp import stats_summary
+from .rtspbuilder import (
+    REQUEST_IDR,
+    REQUEST_TEARDOWN,
+    RESPONSE_NOT_VALID,
+    RESPONSE_OK,
+    RESPONSE_OPTIONS,
+    MessageTemplate,
+    session_request,
+)
+from .rtspparser import RtspMessage, RtspParser, RtspRequest, RtspResponse
 from .settings import Settings
+from .timing import NegotiationTimer, negotiation_stats
 from .video import RasberryPiVideo
 
 
 class RTSPTransport:
-    def __init__(self, host, port):
-        self.buffer = None
-        self._max_attempt = 1000
-        self.open_connection(host, port)
+    """Blocking connection to the RTSP port of a source; :meth:`close` closes the `connector` too.
 
-    def open_connection(self, host, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    Messages are read by :class:`AsyncRtspSink` through :class:`RtspParser`, which
+    keeps received data in a :class:`RecvBuffer`.
+    """
 
-        for _ in range(self._max_attempt):
-            try:
-                sock.connect((host, port))
-            except Exception:
-                sleep(0.5)
-            else:
-                break
+    def __init__(self, host, port, connector: Optional[Connector] = None):
+        self.connector = connector if connector is not None else Connector(deadline=Settings().connect_timeout)
+        try:
+            self.open_connection(host, port)
+        except Exception:
+            self.connector.close()
+            raise
+
+    def open_connection(self, host, port):
+        sock = self.connector.connect(host, port)
         sock.settimeout(1)
         self.sock = sock
 
+    def cancel(self):
+        """Abort a connect in progress from another thread."""
+        self.connector.cancel()
+
     def settimeout(self, value):
         return self.sock.settimeout(value)
 
     def close(self):
         self.sock.close()
-
-    def read(self, size) -> bytes:
-        if self.buffer:
-            if len(self.buffer) > size:
-                res = self.buffer[:size]
-                self.buffer = self.buffer[size:]
-            else:
-                res = self.buffer
-                self.buffer = None
-                if len(res) < size:
-                    res += self.sock.recv(size - len(res))
-        else:
-            res = self.sock.recv(size)
-        return res
-
-    def readline(self) -> bytes:
-        if self.buffer is None:
-            self.buffer = self.sock.recv(1024)
-        while True:
-            if b"\r\n" in self.buffer:
-                (line, self.buffer) = self.buffer.split(b"\r\n", 1)
-                return line
-            else:
-                more = self.sock.recv(1024)
-                if not more:
-                    break
-                else:
-                    self.buffer += more
-        if self.buffer is not None:
-            res = self.buffer
-            self.buffer = None
-            return res
-        else:
-            return b""
-
-    def write(self, b: bytes):
-        return self.sock.sendall(b)
-
-
-class RtspSink(threading.Thread):
-    def __init__(self, player, logger="picast"):
-        super(RtspSink, self).__init__(name="rtsp-server-0", daemon=True)
+        self.connector.close()
+
+
+class SessionState(enum.Enum):
+    INIT = 0  # waiting for M1
+    CAPABILITY = 1  # M1 answered and M2 sent; M3/M4 exchange and M5 trigger
+    SETUP = 2  # M6 SETUP sent
+    PLAY = 3  # M7 PLAY sent
+    PLAYING = 4
+    TEARDOWN = 5  # TEARDOWN sent
+    CLOSED = 6
+
+
+class RtspSinkBase:
+    """Negotiation logic shared by the threaded and the asyncio sink.
+
+    Incoming messages go through :meth:`dispatch`, which looks up a handler by the
+    current :class:`SessionState` and the request method, or for responses by the method
+    of the outstanding request with the same CSeq. Handlers queue outgoing messages,
+    which the front-end sends with :meth:`parts_to_send`.
+    """
+
+    def __init__(
+        self,
+        player,
+        logger="picast",
+        peeraddress: Optional[str] = None,
+        rtsp_port: Optional[int] = None,
+        rtp_port: Optional[int] = None,
+        video: Optional[RasberryPiVideo] = None,
+    ):
         self.config = Settings()
         self.logger = getLogger(logger)
         self.player = player
+        self.peeraddress = peeraddress if peeraddress is not None else self.config.peeraddress
+        self.rtsp_port = rtsp_port if rtsp_port is not None else self.config.rtsp_port
+        self.rtp_port = rtp_port if rtp_port is not None else self.config.rtp_port
         self.watchdog = 0
         self.csnum = 0
-        self.daemon = True
-        self.video = RasberryPiVideo()
+        self.wfd_selected = {}  # type: Dict[str, str]
+        self.selected_format = None  # type: Optional[SelectedFormat]
+        self.idr_interval = self.config.idr_interval
+        self.rtcp_enabled = self.config.rtcp_enabled
+        self._last_idr = None  # type: Optional[float]
+        self.timer = NegotiationTimer()
+        self.stats = negotiation_stats()
+        self.last_rtp_stats = None  # type: Optional[Dict[str, object]]
+        self._rtp_live = False
+        self.reset_session()
+        self.video = video if video is not None else RasberryPiVideo()
         self.wfd_parameters = self.config.get_wfd_parameters()
         self.wfd_video_formats = self.video.get_wfd_video_formats()
 
-    def get_rtsp_headers(self) -> Dict[str, Optional[str]]:
-        headers = self.read_headers()
-        results = {}
-        firstline = headers[0]
-        regex = re.compile(r"RTSP/1.0 ([0-9]+) (\w+([ ]\w)*)")
-        if firstline.startswith("RTSP/1.0"):
-            m = regex.match(firstline)
-            if m:
-                status, reason = m.group(1, 2)
-                cmd = None
-                url = None
-                resp = "{} {}".format(status, reason)  # type: Optional[str]
-            else:
-                raise ValueError
-        else:
-            cmd, url, version = firstline.split(" ")
-            if version != "RTSP/1.0":
-                raise ValueError
-            resp = None
-        results["cmd"] = cmd
-        results["url"] = url
-        results["resp"] = resp
-        for h in headers[1:]:
-            pos = h.find(":")
-            if not pos:
-                break
-            key = h[:pos]
-            val = h[pos + 2 :]
-            results[key] = val
-        return results
-
-    def read_headers(self) -> List[str]:
-        headers = []
-
-        line = self.sock.readline()
-        while not line:
-            line = self.sock.readline()
-
-        while line:
-            headers.append(line.decode("UTF-8"))
-            line = self.sock.readline()
-        self.logger.debug("<< {}".format(headers))
-        return headers
-
-    def read_body(self, headers) -> bytes:
-        length = headers.get("Content-Length", None)
-        if length is None:
-            return b""
-        length = int(length)
-        return self.sock.read(length)
-
     @staticmethod
     def _rtsp_response_header(
         cmd: Optional[str] = None,
@@ -209,42 +189,23 @@ class RtspSink(threading.Thread):
                 continue
         return udp, client_port, server_port
 
-    def rtsp_m1(self) -> bool:
-        headers = self.get_rtsp_headers()
-        if headers["cmd"] != "OPTIONS":
-            return False
-        s_data = self._rtsp_response_header(
-            seq=headers["CSeq"], res="200 OK", others=[("Public", "org.wfa.wfd1.0, SET_PARAMETER, GET_PARAMETER")]
-        )
-        self.logger.debug("<-{}".format(s_data))
-        self.sock.write(s_data.encode("ASCII"))
-        return True
-
-    def rtsp_m2(self) -> bool:
+    def _m2_request(self) -> str:
         self.csnum = 100
-        s_data = self._rtsp_response_header(
+        return self._rtsp_response_header(
             seq=str(self.csnum), cmd="OPTIONS", url="*", others=[("Require", "org.wfa.wfd1.0")]
         )
-        self.logger.debug("<-{}".format(s_data))
-        self.sock.write(s_data.encode("ASCII"))
-        headers = self.get_rtsp_headers()
-        if headers["CSeq"] != "100" or headers["resp"] != "200 OK":
-            return False
-        return True
 
-    def rtsp_m3(self) -> bool:
-        headers = self.get_rtsp_headers()
-        if headers["cmd"] != "GET_PARAMETER" or headers["url"] != "rtsp://localhost/wfd1.0":
-            return False
-        body = self.read_body(headers)
+    def _m3_response(self, headers, body: bytes) -> str:
         msg = ""
-        for req in body.decode("UTF-8").split("\r\n"):
+        for req in str(body, "UTF-8").split("\r\n"):
             if req == "":
                 continue
             elif req == "wfd_client_rtp_ports":
-                msg += "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {} 0 mode=play\r\n".format(self.config.rtp_port)
+                msg += "wfd_client_rtp_ports: RTP/AVP/UDP;unicast {} 0 mode=play\r\n".format(self.rtp_port)
             elif req == "wfd_video_formats":
                 msg += "wfd_video_formats: {}\r\n".format(self.wfd_video_formats)
+            elif req == "microsoft_rtcp_capability" and self.rtcp_enabled:
+                msg += "microsoft_rtcp_capability: supported\r\n"
             elif req in self.wfd_parameters:
                 msg += "{}: {}\r\n".format(req, self.wfd_parameters[req])
             else:
@@ -256,50 +217,20 @@ class RtspSink(threading.Thread):
             others=[("Content-Type", "text/parameters"), ("Content-Length", str(len(msg)))],
         )
         m3resp += msg
-        self.logger.debug("<-{}".format(m3resp))
-        self.sock.write(m3resp.encode("ASCII"))
-        return True
-
-    def rtsp_m4(self) -> bool:
-        headers = self.get_rtsp_headers()
-        if headers["cmd"] != "SET_PARAMETER" or headers["url"] != "rtsp://localhost/wfd1.0":
-            return False
-        self.read_body(headers)
-        # FIXME: parse body here to retrieve video mode and set actual mode.
-        s_data = self._rtsp_response_header(res="200 OK", seq=headers["CSeq"])
-        self.logger.debug("<-{}".format(s_data))
-        self.sock.write(s_data.encode("ASCII"))
-        return True
-
-    def rtsp_m5(self) -> bool:
-        headers = self.get_rtsp_headers()
-        self.read_body(headers)
-        if headers["cmd"] != "SET_PARAMETER":
-            self.logger.debug("M5: got other than SET_PARAMETER request.")
-            s_data = self._rtsp_response_header(res="400 Bad Requests", seq=headers["CSeq"])
-            self.logger.debug("<-{}".format(s_data))
-            self.sock.write(s_data.encode("ASCII"))
-            return False
-        # FIXME: analyze body to have  'wfd_trigger_method: SETUP'
-        s_data = self._rtsp_response_header(res="200 OK", seq=headers["CSeq"])
-        self.logger.debug("<-{}".format(s_data))
-        self.sock.write(s_data.encode("ASCII"))
-        return True
+        return m3resp
 
-    def rtsp_m6(self) -> Tuple[Optional[str], Optional[str]]:
+    def _m6_request(self) -> str:
         self.csnum += 1
-        sessionid = None
-        server_port = None
-        m6req = self._rtsp_response_header(
+        return self._rtsp_response_header(
             cmd="SETUP",
-            url="rtsp://{0:s}/wfd1.0/streamid=0".format(self.config.peeraddress),
+            url=self._stream_url(),
             seq=str(self.csnum),
-            others=[("Transport", "RTP/AVP/UDP;unicast;client_port={0:d}".format(self.config.rtp_port))],
+            others=[("Transport", "RTP/AVP/UDP;unicast;client_port={0:d}".format(self.rtp_port))],
         )
-        self.logger.debug("<-{}".format(m6req))
-        self.sock.write(m6req.encode("ASCII"))
 
-        headers = self.get_rtsp_headers()
+    def _m6_parse_response(self, headers) -> Tuple[Optional[str], Optional[str]]:
+        sessionid = None
+        server_port = None
         if headers["CSeq"] is not None and headers["CSeq"] != str(self.csnum):
             raise ValueError("Unmatch sequence number: {}".format(headers["CSeq"]))
         if "Transport" in headers:
@@ -311,120 +242,527 @@ class RtspSink(threading.Thread):
             sessionid = headers["Session"].split(";")[0]
         return sessionid, server_port
 
-    def rtsp_m7(self, sessionid: str) -> bool:
+    def _rtcp_peer(self, server_port: Optional[str]) -> Optional[Tuple[str, int]]:
+        """RTCP address of the source: the second port of a ``server_port`` range, or the port after its RTP port."""
+        if not server_port:
+            return None
+        ports = server_port.split("-")
+        if not all(p.isdigit() for p in ports) or int(ports[0]) == 0:
+            return None
+        return self.peeraddress, int(ports[1]) if len(ports) > 1 else int(ports[0]) + 1
+
+    def _m7_request(self, sessionid: str) -> str:
         self.csnum += 1
-        m7req = self._rtsp_response_header(
+        return self._rtsp_response_header(
             cmd="PLAY",
-            url="rtsp://{0:s}/wfd1.0/streamid=0".format(self.config.peeraddress),
+            url=self._stream_url(),
             seq=str(self.csnum),
             others=[("Session", sessionid)],
         )
-        self.logger.debug("<-{}".format(m7req))
-        self.sock.write(m7req.encode("ASCII"))
-        headers = self.get_rtsp_headers()
-        if headers["resp"] != "200 OK" or headers["CSeq"] != str(self.csnum):
+
+    def _teardown_request(self) -> List[bytes]:
+        self.csnum += 1
+        return REQUEST_TEARDOWN.render(str(self.csnum))
+
+    @staticmethod
+    def parse_parameters(text: str) -> Dict[str, str]:
+        """Parse a text/parameters body into a dictionary."""
+        params = {}
+        for line in text.splitlines():
+            key, sep, val = line.partition(":")
+            if sep:
+                params[key.strip()] = val.strip()
+        return params
+
+    def _stream_url(self) -> str:
+        return "rtsp://{0:s}/wfd1.0/streamid=0".format(self.peeraddress)
+
+    def reset_session(self) -> None:
+        self.state = SessionState.INIT
+        self.sessionid = None  # type: Optional[str]
+        self.outstanding = {}  # type: Dict[str, str]
+        self.teardown = False
+        self._outbox = []  # type: List[bytes]
+        self._sent_marks = []  # type: List[str]
+        self._keepalive_at = None  # type: Optional[float]
+        self.rtcp_peer = None  # type: Optional[Tuple[str, int]]
+        # playback state reported by players that track it, such as "playing" or "error"
+        self.player_state = None  # type: Optional[str]
+
+    def parts_to_send(self) -> List[bytes]:
+        """Return and clear queued outgoing data as a list of buffers for ``writelines()``."""
+        parts, self._outbox = self._outbox, []
+        for event in self._sent_marks:
+            self.timer.mark(event)
+        self._sent_marks = []
+        if self._keepalive_at is not None:
+            KEEPALIVE_REPLY_SECONDS.observe(time.monotonic() - self._keepalive_at)
+            self._keepalive_at = None
+        if parts and self.logger.isEnabledFor(DEBUG):
+            self.logger.debug("<-{}".format(b"".join(parts).decode("ASCII")))
+        return parts
+
+    def data_to_send(self) -> bytes:
+        return b"".join(self.parts_to_send())
+
+    def _mark_sent(self, *events: str) -> None:
+        """Record `events` when the queued data is handed to the transport."""
+        self._sent_marks.extend(events)
+
+    def finish_timing(self) -> None:
+        """Add the timings of the current negotiation to the statistics and log them once."""
+        if self.timer.origin is None or self.timer.recorded:
+            return
+        self.timer.recorded = True
+        self.stats.record(self.timer)
+        self.logger.info(self.timer.summary())
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        """RTP receive statistics of the playing session, or of the last session after it ended.
+
+        None when the player does not provide them.
+        """
+        if self._rtp_live:
+            return self._player_rtp_stats()
+        return self.last_rtp_stats
+
+    def _player_rtp_stats(self) -> Optional[Dict[str, object]]:
+        stats = getattr(self.player, "rtp_stats", None)
+        return stats() if stats is not None else None
+
+    def finish_rtp_stats(self) -> None:
+        """Keep and log the receive statistics of the session before the player stops."""
+        if not self._rtp_live:
+            return
+        self._rtp_live = False
+        self.last_rtp_stats = self._player_rtp_stats()
+        if self.last_rtp_stats is not None:
+            self.logger.info(stats_summary(self.last_rtp_stats))
+
+    def _reply(self, msg: RtspMessage, template: MessageTemplate = RESPONSE_OK) -> None:
+        self._outbox.extend(template.render(msg.cseq or ""))
+
+    def _request(self, method: str, data: Union[str, List[bytes]]) -> None:
+        self.outstanding[str(self.csnum)] = method
+        if isinstance(data, str):
+            self._outbox.append(data.encode("ASCII"))
+        else:
+            self._outbox.extend(data)
+
+    def dispatch(self, msg: RtspMessage) -> None:
+        """Handle one incoming message according to the transition tables."""
+        if isinstance(msg, RtspResponse):
+            method = self.outstanding.pop(msg.cseq or "", None)
+            if method is None:
+                self.logger.debug("Ignore response without outstanding request: {}".format(msg))
+                return
+            handler = self._RESPONSES.get((self.state, method))
+            if handler is None:
+                self.logger.debug("Ignore {} response in state {}".format(method, self.state.name))
+                return
+        else:
+            assert isinstance(msg, RtspRequest)
+            handler = self._REQUESTS.get((self.state, msg.method))
+            if handler is None:
+                self.logger.debug("{} is not valid in state {}".format(msg.method, self.state.name))
+                self._reply(msg, RESPONSE_NOT_VALID)
+                return
+        previous = self.state
+        handler(self, msg)
+        if self.state != previous:
+            self.logger.debug("State {} -> {}".format(previous.name, self.state.name))
+
+    def _on_options(self, msg: RtspMessage) -> None:
+        self._reply(msg, RESPONSE_OPTIONS)
+        if self.state == SessionState.INIT:
+            self.timer.mark("m1")
+            # M2 goes out right behind the M1 reply; M3 may arrive before its response.
+            self._request("OPTIONS", self._m2_request())
+            self._mark_sent("m1_reply", "m2")
+            self.state = SessionState.CAPABILITY
+
+    def _on_get_parameter(self, msg: RtspMessage) -> None:
+        if msg.body:
+            self.timer.mark("m3")
+            self._outbox.append(self._m3_response(msg.headers, msg.body).encode("ASCII"))
+            self._mark_sent("m3_reply")
+        else:
+            # keep-alive (M16)
+            KEEPALIVES.inc()
+            if self._keepalive_at is None:
+                self._keepalive_at = time.monotonic()
+            self._reply(msg)
+
+    def _on_set_parameter(self, msg: RtspMessage) -> None:
+        params = self.parse_parameters(msg.text)
+        trigger = params.get("wfd_trigger_method")
+        self._reply(msg)
+        if trigger is None:
+            # M4 and later parameter changes.
+            self.timer.mark("m4")
+            self._mark_sent("m4_reply")
+            self.wfd_selected = params
+            self._select_format(params)
+        elif trigger == "SETUP" and self.state == SessionState.CAPABILITY:
+            self.timer.mark("m5")
+            self._request("SETUP", self._m6_request())
+            self._mark_sent("m5_reply", "m6")
+            self.state = SessionState.SETUP
+        elif trigger == "TEARDOWN":
+            self.logger.debug("Got TEARDOWN request.")
+            self._request("TEARDOWN", self._teardown_request())
+            self.teardown = True
+            self.state = SessionState.TEARDOWN
+        elif trigger in ("PLAY", "PAUSE") and self.sessionid is not None:
+            self.csnum += 1
+            self._request(trigger, session_request(trigger, self._stream_url()).render(str(self.csnum), self.sessionid))
+
+    def _select_format(self, params: Dict[str, str]) -> None:
+        if "wfd_video_formats" not in params and "wfd_audio_codecs" not in params:
+            return
+        try:
+            self.selected_format = SelectedFormat.parse(params)
+        except ValueError as e:
+            self.logger.info("Ignore selected format: {}".format(e))
+            return
+        self.logger.debug("Selected format: {}".format(self.selected_format))
+
+    def request_idr(self, reason: str = "") -> bool:
+        """Queue a ``wfd_idr_request`` unless one was sent within `idr_interval`."""
+        if self.state != SessionState.PLAYING or self.sessionid is None:
             return False
+        now = time.monotonic()
+        if self._last_idr is not None and now - self._last_idr < self.idr_interval:
+            IDR_SUPPRESSED.inc()
+            return False
+        self._last_idr = now
+        self.csnum += 1
+        self._request("SET_PARAMETER", REQUEST_IDR.render(str(self.csnum), self.sessionid))
+        IDR_REQUESTS.inc()
+        self.logger.debug("Request IDR: {}".format(reason))
         return True
 
-    def negotiate(self) -> bool:
+    def _on_options_response(self, msg: RtspMessage) -> None:
+        assert isinstance(msg, RtspResponse)
+        self.timer.mark("m2_reply")
+        if msg.status != 200:
+            self.logger.info("M2 rejected: {} {}".format(msg.status, msg.reason))
+            self.state = SessionState.CLOSED
+
+    def _on_setup_response(self, msg: RtspMessage) -> None:
+        assert isinstance(msg, RtspResponse)
+        self.timer.mark("m6_reply")
+        sessionid, server_port = self._m6_parse_response(msg.headers)
+        if msg.status != 200 or sessionid is None:
+            self.state = SessionState.CLOSED
+            return
+        self.sessionid = sessionid
+        self.rtcp_peer = self._rtcp_peer(server_port)
+        self._request("PLAY", self._m7_request(sessionid))
+        self._mark_sent("m7")
+        self.state = SessionState.PLAY
+
+    def _on_play_response(self, msg: RtspMessage) -> None:
+        assert isinstance(msg, RtspResponse)
+        self.timer.mark("m7_reply")
+        self.state = SessionState.PLAYING if msg.status == 200 else SessionState.CLOSED
+
+    def _on_set_parameter_response(self, msg: RtspMessage) -> None:
+        assert isinstance(msg, RtspResponse)
+        if msg.status != 200:
+            self.logger.info("SET_PARAMETER rejected: {} {}".format(msg.status, msg.reason))
+
+    def _on_teardown_response(self, msg: RtspMessage) -> None:
+        self.logger.info("---- Teardown completed ----")
+        self.state = SessionState.CLOSED
+
+    _REQUESTS = {
+        (SessionState.INIT, "OPTIONS"): _on_options,
+        (SessionState.CAPABILITY, "OPTIONS"): _on_options,
+        (SessionState.CAPABILITY, "GET_PARAMETER"): _on_get_parameter,
+        (SessionState.CAPABILITY, "SET_PARAMETER"): _on_set_parameter,
+        (SessionState.SETUP, "GET_PARAMETER"): _on_get_parameter,
+        (SessionState.SETUP, "SET_PARAMETER"): _on_set_parameter,
+        (SessionState.PLAY, "GET_PARAMETER"): _on_get_parameter,
+        (SessionState.PLAY, "SET_PARAMETER"): _on_set_parameter,
+        (SessionState.PLAYING, "OPTIONS"): _on_options,
+        (SessionState.PLAYING, "GET_PARAMETER"): _on_get_parameter,
+        (SessionState.PLAYING, "SET_PARAMETER"): _on_set_parameter,
+        (SessionState.TEARDOWN, "GET_PARAMETER"): _on_get_parameter,
+    }  # type: Dict[Tuple[SessionState, str], Callable[[RtspSinkBase, RtspMessage], None]]
+
+    _RESPONSES = {
+        (SessionState.CAPABILITY, "OPTIONS"): _on_options_response,
+        (SessionState.SETUP, "OPTIONS"): _on_options_response,
+        (SessionState.SETUP, "SETUP"): _on_setup_response,
+        (SessionState.PLAY, "PLAY"): _on_play_response,
+        (SessionState.PLAYING, "SET_PARAMETER"): _on_set_parameter_response,
+        (SessionState.TEARDOWN, "TEARDOWN"): _on_teardown_response,
+    }  # type: Dict[Tuple[SessionState, str], Callable[[RtspSinkBase, RtspMessage], None]]
+
+
+class AsyncRtspSink(RtspSinkBase):
+    """RTSP sink running M1-M7 negotiation and keep-alive handling on an asyncio event loop.
+
+    Every read waits on socket readiness through asyncio streams, so no thread is blocked
+    per session and several sinks can share one loop.
+    """
+
+    def __init__(self, player, logger="picast", **kwargs):
+        super(AsyncRtspSink, self).__init__(player, logger, **kwargs)
+        self.reader = None  # type: Optional[asyncio.StreamReader]
+        self.writer = None  # type: Optional[asyncio.StreamWriter]
+        self.parser = RtspParser()
+        self._messages = collections.deque()  # type: Deque[RtspMessage]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self.connector = Connector(deadline=self.config.connect_timeout, logger=logger)
+        self._session = None  # type: Optional[asyncio.Future]
+        self._restart = False
+
+    async def open_connection(self, host: str, port: int) -> None:
+        self.timer.start()
+        self.reader, self.writer = await self.connector.connect_async(host, port)
+        self.timer.mark("connect")
+        self.parser = RtspParser()
+        self._messages.clear()
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+            self.reader = None
+
+    async def read_message(self, timeout: Optional[float] = None) -> RtspMessage:
+        """Return the next message; `timeout` applies to each wait for more data."""
+        assert self.reader is not None
+        while not self._messages:
+            data = await asyncio.wait_for(self.reader.read(65536), timeout)
+            if not data:
+                raise ConnectionError("Connection closed by peer")
+            self._messages.extend(self.parser.feed(data))
+        msg = self._messages.popleft()
+        self.logger.debug("<< {}".format(msg))
+        return msg
+
+    async def flush(self) -> None:
+        parts = self.parts_to_send()
+        if parts:
+            assert self.writer is not None
+            self.writer.writelines(parts)
+            await self.writer.drain()
+
+    def _send_idr(self, reason: str) -> None:
+        if self.writer is not None and self.request_idr(reason):
+            # a short request written without drain, not to race with the flush of the play loop.
+            self.writer.writelines(self.parts_to_send())
+
+    def on_player_idr_request(self, reason: str) -> None:
+        """Callback for players, called from a streaming thread on loss or decode error."""
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._send_idr, reason)
+        except RuntimeError:
+            # loop already closed: the session is over
+            pass
+
+    def _player_state(self, state: str) -> None:
+        self.player_state = state
+        self.logger.info("Player state: {}".format(state))
+        if state == "error":
+            self._send_idr("player error")
+
+    def on_player_state_change(self, state: str) -> None:
+        """Callback for players reporting their playback state from their own thread."""
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._player_state, state)
+        except RuntimeError:
+            pass
+
+    async def negotiate(self) -> bool:
         self.logger.debug("---- Start negotiation ----")
-        while True:
-            if not self.rtsp_m1():
-                break
-            if not self.rtsp_m2():
-                break
-            if not self.rtsp_m3():
-                break
-            if not self.rtsp_m4():
-                break
-            if not self.rtsp_m5():
-                break
-            sessionid, server_port = self.rtsp_m6()
-            if sessionid is None:
-                break
-            if not self.rtsp_m7(sessionid):
-                break
+        self.reset_session()
+        timeout = self.config.negotiation_timeout
+        try:
+            while self.state not in (SessionState.PLAYING, SessionState.CLOSED):
+                try:
+                    msg = await self.read_message(timeout)
+                except asyncio.TimeoutError:
+                    raise RtspException("No message from the source in {} sec".format(timeout))
+                self.dispatch(msg)
+                await self.flush()
+        except Exception:
+            NEGOTIATIONS_FAILED.inc()
+            raise
+        if self.state == SessionState.PLAYING:
             self.logger.info("---- Negotiation successful ----")
+            NEGOTIATIONS_SUCCEEDED.inc()
             return True
         self.logger.info("---- Negotiation failed ----")
+        NEGOTIATIONS_FAILED.inc()
+        self.finish_timing()
         return False
 
-    def is_keep_alive(self, headers):
-        return headers["cmd"] == "GET_PARAMETER" and headers["url"] == "rtsp://localhost/wfd1.0"
-
-    def is_parameter_change(self, headers):
-        return headers["cmd"] == "SET_PARAMETER"
-
-    def keep_alive(self, headers):
-        self.read_body(headers)
-        resp_msg = self._rtsp_response_header(seq=headers["CSeq"], res="200 OK")
-        self.sock.write(resp_msg.encode("ASCII"))
-        return
-
-    def parameter_change(self, headers):
-        body = self.read_body(headers)
-        lines = body.decode("UTF-8").splitlines()
-        if "wfd_trigger_method: TEARDOWN" in lines:
-            self.logger.debug("Got TEARDOWN request.")
-            self.response_teardown(headers)
-            self.teardown = True
-        return
-
-    def response_teardown(self, headers):
-        resp_msg = self._rtsp_response_header(seq=headers["CSeq"], res="200 OK")
-        self.sock.write(resp_msg.encode("ASCII"))
-        m5_msg = self._rtsp_response_header(seq=str(self.csnum), cmd="TEARDOWN", url="rtsp://localhost/wfd1.0")
-        self.sock.write(m5_msg.encode("ASCII"))
-
-    def is_response(self, headers):
-        return headers["resp"] == "200 OK"
-
-    def play(self) -> None:
-        self.player.start()
-        self.teardown = False
+    async def _open_rtcp(self) -> Optional[RtcpReporter]:
+        """Start receiver reports for a player that does not send them itself."""
+        if not self.rtcp_enabled or getattr(self.player, "sends_rtcp", False):
+            return None
+        reporter = RtcpReporter(
+            self.rtcp_peer,
+            lambda: getattr(self.player, "receive_stats", None),
+            interval=self.config.rtcp_interval,
+            logger=self.logger.name,
+        )
+        try:
+            await reporter.open(self.rtp_port + 1)
+        except OSError as e:
+            self.logger.info("Cannot send RTCP from port {}: {}".format(self.rtp_port + 1, e))
+            return None
+        return reporter
+
+    async def play(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self.player.on_idr_request = self.on_player_idr_request
+        self.player.on_state_change = self.on_player_state_change
+        self.player.rtcp_peer = self.rtcp_peer
+        rtcp = await self._open_rtcp()
+        self.player.start(self.selected_format)
+        self.timer.mark("play")
+        self.finish_timing()
+        self._rtp_live = True
+        SESSIONS_ACTIVE.inc()
         self.watchdog = 0
-        self.sock.settimeout(10)
-
-        while True:
-            try:
-                headers = self.get_rtsp_headers()
-            except socket.timeout as e:
-                sleep(0.1)
-                continue
-            except socket.error as e:
-                err = e.args[0]
-                if err == errno.EAGAIN or err == errno.EWOULDBLOCK or err == errno.EALREADY or err == errno.EINPROGRESS:
-                    sleep(0.1)
-                    continue
-                elif err == errno.ETIMEDOUT:
+        try:
+            while self.state not in (SessionState.TEARDOWN, SessionState.CLOSED):
+                try:
+                    msg = await self.read_message(timeout=10)
+                except asyncio.TimeoutError:
                     self.watchdog += 1
-                    if self.watchdog > self.config.max_timeout:
+                    WATCHDOG_TIMEOUTS.inc()
+                    if self.watchdog > int(self.config.max_timeout):
                         break
-                else:
-                    self.logger.debug("Got unexpected socket error {}".format(e.args[0]))
+                    continue
+                except ConnectionError as e:
+                    self.logger.debug("Connection closed: {}".format(e))
                     break
-            else:
                 self.watchdog = 0
-                if self.is_keep_alive(headers):
-                    self.keep_alive(headers)
-                elif self.is_parameter_change(headers):
-                    self.parameter_change(headers)
-                    if self.teardown:
-                        self.player.stop()
-                elif self.is_response(headers):
-                    if self.teardown:
-                        self.logger.info("---- Teardown completed ----")
-                        break
-                else:
-                    # ignore all other commands now...
-                    continue
+                self.dispatch(msg)
+                await self.flush()
+        finally:
+            SESSIONS_ACTIVE.dec()
+            self.finish_rtp_stats()
+            if rtcp is not None:
+                rtcp.close()
+            self.player.stop()
+            self.player.on_idr_request = None
+            self.player.on_state_change = None
+        try:
+            # wait briefly for the response to our TEARDOWN request
+            while self.state == SessionState.TEARDOWN:
+                self.dispatch(await self.read_message(timeout=1))
+                await self.flush()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+    async def run_session(self) -> bool:
+        """Connect, negotiate and play one session until teardown or disconnection."""
+        try:
+            await self.open_connection(self.peeraddress, self.rtsp_port)
+            if await self.negotiate():
+                await self.play()
+                return True
+        except (OSError, RtspException, ValueError, asyncio.TimeoutError) as e:
+            self.logger.info("---- Session aborted: {} ----".format(e))
+        finally:
+            self.finish_timing()
+            await self.close()
+        return False
+
+    def set_peer(self, address: str) -> None:
+        """Use the source at `address`; a connect in progress to another address starts over."""
+        if address == self.peeraddress:
+            return
+        self.logger.info("Source address is {}".format(address))
+        self.peeraddress = address
+        if self.writer is None and self._session is not None and not self._session.done():
+            self._restart = True
+            self._session.cancel()
+
+    async def run(self) -> None:
+        while True:
+            self._session = asyncio.ensure_future(self.run_session())
+            try:
+                await self._session
+            except asyncio.CancelledError:
+                if not self._restart:
+                    raise
+                self._restart = False
+                continue
+            await asyncio.sleep(1)
+
+
+class RtspSink(RtspSinkBase, threading.Thread):
+    """Threaded front-end of the sink.
+
+    ``run()`` drives an :class:`AsyncRtspSink` on an event loop owned by this thread;
+    the other methods hand requests from other threads over to that loop.
+    """
+
+    def __init__(self, player, logger="picast"):
+        threading.Thread.__init__(self, name="rtsp-server-0", daemon=True)
+        RtspSinkBase.__init__(self, player, logger)
+        self._logger_name = logger
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._task = None  # type: Optional[asyncio.Task]
+        self.engine = None  # type: Optional[AsyncRtspSink]
 
     def run(self):
         sd = ServiceDiscovery()
         sd.register()
-        while True:
-            self.sock = RTSPTransport(self.config.peeraddress, self.config.rtsp_port)
-            if self.negotiate():
-                self.play()
-            self.sock.close()
-            sleep(1)
+        asyncio.run(self._serve())
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._task = asyncio.current_task()
+        self.engine = AsyncRtspSink(self.player, logger=self._logger_name, peeraddress=self.peeraddress, video=self.video)
+        try:
+            await self.engine.run()
+        except asyncio.CancelledError:
+            self.logger.info("RTSP sink stopped.")
+        finally:
+            self.engine.connector.close()
+
+    def rtp_stats(self) -> Optional[Dict[str, object]]:
+        if self.engine is not None:
+            return self.engine.rtp_stats()
+        return super(RtspSink, self).rtp_stats()
+
+    def _set_peer(self, address: str) -> None:
+        if self.engine is not None:
+            self.engine.set_peer(address)
+
+    def on_lease(self, lease: Lease) -> None:
+        """Connect to the source at the address just leased to it; callable from any thread."""
+        self.peeraddress = lease.address
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._set_peer, lease.address)
+        except RuntimeError:
+            pass
+
+    def stop(self) -> None:
+        """Stop the sink from another thread, including a connect in progress."""
+        if self._loop is None or self._task is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        except RuntimeError:
+            # loop already closed: the sink has stopped
+            pass
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import threading
+from logging import getLogger
+from typing import Callable, Dict, List, Optional
+
+from .dhcpd import Lease
+from .players import create_player
+from .rtspsink import AsyncRtspSink
+from .settings import Settings
+from .video import RasberryPiVideo
+
+
+class RtpPortPool:
+    """Pool of RTP receive ports; each session holds its own port while it is alive.
+
+    Ports are handed out with a `step` of 2 to leave the odd port free for RTCP.
+    """
+
+    def __init__(self, base: int, count: int, step: int = 2):
+        self.base = base
+        self.count = count
+        self.step = step
+        self._free = [base + i * step for i in range(count)]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._free)
+
+    def acquire(self) -> int:
+        with self._lock:
+            if not self._free:
+                raise RuntimeError("No free RTP port in pool")
+            return self._free.pop(0)
+
+    def release(self, port: int) -> None:
+        with self._lock:
+            if port in self._free or not self.base <= port < self.base + self.count * self.step:
+                return
+            self._free.append(port)
+            self._free.sort()
+
+
+class SessionManager(threading.Thread):
+    """Run several sink sessions concurrently on one event loop.
+
+    Every peer gets its own :class:`AsyncRtspSink`, player instance and RTP port from
+    a :class:`RtpPortPool`. A session that ends or fails releases its port without
+    affecting other sessions; the player stays with the port for the next session
+    and is closed when the manager stops.
+
+    All sessions share one asyncio loop in this single thread, so RTSP handling and
+    player control of every session run on one CPU core. Only media decoding, done
+    by player processes or GStreamer streaming threads, runs on other cores.
+    """
+
+    def __init__(self, logger="picast", player_factory: Optional[Callable] = None, max_sessions: Optional[int] = None):
+        threading.Thread.__init__(self, name="rtsp-sessions", daemon=True)
+        self.config = Settings()
+        self.logger = getLogger(logger)
+        self._logger_name = logger
+        self.max_sessions = max_sessions if max_sessions is not None else self.config.max_sessions
+        self.ports = RtpPortPool(self.config.rtp_port, self.max_sessions)
+        if player_factory is None:
+            player_factory = self._create_player
+        self.player_factory = player_factory
+        self.sessions = {}  # type: Dict[str, asyncio.Task]
+        self.sinks = {}  # type: Dict[str, AsyncRtspSink]
+        # players are kept per RTP port, so a warm player is reused by the next session on the port.
+        self.players = {}  # type: Dict[int, object]
+        self.video = None  # type: Optional[RasberryPiVideo]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._stopped = None  # type: Optional[asyncio.Event]
+        # addresses leased before the loop runs
+        self._leased = []  # type: List[str]
+        self._lease_lock = threading.Lock()
+
+    def _create_player(self, rtp_port: int):
+        return create_player(self.config.player, logger=self._logger_name, rtp_port=rtp_port)
+
+    async def add_peer(self, address: str, rtsp_port: Optional[int] = None, persistent: bool = False) -> bool:
+        """Start a session with the source at `address`; return False when no slot is available.
+
+        A `persistent` session reconnects after teardown until it is removed.
+        """
+        if address in self.sessions:
+            return True
+        if len(self.sessions) >= self.max_sessions:
+            self.logger.info("Reject session with {}: {} session(s) running".format(address, len(self.sessions)))
+            return False
+        if self.video is None:
+            self.video = RasberryPiVideo()
+        rtp_port = self.ports.acquire()
+        try:
+            if rtp_port not in self.players:
+                self.players[rtp_port] = self.player_factory(rtp_port)
+            sink = AsyncRtspSink(
+                self.players[rtp_port],
+                logger=self._logger_name,
+                peeraddress=address,
+                rtsp_port=rtsp_port,
+                rtp_port=rtp_port,
+                video=self.video,
+            )
+        except Exception:
+            self.ports.release(rtp_port)
+            raise
+        self.sinks[address] = sink
+        self.sessions[address] = asyncio.ensure_future(self._run_sink(address, sink, persistent))
+        self.logger.info("Session with {} uses RTP port {}".format(address, rtp_port))
+        return True
+
+    async def _run_sink(self, address: str, sink: AsyncRtspSink, persistent: bool) -> None:
+        try:
+            while True:
+                await sink.run_session()
+                if not persistent:
+                    break
+                await asyncio.sleep(1)
+        except Exception as e:
+            self.logger.error("Session with {} failed: {}".format(address, e))
+        finally:
+            self.ports.release(sink.rtp_port)
+            self.sinks.pop(address, None)
+            self.sessions.pop(address, None)
+            sink.connector.close()
+
+    async def remove_peer(self, address: str) -> None:
+        task = self.sessions.get(address)
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def wait_sessions(self) -> None:
+        """Wait until all running sessions end."""
+        while self.sessions:
+            await asyncio.wait(list(self.sessions.values()))
+
+    async def serve(self, peers: Optional[List[str]] = None) -> None:
+        self._stopped = asyncio.Event()
+        with self._lease_lock:
+            self._loop = asyncio.get_event_loop()
+            leased, self._leased = self._leased, []
+        if peers is None:
+            peers = self.config.session_peers
+        for peer in peers:
+            await self.add_peer(peer, persistent=True)
+        for address in leased:
+            await self.add_peer(address)
+        try:
+            await self._stopped.wait()
+        finally:
+            for address in list(self.sessions):
+                await self.remove_peer(address)
+            self._close_players()
+
+    def _close_players(self) -> None:
+        """Free what the players kept across sessions hold, such as a warm pipeline or a libvlc instance."""
+        players, self.players = self.players, {}
+        for player in players.values():
+            close = getattr(player, "close", None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception:
+                self.logger.exception("Error in closing a player")
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def add_peer_threadsafe(self, address: str, rtsp_port: Optional[int] = None, persistent: bool = False):
+        """Schedule :meth:`add_peer` from another thread; return a concurrent future."""
+        assert self._loop is not None
+        return asyncio.run_coroutine_threadsafe(self.add_peer(address, rtsp_port, persistent), self._loop)
+
+    def on_lease(self, lease: Lease) -> None:
+        """Start a session with a source as soon as it is leased an address; callable from any thread."""
+        with self._lease_lock:
+            if self._loop is None:
+                self._leased.append(lease.address)
+                return
+        self.add_peer_threadsafe(lease.address)
+
+    def stop(self) -> None:
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
@@ -123,6 +123,26 @@ class Settings(object):
     def device_name(self):
         return self._config.get("p2p", "device_name")
 
+    @property
+    def ctrl_interface(self):
+        return self._config.get("p2p", "ctrl_interface")
+
+    @property
+    def dhcp_server(self):
+        return self._config.get("dhcp", "server")
+
+    @property
+    def dhcp_pool_size(self):
+        return self._config.getint("dhcp", "pool_size")
+
+    @property
+    def dhcp_lease_time(self):
+        return self._config.getint("dhcp", "lease_time")
+
+    @property
+    def dhcp_lease_file(self):
+        return self._config.get("dhcp", "lease_file")
+
     @property
     def rtsp_port(self):
         return self._config.getint("network", "rtsp_port")
@@ -131,6 +151,92 @@ class Settings(object):
     def gst_decoder(self):
         return self._config.get("gst", "decoder")
 
+    @property
+    def gst_decoder_cache(self):
+        return self._config.get("gst", "decoder_cache")
+
+    @property
+    def gst_video_sink(self):
+        return self._config.get("gst", "video_sink")
+
+    @property
+    def gst_audio_sink(self):
+        return self._config.get("gst", "audio_sink")
+
+    @property
+    def gst_keep_warm(self):
+        return self._config.getboolean("gst", "keep_warm")
+
+    @property
+    def gst_release_after(self):
+        return self._config.getfloat("gst", "release_after")
+
+    @property
+    def connect_timeout(self):
+        return self._config.getfloat("network", "connect_timeout")
+
+    @property
+    def negotiation_timeout(self):
+        return self._config.getfloat("network", "negotiation_timeout")
+
     @property
     def max_timeout(self):
         return self._config.get("network", "max_timeout")
+
+    @property
+    def idr_interval(self):
+        return self._config.getfloat("player", "idr_interval")
+
+    @property
+    def rtp_monitor(self):
+        return self._config.getboolean("player", "rtp_monitor")
+
+    @property
+    def record_directory(self):
+        return self._config.get("record", "directory")
+
+    @property
+    def record_file_size(self):
+        return self._config.getint("record", "file_size") * 1024 * 1024
+
+    @property
+    def record_files(self):
+        return self._config.getint("record", "files")
+
+    @property
+    def record_buffer_size(self):
+        return self._config.getint("record", "buffer_size") * 1024
+
+    @property
+    def record_buffers(self):
+        return self._config.getint("record", "buffers")
+
+    @property
+    def rtcp_enabled(self):
+        return self._config.getboolean("rtcp", "enable")
+
+    @property
+    def rtcp_interval(self):
+        return self._config.getfloat("rtcp", "interval")
+
+    @property
+    def latency_profile(self):
+        return self._config.get("latency", "profile")
+
+    def get_latency_range(self, profile):
+        """Return (minimum, maximum) jitter buffer latency in milliseconds of `profile`."""
+        minimum, maximum = self._config.get("latency", profile).split(",")
+        return int(minimum), int(maximum)
+
+    @property
+    def metrics_listen(self):
+        return self._config.get("metrics", "listen")
+
+    @property
+    def max_sessions(self):
+        return self._config.getint("session", "max_sessions")
+
+    @property
+    def session_peers(self):
+        peers = [p.strip() for p in self._config.get("session", "peers").split(",") if p.strip()]
+        return peers if peers else [self.peeraddress]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# upper bounds in seconds; the last bucket takes everything above.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# Negotiation events in protocol order. For a message received from the source the
+# name is the message itself ("m1"), for a message sent by the sink it is the
+# reply or request we send ("m1_reply", "m2"), so the gap before a sink event is our
+# handling time and the gap before a source event is the source think time.
+EVENTS = (
+    "connect",
+    "m1",
+    "m1_reply",
+    "m2",
+    "m2_reply",
+    "m3",
+    "m3_reply",
+    "m4",
+    "m4_reply",
+    "m5",
+    "m5_reply",
+    "m6",
+    "m6_reply",
+    "m7",
+    "m7_reply",
+    "play",
+)
+
+
+class Histogram:
+    """Histogram with fixed bucket bounds, compatible with Prometheus cumulative buckets."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self._lock = threading.Lock()
+        self.bounds = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Return (upper bound, number of observations less or equal) pairs."""
+        with self._lock:
+            counts = list(self.counts)
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds, counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket that contains it."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return self.bounds[-1]
+
+
+class NegotiationTimer:
+    """Monotonic timestamps of the events of one negotiation.
+
+    Times are relative to :meth:`start`, which is called when the sink begins to connect.
+    Only the first occurrence of an event is kept, so keep-alive messages later in a
+    session do not overwrite the negotiation timestamps.
+    """
+
+    def __init__(self):
+        self.origin = None  # type: Optional[float]
+        self.marks = {}  # type: Dict[str, float]
+        self.recorded = False
+
+    def start(self) -> None:
+        self.origin = time.monotonic()
+        self.marks = {}
+        self.recorded = False
+
+    def mark(self, event: str) -> None:
+        if self.origin is not None and event not in self.marks:
+            self.marks[event] = time.monotonic() - self.origin
+
+    def steps(self) -> List[Tuple[str, float]]:
+        """Return (event, seconds since the previous event) in protocol order."""
+        result = []
+        previous = 0.0
+        for event in EVENTS:
+            if event in self.marks:
+                result.append((event, self.marks[event] - previous))
+                previous = self.marks[event]
+        return result
+
+    @property
+    def time_to_play(self) -> Optional[float]:
+        return self.marks.get("play")
+
+    def summary(self) -> str:
+        steps = " ".join("{}=+{:.0f}ms".format(event, delta * 1000) for event, delta in self.steps())
+        total = self.time_to_play
+        if total is None:
+            return "Negotiation timing: {} (not played)".format(steps)
+        return "Negotiation timing: {} total={:.0f}ms".format(steps, total * 1000)
+
+
+class NegotiationStats:
+    """Histograms of negotiation timings across sessions.
+
+    Each event has a histogram of the time since the previous event; `time_to_play` is
+    the time from the start of connecting until the player started.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.steps = {event: Histogram() for event in EVENTS}  # type: Dict[str, Histogram]
+        self.time_to_play = Histogram()
+        self.sessions = 0
+        self.last = None  # type: Optional[Dict[str, float]]
+
+    def record(self, timer: NegotiationTimer) -> None:
+        with self._lock:
+            for event, delta in timer.steps():
+                self.steps[event].observe(delta)
+            if timer.time_to_play is not None:
+                self.time_to_play.observe(timer.time_to_play)
+            self.sessions += 1
+            self.last = dict(timer.marks)
+
+    def snapshot(self) -> Dict[str, object]:
+        """Return the current values as plain data for export."""
+        with self._lock:
+            return {
+                "sessions": self.sessions,
+                "last": dict(self.last) if self.last is not None else None,
+                "time_to_play": _histogram_data(self.time_to_play),
+                "steps": {event: _histogram_data(h) for event, h in self.steps.items()},
+            }
+
+
+def _histogram_data(h: Histogram) -> Dict[str, object]:
+    return {"count": h.count, "sum": h.sum, "buckets": h.cumulative()}
+
+
+_stats = NegotiationStats()
+
+
+def negotiation_stats() -> NegotiationStats:
+    """Return the process wide negotiation statistics shared by all sinks."""
+    return _stats
@@ -22,35 +22,88 @@ import os
 import threading
 from logging import getLogger
 from time import sleep
+from typing import Callable, List, Optional, Union
 
-from .dhcpd import Dhcpd
+from .dhcpd import Dhcpd, DhcpServer, Lease
 from .exceptions import WpaException
+from .p2pconfig import P2PConfig
 from .settings import Settings
 from .wpacli import WpaCli
+from .wpactrl import WpaEvent, WpaMonitor
+from .wpastate import WpaState
 
 
 class WifiP2PServer(threading.Thread):
+    """Set up a P2P group of wpa_supplicant and accept sources into it.
+
+    Setup steps wait for the wpa_supplicant events that complete them, such as
+    ``P2P-GROUP-STARTED``, instead of fixed sleeps. Callbacks on :attr:`events` see the
+    stations joining and leaving the group. Interfaces and networks are looked up in
+    :attr:`state`. Without access to the events, fixed sleeps are used as before.
+    Callbacks of :meth:`subscribe_leases` see the addresses leased to sources.
+    """
+
+    # seconds to wait for the group to start
+    group_timeout = 10.0
+
     def __init__(self, R2=False, logger="picast"):
         super(WifiP2PServer, self).__init__(name="wifi-p2p-0", daemon=False)
         self.config = Settings()
         self.logger = getLogger(logger)
+        # one client keeps its control socket connections for all commands
+        self.wpacli = WpaCli(logger=logger)
+        self.events = WpaMonitor(ctrl_dir=self.wpacli.ctrl_dir, logger=logger)
+        self.events.subscribe(self.on_station_event, "AP-STA-CONNECTED", "AP-STA-DISCONNECTED", "WPS-")
+        self.events_ready = self._attach_events()
+        # interfaces and networks, read once and kept up to date by the events
+        self.state = WpaState(self.wpacli, self.events, logger=logger)
+        self.dhcpd = None  # type: Optional[Union[Dhcpd, DhcpServer]]
+        self.lease_callbacks = []  # type: List[Callable[[Lease], None]]
         self.set_p2p_interface(R2)
 
+    def _attach_events(self) -> bool:
+        try:
+            self.events.attach(self.wpacli.default_interface())
+        except (OSError, WpaException) as e:
+            self.logger.info("Cannot receive wpa_supplicant events, use fixed waits: {}".format(e))
+            return False
+        self.events.start()
+        return True
+
     def run(self):
         self.start_dhcpd()
         self.start_wps()
-        sleep(3)
+        if not self.events_ready:
+            sleep(3)
+
+    def on_station_event(self, event: WpaEvent) -> None:
+        self.logger.info("{} {}".format(event.name, " ".join(event.args)))
 
     def start_wps(self):
-        wpacli = WpaCli()
+        wpacli = self.wpacli
         if self.config.wps_mode == "pbc":
             wpacli.start_wps_pbc(self.wlandev)
         else:
             wpacli.set_wps_pin(self.wlandev, self.config.pin, self.config.timeout)
 
+    def subscribe_leases(self, callback: Callable[[Lease], None]) -> None:
+        """Call `callback` with each address leased by the builtin DHCP server."""
+        self.lease_callbacks.append(callback)
+
     def start_dhcpd(self):
+        if self.config.dhcp_server == "builtin":
+            server = DhcpServer(self.wlandev, logger=self.logger.name)
+            for callback in self.lease_callbacks:
+                server.subscribe(callback)
+            try:
+                server.start()
+                self.dhcpd = server
+                return
+            except OSError as e:
+                self.logger.info("Cannot run DHCP server in picast, run udhcpd instead: {}".format(e))
         dhcpd = Dhcpd(self.wlandev)
         dhcpd.start()
+        self.dhcpd = dhcpd
 
     def wfd_devinfo(self):
         type = 0b01  # PRIMARY_SINK
@@ -80,34 +133,60 @@ class WifiP2PServer(threading.Thread):
         r2_sink = 0b01
         return "0002{0:04X}".format(r2_sink)
 
-    def create_p2p_interface(self, R2):
-        wpacli = WpaCli()
-        wpacli.set_device_name(self.config.device_name)
-        wpacli.set_device_type(self.config.device_type)
-        wpacli.set_p2p_go_ht40()
-        wpacli.set_p2p_ssid_postfix(self.config.device_name)
-        wpacli.wfd_subelem_set(0, self.wfd_devinfo())
-        wpacli.wfd_subelem_set(1, self.wfd_bssid(0))
-        wpacli.wfd_subelem_set(6, self.wfd_sink_info(0, 0))
-        wpacli.wfd_subelem_set(7, self.wfd_ext_cap(uibc=False, i2c=False))
+    def p2p_config(self, R2) -> P2PConfig:
+        values = {
+            "device_name": self.config.device_name,
+            "device_type": self.config.device_type,
+            "p2p_go_ht40": "1",
+            "p2p_ssid_postfix": "_{}".format(self.config.device_name),
+        }
+        subelements = {
+            0: self.wfd_devinfo(),
+            1: self.wfd_bssid(0),
+            6: self.wfd_sink_info(0, 0),
+            7: self.wfd_ext_cap(uibc=False, i2c=False),
+        }
         if R2:
-            wpacli.wfd_subelem_set(11, self.wfd_devinfo2())
+            subelements[11] = self.wfd_devinfo2()
+        return P2PConfig(values, subelements, logger=self.logger.name)
+
+    def configure(self, R2) -> None:
+        """Bring the P2P and WFD parameters of wpa_supplicant to the settings, sending only changes."""
+        changed = self.p2p_config(R2).apply(self.wpacli)
+        if changed:
+            self.logger.info("Updated {} wpa_supplicant parameter(s).".format(len(changed)))
+
+    def create_p2p_interface(self, R2):
+        wpacli = self.wpacli
         network_id = None
         if not self.config.recreate_group:
-            network_id = wpacli.get_persistent_group_network_id(self.config.device_name)
+            network_id = self.state.persistent_group_network_id(self.config.device_name)
         wpacli.p2p_group_add(network_id)
 
     def set_p2p_interface(self, R2):
-        wpacli = WpaCli()
-        if wpacli.check_p2p_interface():
+        # also for an existing group, so a changed setting takes effect on restart
+        self.configure(R2)
+        p2p_interface = self.state.p2p_interface()
+        if p2p_interface is not None:
             self.logger.info("Already set a p2p interface.")
-            p2p_interface = wpacli.get_p2p_interface()
         else:
+            started = self.events.expect("P2P-GROUP-STARTED") if self.events_ready else None
             self.create_p2p_interface(R2)
-            sleep(3)
-            p2p_interface = wpacli.get_p2p_interface()
+            p2p_interface = None
+            if started is not None:
+                event = started.wait(self.group_timeout)
+                if event is None:
+                    self.events.discard(started)
+                elif event.args:
+                    p2p_interface = event.args[0]
+            else:
+                sleep(3)
+            if p2p_interface is None:
+                # no event told the group, so look again
+                self.state.invalidate()
+                p2p_interface = self.state.p2p_interface()
             if p2p_interface is None:
-                interfaces = wpacli.get_interfaces()
+                interfaces = self.state.interfaces()
                 message = "Can not create P2P Wifi interface.\n\nCurrent interfaces are:\n"
                 for it in interfaces:
                     message += "{} ".format(it)
@@ -116,3 +195,9 @@ class WifiP2PServer(threading.Thread):
             self.logger.info("Start p2p interface: {} address {}".format(p2p_interface, self.config.myaddress))
             os.system("sudo ifconfig {} {}".format(p2p_interface, self.config.myaddress))
         self.wlandev = p2p_interface
+        if self.events_ready:
+            # stations join the group interface, and its events come on its own socket
+            try:
+                self.events.attach(p2p_interface)
+            except (OSError, WpaException) as e:
+                self.logger.info("Cannot receive events of {}: {}".format(p2p_interface, e))
@@ -18,125 +18,49 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import re
 import subprocess
-from logging import getLogger
-from typing import List, Optional, Tuple
+import time
+from typing import List, Optional
 
-from .exceptions import WpaException
+from .metrics import WPA_CLI_SECONDS
+from .wpactrl import WpaCtrl
 
 
-class WpaCli:
-    """
-    Wraps the wpa_cli command line interface.
+class WpaCli(WpaCtrl):
     """
+    Compatibility name of :class:`picast.wpactrl.WpaCtrl`.
 
-    def __init__(self, logger="picast"):
-        self.logger = getLogger(logger)
-        pass
+    Commands go to the wpa_supplicant control sockets. When picast is not allowed
+    to open them, the wpa_cli command is run with sudo as before.
+    """
 
-    def cmd(self, *argv):
+    def __init__(self, logger="picast", ctrl_dir=None):
+        super().__init__(logger=logger, ctrl_dir=ctrl_dir)
+        self.use_command = False
+
+    def cmd(self, *argv) -> List[str]:
+        if not self.use_command:
+            try:
+                return super().cmd(*argv)
+            except PermissionError as e:
+                self.logger.info("Cannot use wpa_supplicant control socket, run wpa_cli instead: {}".format(e))
+                self.use_command = True
+        return self._run_wpa_cli(*argv)
+
+    def request_many(self, commands: List[str], interface: Optional[str] = None, window: int = 8) -> List[str]:
+        if not self.use_command:
+            try:
+                return super().request_many(commands, interface, window)
+            except PermissionError as e:
+                self.logger.info("Cannot use wpa_supplicant control socket, run wpa_cli instead: {}".format(e))
+                self.use_command = True
+        prefix = ["-i", interface] if interface is not None else []
+        # commands are "NAME key value" as SET, where the value may contain spaces and stays one argument
+        return ["\n".join(self._run_wpa_cli(*(prefix + command.split(" ", 2)))) + "\n" for command in commands]
+
+    def _run_wpa_cli(self, *argv) -> List[str]:
+        start = time.monotonic()
         p = subprocess.Popen(["sudo", "wpa_cli"] + list(argv), stdout=subprocess.PIPE)
         stdout = p.communicate()[0]
+        WPA_CLI_SECONDS.observe(time.monotonic() - start)
         return stdout.decode("UTF-8").splitlines()
-
-    def start_p2p_find(self):
-        self.logger.debug("wpa_cli p2p_find type=progressive")
-        status = self.cmd("p2p_find", "type=progressive")
-        if "OK" not in status:
-            raise WpaException("Fail to start p2p find.")
-
-    def stop_p2p_find(self):
-        self.logger.debug("wpa_cli p2p_stop_find")
-        status = self.cmd("p2p_stop_find")
-        if "OK" not in status:
-            raise WpaException("Fail to stop p2p find.")
-
-    def set_device_name(self, name: str):
-        self.logger.debug("wpa_cli set device_name {}".format(name))
-        status = self.cmd("set", "device_name", name)
-        if "OK" not in status:
-            raise WpaException("Fail to set device name {}".format(name))
-
-    def set_device_type(self, type):
-        self.logger.debug("wpa_cli set device_type {}".format(type))
-        status = self.cmd("set", "device_type", type)
-        if "OK" not in status:
-            raise WpaException("Fail to set device type {}".format(type))
-
-    def set_p2p_go_ht40(self):
-        self.logger.debug("wpa_cli set p2p_go_ht40 1")
-        status = self.cmd("set", "p2p_go_ht40", "1")
-        if "OK" not in status:
-            raise WpaException("Fail to set p2p_go_ht40")
-
-    def set_p2p_ssid_postfix(self, postfix: str):
-        self.logger.debug("wpa_cli set p2p_ssid_postfix _{}".format(postfix))
-        status = self.cmd("set", "p2p_ssid_postfix", "_{}".format(postfix))
-        if "OK" not in status:
-            raise WpaException("Fail to set p2p_ssid_postfix")
-
-    def wfd_subelem_set(self, key: int, val: str):
-        self.logger.debug("wpa_cli wfd_subelem_set {0:d} {1:s}".format(key, val))
-        status = self.cmd("wfd_subelem_set", "{0:d}".format(key), val)
-        if "OK" not in status:
-            raise WpaException("Fail to wfd_subelem_set.")
-
-    def p2p_group_add(self, network_id: str):
-        group_option = "persistent"
-        if network_id is not None:
-            group_option = "persistent={}".format(network_id)
-        self.logger.debug("wpa_cli p2p_group_add {}".format(group_option))
-        self.cmd("p2p_group_add", group_option)
-
-    def set_wps_pin(self, interface: str, pin: str, timeout: int):
-        self.logger.debug("wpa_cli -i {0:s} wps_pin any {1:s} {2:d}".format(interface, pin, timeout))
-        status = self.cmd("-i", interface, "wps_pin", "any", "{0:s}".format(pin), "{0:d}".format(timeout))
-        return status
-
-    def start_wps_pbc(self, interface: str):
-        self.logger.debug("wpa_cli -i {0:s} wps_pbc".format(interface))
-        status = self.cmd("-i", interface, "wps_pbc")
-        return status
-
-    def p2p_connect(self, interface: str, pin: str, peer: str):
-        self.logger.debug("wpa_cli -i {0:s} p2p_connect {1:s} {2:s}".format(interface, peer, pin))
-        status = self.cmd("-i", interface, "p2p_connect", "{0:s}".format(peer), "{0:s}".format(pin))
-        return status
-
-    def get_interfaces(self) -> Tuple[Optional[str], List[str]]:
-        selected = None
-        interfaces = []
-        status = self.cmd("interface")
-        for ln in status:
-            if ln.startswith("Selected interface"):
-                m = re.match(r"Selected interface\s\'(.+)\'$", ln)
-                if m is not None:
-                    selected = m.group(1)
-            elif ln.startswith("Available interfaces:"):
-                pass
-            else:
-                interfaces.append(str(ln))
-        return selected, interfaces
-
-    def get_p2p_interface(self) -> Optional[str]:
-        sel, interfaces = self.get_interfaces()
-        for it in interfaces:
-            if it.startswith("p2p-") and not it.startswith("p2p-dev"):
-                return it
-        return None
-
-    def check_p2p_interface(self) -> bool:
-        if self.get_p2p_interface() is not None:
-            return True
-        return False
-
-    def get_persistent_group_network_id(self, postfix: str) -> Optional[str]:
-        network_id = None
-        networks = self.cmd("list_networks")
-        for n in networks:
-            m = re.match(r"^([0-9]+)\s*?([^\s]+).*$", n)
-            if m is not None:
-                if m.group(2).endswith("_{}".format(postfix)):
-                    network_id = m.group(1)
-        return network_id
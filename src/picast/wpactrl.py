@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import os
+import re
+import select
+import shlex
+import socket
+import tempfile
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .exceptions import WpaException
+from .metrics import WPA_CLI_SECONDS
+from .settings import Settings
+
+# replies of wpa_supplicant fit in this size; larger ones are truncated by wpa_supplicant itself.
+REPLY_SIZE = 8192
+
+_counter = itertools.count()
+
+
+def _open(ctrl_dir: str, interface: str) -> Tuple[socket.socket, str]:
+    """Socket connected to the control interface of `interface`, and its local path to unlink on close."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # wpa_supplicant replies to the address of the sender, so the client needs one.
+    local = os.path.join(tempfile.gettempdir(), "picast_wpa_{}-{}".format(os.getpid(), next(_counter)))
+    try:
+        sock.bind(local)
+        sock.connect(os.path.join(ctrl_dir, interface))
+    except OSError:
+        sock.close()
+        _unlink(local)
+        raise
+    return sock, local
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class WpaCtrl:
+    """Client of the wpa_supplicant control interface.
+
+    Requests go to the Unix datagram socket of an interface in `ctrl_dir`, as wpa_cli
+    sends them, but over one connection per interface kept open for the life of the
+    client, so a command costs a socket round trip instead of a process start.
+    Arguments of :meth:`cmd` are those of the wpa_cli command line.
+    """
+
+    def __init__(self, logger="picast", ctrl_dir: Optional[str] = None, timeout: float = 10.0):
+        self.ctrl_dir = ctrl_dir if ctrl_dir is not None else Settings().ctrl_interface
+        self.logger = getLogger(logger)
+        self.timeout = timeout
+        self._connections = {}  # type: Dict[str, Tuple[socket.socket, str, threading.Lock]]
+        self._lock = threading.Lock()
+
+    def interfaces(self) -> List[str]:
+        """Interfaces with a control socket, sorted by name."""
+        try:
+            return sorted(name for name in os.listdir(self.ctrl_dir) if not name.startswith("."))
+        except FileNotFoundError:
+            return []
+
+    def default_interface(self) -> str:
+        """Interface for commands without one: the P2P device if there is one, as P2P commands go there."""
+        interfaces = self.interfaces()
+        if not interfaces:
+            raise WpaException("No wpa_supplicant control socket in {}".format(self.ctrl_dir))
+        for name in interfaces:
+            if name.startswith("p2p-dev-"):
+                return name
+        return interfaces[0]
+
+    def _connection(self, interface: str) -> Tuple[socket.socket, str, threading.Lock]:
+        with self._lock:
+            conn = self._connections.get(interface)
+            if conn is None:
+                sock, local = _open(self.ctrl_dir, interface)
+                conn = (sock, local, threading.Lock())
+                self._connections[interface] = conn
+            return conn
+
+    def request(self, command: str, interface: Optional[str] = None) -> str:
+        """Send `command` and return the reply."""
+        return self.request_many([command], interface)[0]
+
+    def _drop(self, interface: str, conn: Tuple[socket.socket, str, threading.Lock]) -> None:
+        with self._lock:
+            if self._connections.get(interface) is conn:
+                del self._connections[interface]
+        sock, local, _ = conn
+        sock.close()
+        _unlink(local)
+
+    def request_many(self, commands: List[str], interface: Optional[str] = None, window: int = 8) -> List[str]:
+        """Send `commands` pipelined and return their replies in order.
+
+        wpa_supplicant answers commands of a socket one by one, so replies come in
+        order. At most `window` commands wait for a reply at a time, since it drops
+        replies that do not fit in the receive queue of the client. When the socket
+        fails, as after a restart of wpa_supplicant, it is reconnected once.
+        """
+        if interface is None:
+            interface = self.default_interface()
+        start = time.monotonic()
+        for retry in (False, True):
+            conn = self._connection(interface)
+            try:
+                replies = self._exchange(conn, commands, window)
+                break
+            except OSError as e:
+                self._drop(interface, conn)
+                if retry:
+                    raise
+                self.logger.debug("Reconnect to wpa_supplicant on {}: {}".format(interface, e))
+        WPA_CLI_SECONDS.observe(time.monotonic() - start)
+        return replies
+
+    def _exchange(self, conn: Tuple[socket.socket, str, threading.Lock], commands: List[str], window: int) -> List[str]:
+        sock, _, lock = conn
+        replies = []  # type: List[str]
+        with lock:
+            # drop a late reply to an earlier request that timed out, not to take it for this one
+            sock.setblocking(False)
+            try:
+                while True:
+                    sock.recv(REPLY_SIZE)
+            except BlockingIOError:
+                pass
+            sock.setblocking(True)
+            sent = 0
+            deadline = time.monotonic() + self.timeout
+            while len(replies) < len(commands):
+                while sent < len(commands) and sent - len(replies) < window:
+                    sock.send(commands[sent].encode("UTF-8"))
+                    sent += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                    raise WpaException("wpa_supplicant did not reply to {}".format(commands[len(replies)].split(" ")[0]))
+                reply = sock.recv(REPLY_SIZE).decode("UTF-8", errors="replace")
+                # events come only to attached sockets, but never take one for a reply
+                if not reply.startswith("<"):
+                    replies.append(reply)
+                    deadline = time.monotonic() + self.timeout
+        return replies
+
+    def cmd(self, *argv) -> List[str]:
+        """Run a command given as wpa_cli arguments, with an optional leading ``-i interface``; return reply lines."""
+        args = list(argv)
+        interface = None
+        if len(args) > 1 and args[0] == "-i":
+            interface = args[1]
+            args = args[2:]
+        if args == ["interface"]:
+            # wpa_cli answers this itself from the control directory
+            selected = interface if interface is not None else self.default_interface()
+            return ["Selected interface '{}'".format(selected), "Available interfaces:"] + self.interfaces()
+        return self.request(" ".join([args[0].upper()] + args[1:]), interface).splitlines()
+
+    def close(self) -> None:
+        with self._lock:
+            for sock, local, _ in self._connections.values():
+                sock.close()
+                _unlink(local)
+            self._connections = {}
+
+    def __enter__(self) -> "WpaCtrl":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def start_p2p_find(self):
+        self.logger.debug("wpa_cli p2p_find type=progressive")
+        status = self.cmd("p2p_find", "type=progressive")
+        if "OK" not in status:
+            raise WpaException("Fail to start p2p find.")
+
+    def stop_p2p_find(self):
+        self.logger.debug("wpa_cli p2p_stop_find")
+        status = self.cmd("p2p_stop_find")
+        if "OK" not in status:
+            raise WpaException("Fail to stop p2p find.")
+
+    def set_device_name(self, name: str):
+        self.logger.debug("wpa_cli set device_name {}".format(name))
+        status = self.cmd("set", "device_name", name)
+        if "OK" not in status:
+            raise WpaException("Fail to set device name {}".format(name))
+
+    def set_device_type(self, type):
+        self.logger.debug("wpa_cli set device_type {}".format(type))
+        status = self.cmd("set", "device_type", type)
+        if "OK" not in status:
+            raise WpaException("Fail to set device type {}".format(type))
+
+    def set_p2p_go_ht40(self):
+        self.logger.debug("wpa_cli set p2p_go_ht40 1")
+        status = self.cmd("set", "p2p_go_ht40", "1")
+        if "OK" not in status:
+            raise WpaException("Fail to set p2p_go_ht40")
+
+    def set_p2p_ssid_postfix(self, postfix: str):
+        self.logger.debug("wpa_cli set p2p_ssid_postfix _{}".format(postfix))
+        status = self.cmd("set", "p2p_ssid_postfix", "_{}".format(postfix))
+        if "OK" not in status:
+            raise WpaException("Fail to set p2p_ssid_postfix")
+
+    def wfd_subelem_set(self, key: int, val: str):
+        self.logger.debug("wpa_cli wfd_subelem_set {0:d} {1:s}".format(key, val))
+        status = self.cmd("wfd_subelem_set", "{0:d}".format(key), val)
+        if "OK" not in status:
+            raise WpaException("Fail to wfd_subelem_set.")
+
+    def p2p_group_add(self, network_id: str):
+        group_option = "persistent"
+        if network_id is not None:
+            group_option = "persistent={}".format(network_id)
+        self.logger.debug("wpa_cli p2p_group_add {}".format(group_option))
+        self.cmd("p2p_group_add", group_option)
+
+    def set_wps_pin(self, interface: str, pin: str, timeout: int):
+        self.logger.debug("wpa_cli -i {0:s} wps_pin any {1:s} {2:d}".format(interface, pin, timeout))
+        status = self.cmd("-i", interface, "wps_pin", "any", "{0:s}".format(pin), "{0:d}".format(timeout))
+        return status
+
+    def start_wps_pbc(self, interface: str):
+        self.logger.debug("wpa_cli -i {0:s} wps_pbc".format(interface))
+        status = self.cmd("-i", interface, "wps_pbc")
+        return status
+
+    def p2p_connect(self, interface: str, pin: str, peer: str):
+        self.logger.debug("wpa_cli -i {0:s} p2p_connect {1:s} {2:s}".format(interface, peer, pin))
+        status = self.cmd("-i", interface, "p2p_connect", "{0:s}".format(peer), "{0:s}".format(pin))
+        return status
+
+    def get_interfaces(self) -> Tuple[Optional[str], List[str]]:
+        selected = None
+        interfaces = []
+        status = self.cmd("interface")
+        for ln in status:
+            if ln.startswith("Selected interface"):
+                m = re.match(r"Selected interface\s\'(.+)\'$", ln)
+                if m is not None:
+                    selected = m.group(1)
+            elif ln.startswith("Available interfaces:"):
+                pass
+            else:
+                interfaces.append(str(ln))
+        return selected, interfaces
+
+    def get_p2p_interface(self) -> Optional[str]:
+        sel, interfaces = self.get_interfaces()
+        for it in interfaces:
+            if it.startswith("p2p-") and not it.startswith("p2p-dev"):
+                return it
+        return None
+
+    def check_p2p_interface(self) -> bool:
+        if self.get_p2p_interface() is not None:
+            return True
+        return False
+
+    def get_persistent_group_network_id(self, postfix: str) -> Optional[str]:
+        network_id = None
+        networks = self.cmd("list_networks")
+        for n in networks:
+            m = re.match(r"^([0-9]+)\s*?([^\s]+).*$", n)
+            if m is not None:
+                if m.group(2).endswith("_{}".format(postfix)):
+                    network_id = m.group(1)
+        return network_id
+
+
+class WpaEvent(NamedTuple):
+    """Unsolicited message of wpa_supplicant, such as ``P2P-GROUP-STARTED p2p-wlan0-0 GO ssid="..."``."""
+
+    interface: str
+    name: str
+    args: List[str]
+    params: Dict[str, str]
+    level: int = 2
+
+    @classmethod
+    def parse(cls, interface: str, message: str) -> "WpaEvent":
+        level = 2
+        if message.startswith("<") and ">" in message:
+            prefix, _, message = message[1:].partition(">")
+            if prefix.isdigit():
+                level = int(prefix)
+        try:
+            tokens = shlex.split(message)
+        except ValueError:
+            # an unbalanced quote in a value such as a passphrase
+            tokens = message.split()
+        args = []
+        params = {}
+        for token in tokens[1:]:
+            key, sep, value = token.partition("=")
+            if sep:
+                params[key] = value
+            else:
+                args.append(token)
+        return cls(interface, tokens[0] if tokens else "", args, params, level)
+
+    def matches(self, names: Tuple[str, ...]) -> bool:
+        """Whether the name is one of `names`, where a name ending with ``-`` is a prefix such as ``WPS-``."""
+        return any(self.name == n or (n.endswith("-") and self.name.startswith(n)) for n in names)
+
+
+class EventWaiter:
+    """One event expected by :meth:`WpaMonitor.expect`."""
+
+    def __init__(self, names: Tuple[str, ...], predicate: Optional[Callable[[WpaEvent], bool]] = None):
+        self.names = names
+        self.predicate = predicate
+        self.event = None  # type: Optional[WpaEvent]
+        self._done = threading.Event()
+
+    def offer(self, event: WpaEvent) -> bool:
+        if self._done.is_set() or not event.matches(self.names):
+            return False
+        if self.predicate is not None and not self.predicate(event):
+            return False
+        self.event = event
+        self._done.set()
+        return True
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[WpaEvent]:
+        """Return the event, or None when it did not come within `timeout` seconds."""
+        self._done.wait(timeout)
+        return self.event
+
+
+class WpaMonitor(threading.Thread):
+    """Receive unsolicited events of wpa_supplicant.
+
+    Each attached interface gets its own control socket registered with ``ATTACH``.
+    Events go to callbacks of :meth:`subscribe` and to waiters of :meth:`expect` from
+    the monitor thread. A waiter is created before the command that causes the event,
+    so an event arriving before :meth:`EventWaiter.wait` is not missed.
+
+    A socket quiet for `ping_interval` seconds is sent a ``PING``. When that fails or
+    stays unanswered, as after a restart of wpa_supplicant, the interface is attached
+    again on a new socket, retried every `ping_interval` until it succeeds.
+    """
+
+    def __init__(self, ctrl_dir: Optional[str] = None, logger="picast", timeout: float = 5.0, ping_interval: float = 10.0):
+        super().__init__(name="wpa-events", daemon=True)
+        self.ctrl_dir = ctrl_dir if ctrl_dir is not None else Settings().ctrl_interface
+        self.logger = getLogger(logger)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._sockets = {}  # type: Dict[socket.socket, Tuple[str, str]]
+        # monotonic time of the last message of each socket, and of its unanswered PING
+        self._seen = {}  # type: Dict[socket.socket, float]
+        self._pinged = {}  # type: Dict[socket.socket, float]
+        # interfaces to attach again
+        self._lost = []  # type: List[str]
+        self._subscribers = []  # type: List[Tuple[Tuple[str, ...], Callable[[WpaEvent], None]]]
+        self._waiters = []  # type: List[EventWaiter]
+        self._lock = threading.Lock()
+        self._wakeup, self._waker = socket.socketpair()
+        self._stopped = False
+
+    @property
+    def interfaces(self) -> List[str]:
+        with self._lock:
+            return [interface for interface, _ in self._sockets.values()]
+
+    def attach(self, interface: str) -> None:
+        """Receive events of `interface`; raise :class:`WpaException` or OSError when it cannot attach."""
+        if interface in self.interfaces:
+            return
+        sock, local = _open(self.ctrl_dir, interface)
+        try:
+            sock.send(b"ATTACH")
+            readable = select.select([sock], [], [], self.timeout)[0]
+            reply = sock.recv(REPLY_SIZE) if readable else b""
+        except OSError:
+            sock.close()
+            _unlink(local)
+            raise
+        if not reply.startswith(b"OK"):
+            sock.close()
+            _unlink(local)
+            raise WpaException("Cannot attach to events of {}".format(interface))
+        with self._lock:
+            self._sockets[sock] = (interface, local)
+            self._seen[sock] = time.monotonic()
+        self._waker.send(b"\0")
+        self.logger.debug("Attached to wpa_supplicant events of {}".format(interface))
+
+    def subscribe(self, callback: Callable[[WpaEvent], None], *names: str) -> None:
+        """Call `callback` with events of `names`, where ``WPS-`` is a prefix; with no names, with every event."""
+        with self._lock:
+            self._subscribers.append((names, callback))
+
+    def expect(self, *names: str, predicate: Optional[Callable[[WpaEvent], bool]] = None) -> EventWaiter:
+        """Start waiting for the next event of `names` which satisfies `predicate`."""
+        waiter = EventWaiter(names, predicate)
+        with self._lock:
+            self._waiters.append(waiter)
+        return waiter
+
+    def discard(self, waiter: EventWaiter) -> None:
+        """Stop waiting with `waiter`, as after its wait timed out."""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def dispatch(self, event: WpaEvent) -> None:
+        with self._lock:
+            subscribers = [callback for names, callback in self._subscribers if not names or event.matches(names)]
+            self._waiters = [waiter for waiter in self._waiters if not waiter.offer(event)]
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                self.logger.exception("Error in wpa_supplicant event callback")
+
+    def run(self) -> None:
+        while not self._stopped:
+            with self._lock:
+                sockets = list(self._sockets)
+            readable, _, _ = select.select(sockets + [self._wakeup], [], [], self.ping_interval)
+            for sock in readable:
+                if sock is self._wakeup:
+                    self._wakeup.recv(64)
+                    continue
+                try:
+                    data = sock.recv(REPLY_SIZE)
+                except OSError as e:
+                    self._lose(sock, e)
+                    continue
+                self._seen[sock] = time.monotonic()
+                self._pinged.pop(sock, None)
+                message = data.decode("UTF-8", errors="replace")
+                if not message.startswith("<"):
+                    # the reply to PING or DETACH
+                    continue
+                event = WpaEvent.parse(self._sockets[sock][0], message)
+                self.logger.debug("wpa event {}: {}".format(event.interface, message))
+                self.dispatch(event)
+            if not self._stopped:
+                self._check()
+
+    def _check(self) -> None:
+        """Ping quiet sockets, and attach again the interfaces whose socket is lost."""
+        now = time.monotonic()
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            pinged = self._pinged.get(sock)
+            if pinged is not None:
+                if now - pinged > self.ping_interval:
+                    self._lose(sock, "no reply to PING")
+            elif now - self._seen.get(sock, now) >= self.ping_interval:
+                try:
+                    sock.send(b"PING")
+                except OSError as e:
+                    self._lose(sock, e)
+                    continue
+                self._pinged[sock] = now
+        lost, self._lost = self._lost, []
+        for interface in lost:
+            try:
+                self.attach(interface)
+            except (OSError, WpaException) as e:
+                self.logger.debug("Cannot attach to events of {} yet: {}".format(interface, e))
+                self._lost.append(interface)
+            else:
+                self.logger.info("Attached again to wpa_supplicant events of {}".format(interface))
+
+    def _lose(self, sock: socket.socket, reason) -> None:
+        interface = self._sockets[sock][0]
+        self.logger.error("wpa_supplicant events of {} lost: {}".format(interface, reason))
+        self._detach(sock)
+        self._lost.append(interface)
+        # wpa_supplicant went away without telling, so tell subscribers as it does on a clean exit
+        self.dispatch(WpaEvent(interface, "CTRL-EVENT-TERMINATING", [], {}))
+
+    def _detach(self, sock: socket.socket) -> None:
+        with self._lock:
+            _, local = self._sockets.pop(sock)
+            self._seen.pop(sock, None)
+            self._pinged.pop(sock, None)
+        try:
+            sock.send(b"DETACH")
+        except OSError:
+            pass
+        sock.close()
+        _unlink(local)
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._waker.send(b"\0")
+        if self.is_alive():
+            self.join()
+        for sock in list(self._sockets):
+            self._detach(sock)
+        self._wakeup.close()
+        self._waker.close()
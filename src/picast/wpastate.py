@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+picast - a simple wireless display receiver for Raspberry Pi
+
+    Copyright (C) 2019-2022 Hiroshi Miura
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from logging import getLogger
+from typing import Dict, List, NamedTuple, Optional
+
+from .wpactrl import WpaCtrl, WpaEvent, WpaMonitor
+
+# events after which the interfaces or the networks are read again
+INTERFACE_EVENTS = ("P2P-GROUP-STARTED", "P2P-GROUP-REMOVED", "CTRL-EVENT-TERMINATING")
+NETWORK_EVENTS = ("CTRL-EVENT-NETWORK-ADDED", "CTRL-EVENT-NETWORK-REMOVED", "P2P-GROUP-STARTED", "CTRL-EVENT-TERMINATING")
+
+
+class Network(NamedTuple):
+    """A configured network of ``LIST_NETWORKS``."""
+
+    id: str
+    ssid: str
+    bssid: str
+    flags: str
+
+    @property
+    def persistent(self) -> bool:
+        return "[P2P-PERSISTENT]" in self.flags
+
+
+def parse_networks(lines: List[str]) -> Dict[str, Network]:
+    """Networks by id from the tab separated lines of ``LIST_NETWORKS``."""
+    networks = {}
+    for line in lines:
+        fields = line.split("\t") if "\t" in line else line.split()
+        if len(fields) < 2 or not fields[0].isdigit():
+            continue
+        fields += [""] * (4 - len(fields))
+        networks[fields[0]] = Network(*fields[:4])
+    return networks
+
+
+class WpaState:
+    """Interfaces, P2P groups and networks of wpa_supplicant kept in memory.
+
+    The state is read on first use and then served from memory. Events of `monitor`
+    update the P2P groups at once and mark the interfaces or networks for reading
+    again on the next lookup. Without events, a lookup reads again when the state is
+    older than `ttl` seconds.
+    """
+
+    def __init__(self, wpa: WpaCtrl, monitor: Optional[WpaMonitor] = None, ttl: float = 30.0, logger="picast"):
+        self.wpa = wpa
+        self.ttl = ttl
+        self.logger = getLogger(logger)
+        self._lock = threading.Lock()
+        self._interfaces = []  # type: List[str]
+        # role, GO or client, of each P2P group interface
+        self._groups = {}  # type: Dict[str, str]
+        self._networks = {}  # type: Dict[str, Network]
+        self._interfaces_at = None  # type: Optional[float]
+        self._networks_at = None  # type: Optional[float]
+        if monitor is not None:
+            monitor.subscribe(self.on_event, *sorted(set(INTERFACE_EVENTS + NETWORK_EVENTS)))
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._interfaces_at = None
+            self._networks_at = None
+
+    def _fresh(self, loaded_at: Optional[float]) -> bool:
+        return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+
+    def on_event(self, event: WpaEvent) -> None:
+        with self._lock:
+            if event.name == "P2P-GROUP-STARTED" and event.args:
+                if event.args[0] not in self._interfaces:
+                    self._interfaces.append(event.args[0])
+                self._groups[event.args[0]] = event.args[1] if len(event.args) > 1 else ""
+            elif event.name == "P2P-GROUP-REMOVED" and event.args:
+                self._groups.pop(event.args[0], None)
+                if event.args[0] in self._interfaces:
+                    self._interfaces.remove(event.args[0])
+            elif event.name in INTERFACE_EVENTS:
+                self._interfaces_at = None
+            if event.name in NETWORK_EVENTS:
+                self._networks_at = None
+
+    def _load_interfaces(self) -> None:
+        if self._fresh(self._interfaces_at):
+            return
+        interfaces = self.wpa.get_interfaces()[1]
+        groups = {}
+        for name in interfaces:
+            if name.startswith("p2p-") and not name.startswith("p2p-dev"):
+                groups[name] = self._groups.get(name, "")
+        self._interfaces = interfaces
+        self._groups = groups
+        self._interfaces_at = time.monotonic()
+
+    def _load_networks(self) -> None:
+        if self._fresh(self._networks_at):
+            return
+        self._networks = parse_networks(self.wpa.cmd("list_networks"))
+        self._networks_at = time.monotonic()
+
+    def interfaces(self) -> List[str]:
+        with self._lock:
+            self._load_interfaces()
+            return list(self._interfaces)
+
+    def groups(self) -> Dict[str, str]:
+        """Role of each P2P group interface, empty when the group was found without its event."""
+        with self._lock:
+            self._load_interfaces()
+            return dict(self._groups)
+
+    def p2p_interface(self) -> Optional[str]:
+        with self._lock:
+            self._load_interfaces()
+            return min(self._groups) if self._groups else None
+
+    def networks(self) -> Dict[str, Network]:
+        with self._lock:
+            self._load_networks()
+            return dict(self._networks)
+
+    def persistent_group_network_id(self, postfix: str) -> Optional[str]:
+        """Id of the last persistent group network whose SSID ends with `_postfix`."""
+        with self._lock:
+            self._load_networks()
+            found = [n.id for n in self._networks.values() if n.ssid.endswith("_{}".format(postfix))]
+        return found[-1] if found else None
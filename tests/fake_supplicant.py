@@ -0,0 +1,105 @@
+"""A fake wpa_supplicant control interface for tests and benchmarks."""
+
+import os
+import select
+import socket
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from picast.wpactrl import REPLY_SIZE
+
+
+class FakeSupplicant(threading.Thread):
+    """A wpa_supplicant control interface serving fixed replies, for tests and benchmarks.
+
+    It binds a socket for each of `interfaces` in `ctrl_dir`. ``SET``/``GET`` keep
+    values, ``LIST_NETWORKS`` lists `networks`, and other commands are answered from
+    `replies` by their name, or with ``OK``. WFD sub-elements are kept as values
+    named ``wfd_subelem_<id>``. Requests are kept in `requests` as
+    (interface, command) and attached sockets receive :meth:`event` messages.
+    """
+
+    def __init__(self, ctrl_dir: str, interfaces: Tuple[str, ...] = ("p2p-dev-wlan0", "wlan0")):
+        super().__init__(name="fake-wpa-supplicant", daemon=True)
+        self.ctrl_dir = ctrl_dir
+        self.requests = []  # type: List[Tuple[str, str]]
+        self.values = {}  # type: Dict[str, str]
+        self.networks = []  # type: List[str]
+        self.replies = {}  # type: Dict[str, str]
+        # a handler takes (interface, command) and returns a reply, or None for the default handling.
+        self.handler = None  # type: Optional[Callable[[str, str], Optional[str]]]
+        self.attached = set()  # type: Set[Tuple[socket.socket, str]]
+        self._sockets = {}  # type: Dict[socket.socket, str]
+        for name in interfaces:
+            self.add_interface(name)
+        self._wakeup, self._waker = socket.socketpair()
+        self._stopped = False
+
+    def add_interface(self, name: str) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(os.path.join(self.ctrl_dir, name))
+        self._sockets[sock] = name
+
+    def event(self, message: str, level: int = 2) -> None:
+        """Send an event to the attached clients."""
+        data = "<{}>{}".format(level, message).encode("UTF-8")
+        for sock, addr in list(self.attached):
+            try:
+                sock.sendto(data, addr)
+            except OSError:
+                self.attached.discard((sock, addr))
+
+    def _reply(self, interface: str, command: str, sock: socket.socket, addr: str) -> str:
+        if self.handler is not None:
+            reply = self.handler(interface, command)
+            if reply is not None:
+                return reply
+        name, _, rest = command.partition(" ")
+        if name == "PING":
+            return "PONG\n"
+        if name == "ATTACH":
+            self.attached.add((sock, addr))
+            return "OK\n"
+        if name == "DETACH":
+            self.attached.discard((sock, addr))
+            return "OK\n"
+        if name == "SET":
+            key, _, value = rest.partition(" ")
+            self.values[key] = value
+            return "OK\n"
+        if name == "GET":
+            return self.values[rest] if rest in self.values else "FAIL\n"
+        if name == "WFD_SUBELEM_SET":
+            key, _, value = rest.partition(" ")
+            self.values["wfd_subelem_{}".format(key)] = value.lower()
+            return "OK\n"
+        if name == "WFD_SUBELEM_GET":
+            return self.values.get("wfd_subelem_{}".format(rest), "")
+        if name == "LIST_NETWORKS":
+            return "\n".join(["network id / ssid / bssid / flags"] + self.networks) + "\n"
+        return self.replies.get(name, "OK\n")
+
+    def run(self) -> None:
+        while not self._stopped:
+            readable, _, _ = select.select(list(self._sockets) + [self._wakeup], [], [])
+            for sock in readable:
+                if sock is self._wakeup:
+                    continue
+                data, addr = sock.recvfrom(REPLY_SIZE)
+                interface = self._sockets[sock]
+                command = data.decode("UTF-8")
+                self.requests.append((interface, command))
+                try:
+                    sock.sendto(self._reply(interface, command, sock, addr).encode("UTF-8"), addr)
+                except OSError:
+                    pass
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._waker.send(b"\0")
+        self.join()
+        for sock, name in self._sockets.items():
+            sock.close()
+            os.unlink(os.path.join(self.ctrl_dir, name))
+        self._wakeup.close()
+        self._waker.close()
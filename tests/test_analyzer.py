@@ -0,0 +1,138 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from picast.analyzer import TS_DTYPE, TsAnalyzer, analyze_file, find_sync, format_report, main  # noqa: E402
+
+VIDEO_PID = 0x1011
+PCR_PID = 0x1000
+
+
+def ts_packet(pid, cc, payload=b"", pusi=False, pcr=None, random_access=False):
+    header = bytes([0x47, (0x40 if pusi else 0) | pid >> 8, pid & 0xFF])
+    af = b""
+    if pcr is not None or random_access:
+        flags = (0x40 if random_access else 0) | (0x10 if pcr is not None else 0)
+        af = bytes([flags])
+        if pcr is not None:
+            base, ext = divmod(pcr, 300)
+            af += (base << 15 | 0x3F << 9 | ext).to_bytes(6, "big")
+    room = 184 - len(payload)
+    if af or room:
+        if not af and room > 1:
+            af = b"\x00"
+        af = af + b"\xff" * (room - 1 - len(af))
+        packet = header + bytes([0x30 | cc, len(af)]) + af + payload
+    else:
+        packet = header + bytes([0x10 | cc]) + payload
+    assert len(packet) == 188
+    return packet
+
+
+def pes(dts, key):
+    def timestamp(prefix, value):
+        return bytes(
+            [
+                prefix << 4 | (value >> 29) & 0x0E | 1,
+                (value >> 22) & 0xFF,
+                (value >> 14) & 0xFE | 1,
+                (value >> 7) & 0xFF,
+                (value << 1) & 0xFE | 1,
+            ]
+        )
+
+    header = b"\x00\x00\x01\xe0\x00\x00\x80\xc0\x0a" + timestamp(3, dts + 3000) + timestamp(1, dts)
+    es = b"\x00\x00\x00\x01\x09\xf0" + (b"\x00\x00\x00\x01\x67\x42" if key else b"\x00\x00\x00\x01\x41\x9a")
+    return header + es
+
+
+def stream(frames=90, packets_per_frame=10, skip_cc=None, arrival=None):
+    """30 fps video with a key frame every 30 frames and a PCR every 3 frames.
+
+    The send time of each packet, the time of its frame, is appended to `arrival`.
+    """
+    out = []
+    cc = {VIDEO_PID: 0, PCR_PID: 0}
+    for n in range(frames):
+        dts = 900000 + n * 3000
+        for i in range(packets_per_frame):
+            position = n * packets_per_frame + i
+            if i == 0:
+                payload = pes(dts, n % 30 == 0)
+                out.append(ts_packet(VIDEO_PID, cc[VIDEO_PID], payload, pusi=True))
+            else:
+                out.append(ts_packet(VIDEO_PID, cc[VIDEO_PID], b"\x00" * 184))
+            cc[VIDEO_PID] = (cc[VIDEO_PID] + 1) % 16
+            if position == skip_cc:
+                cc[VIDEO_PID] = (cc[VIDEO_PID] + 1) % 16
+        if n % 3 == 0:
+            out.append(ts_packet(PCR_PID, cc[PCR_PID], pcr=(dts - 9000) * 300))
+        if arrival is not None:
+            arrival.extend([n / 30] * (len(out) - len(arrival)))
+    return b"".join(out)
+
+
+@pytest.mark.unit
+def test_find_sync():
+    data = stream(frames=3)
+    assert find_sync(data) == 0
+    assert find_sync(b"\x00\x47" + data) == 2
+    assert find_sync(b"\x00" * 200) == -1
+
+
+@pytest.mark.unit
+def test_analyzer_stream():
+    data = stream(skip_cc=55)
+    analyzer = TsAnalyzer()
+    packets = np.frombuffer(data, TS_DTYPE)
+    # across batch boundaries
+    for start in range(0, len(packets), 64):
+        analyzer.feed(packets[start : start + 64])
+    report = analyzer.report()
+    assert report["packets"] == len(packets)
+    assert report["sync_errors"] == 0
+    assert report["pids"][VIDEO_PID] == {"packets": 900, "cc_errors": 1}
+    assert report["pids"][PCR_PID]["cc_errors"] == 0
+    pcr = report["pcr"]
+    assert pcr["pid"] == PCR_PID
+    assert pcr["count"] == 30
+    assert pcr["interval_ms"]["mean"] == pytest.approx(100)
+    # 31 packets between PCRs 100 ms apart
+    assert pcr["bitrate"] == pytest.approx(31 * 188 * 8 * 10)
+    assert pcr["jitter_ms"] is None
+    video = report["pes"][VIDEO_PID]
+    assert video["video"]
+    assert video["pes"] == 90
+    assert video["frame_rate"] == pytest.approx(30)
+    assert video["key_frames"] == 3
+    assert video["key_interval_s"]["mean"] == pytest.approx(1.0)
+    assert video["key_interval_frames"]["max"] == 30
+    assert "1 continuity errors" in format_report(report)
+
+
+@pytest.mark.unit
+def test_analyzer_arrival_jitter():
+    sent = []
+    packets = np.frombuffer(stream(arrival=sent), TS_DTYPE)
+    # packets arrive 20 ms after sending, with a 5 ms delay spike on frames 30 to 32
+    arrival = np.array(sent) + 50.02
+    arrival[(arrival > 51.01) & (arrival < 51.1)] += 0.005
+    analyzer = TsAnalyzer()
+    analyzer.feed(packets, arrival)
+    report = analyzer.report()
+    assert report["pcr"]["jitter_ms"] == pytest.approx(5, abs=0.5)
+    assert report["pes"][VIDEO_PID]["arrival_jitter_ms"] == pytest.approx(5, abs=0.5)
+
+
+@pytest.mark.unit
+def test_analyze_file(tmp_path, capsys):
+    path = tmp_path / "stream.ts"
+    # a recording starting in the middle of a packet
+    path.write_bytes(b"\x12\x34" + stream() + b"\x47\x00")
+    report = analyze_file(str(path), batch=100)
+    assert report["pids"][VIDEO_PID]["packets"] == 900
+    assert report["pids"][VIDEO_PID]["cc_errors"] == 0
+    assert main([str(path), "--json"]) == 0
+    assert json.loads(capsys.readouterr().out)["pes"][str(VIDEO_PID)]["key_frames"] == 3
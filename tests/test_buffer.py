@@ -0,0 +1,52 @@
+import socket
+
+import pytest
+
+from picast.buffer import RecvBuffer
+
+
+@pytest.mark.unit
+def test_recvbuffer_readline_split_terminator():
+    buf = RecvBuffer(size=8)
+    buf.feed(b"OPTIONS * RTSP/1.0\r")
+    assert buf.readline() is None
+    buf.feed(b"\nCSeq: 0\r\n\r\n")
+    assert buf.readline() == b"OPTIONS * RTSP/1.0"
+    assert buf.readline() == b"CSeq: 0"
+    assert buf.readline() == b""
+    assert buf.readline() is None
+    assert len(buf) == 0
+
+
+@pytest.mark.unit
+def test_recvbuffer_read_body():
+    buf = RecvBuffer(size=16)
+    buf.feed(b"Content-Length: 5\r\n\r\nhelloworld")
+    assert buf.readline() == b"Content-Length: 5"
+    assert buf.readline() == b""
+    assert buf.read(5) == b"hello"
+    assert buf.read(100) == b"world"
+    assert len(buf) == 0
+
+
+@pytest.mark.unit
+def test_recvbuffer_views_survive_growth():
+    buf = RecvBuffer(size=8)
+    buf.feed(b"line\r\n")
+    line = buf.readline()
+    buf.feed(b"x" * 64)
+    assert line == b"line"
+    assert buf.read_all() == b"x" * 64
+
+
+@pytest.mark.unit
+def test_recvbuffer_recv_into():
+    a, b = socket.socketpair()
+    try:
+        buf = RecvBuffer(size=4)
+        a.sendall(b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\n")
+        while buf.readline() is None:
+            assert buf.recv_into(b) > 0
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,85 @@
+import json
+import re
+
+import pytest
+
+from picast.players.decoders import DecoderProbe, h264_sample, rank, registry_key
+
+
+@pytest.mark.unit
+def test_h264_sample():
+    sample = h264_sample(width=32, height=32, frames=2)
+    nals = [n for n in sample.split(b"\x00\x00\x00\x01") if n]
+    assert [n[0] for n in nals] == [0x67, 0x68, 0x65, 0x65]
+    # emulation prevention leaves no start code prefix inside a NAL unit
+    for nal in nals:
+        assert re.search(b"\x00\x00[\x00-\x02]", nal) is None
+    # I_PCM samples are carried as is; 4 macroblocks of 384 bytes per frame
+    assert len(nals[2]) > 4 * 384
+
+
+@pytest.mark.unit
+def test_registry_key():
+    assert registry_key("1.18", ["a:1", "b:1"]) == registry_key("1.18", ["b:1", "a:1"])
+    assert registry_key("1.18", ["a:1"]) != registry_key("1.20", ["a:1"])
+    assert registry_key("1.18", ["a:1"]) != registry_key("1.18", ["a:2"])
+
+
+@pytest.mark.unit
+def test_rank():
+    assert rank({"slow": 2.0, "broken": None, "fast": 0.5}) == ["fast", "slow"]
+    assert rank({"broken": None}) == []
+
+
+class ProbeMock(DecoderProbe):
+    def __init__(self, cache_file, installed, timings, version="1.18"):
+        super().__init__(cache_file)
+        self._installed = installed
+        self._timings = timings
+        self._version = version
+        self.probed = 0
+
+    def registry(self):
+        return self._version, ["{}:1".format(name) for name in self._installed]
+
+    def installed(self, names):
+        return [name for name in names if name in self._installed]
+
+    def probe(self, candidates):
+        self.probed += 1
+        return {name: self._timings.get(name) for name in candidates}
+
+
+@pytest.mark.unit
+def test_decoder_probe_select(tmp_path):
+    cache = str(tmp_path / "decoder.json")
+    probe = ProbeMock(cache, ["omxh264dec", "avdec_h264"], {"omxh264dec": None, "avdec_h264": 0.3})
+    # an installed decoder is used as configured
+    assert probe.select("omxh264dec") == "omxh264dec"
+    assert probe.probed == 0
+    # otherwise the fastest working one, and the result is cached
+    assert probe.select("v4l2h264dec") == "avdec_h264"
+    assert probe.select("auto") == "avdec_h264"
+    assert probe.probed == 1
+    with open(cache) as f:
+        assert json.load(f)["decoder"] == "avdec_h264"
+    # a GStreamer upgrade invalidates the cache
+    upgraded = ProbeMock(cache, ["omxh264dec", "avdec_h264"], {"omxh264dec": 0.1, "avdec_h264": 0.3}, version="1.20")
+    assert upgraded.select("auto") == "omxh264dec"
+    assert upgraded.probed == 1
+
+
+@pytest.mark.unit
+def test_decoder_probe_none_works(tmp_path):
+    probe = ProbeMock(str(tmp_path / "decoder.json"), [], {})
+    assert probe.select("auto") is None
+    assert probe.select("omxh264dec") is None
+    assert not (tmp_path / "decoder.json").exists()
+
+
+@pytest.mark.unit
+def test_decoder_probe_video_sink(tmp_path):
+    probe = ProbeMock(str(tmp_path / "decoder.json"), ["glimagesink", "xvimagesink"], {})
+    assert probe.video_sink("auto") == "glimagesink"
+    assert probe.video_sink("fbdevsink") == "fbdevsink"
+    assert ProbeMock(str(tmp_path / "decoder.json"), [], {}).video_sink("auto") == "autovideosink"
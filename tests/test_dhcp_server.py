@@ -0,0 +1,201 @@
+import asyncio
+import json
+import socket
+import struct
+
+import pytest
+
+from picast import dhcpd
+from picast.dhcpd import (
+    BOOTREPLY,
+    BOOTREQUEST,
+    DHCPACK,
+    DHCPDISCOVER,
+    DHCPINFORM,
+    DHCPNAK,
+    DHCPOFFER,
+    DHCPRELEASE,
+    DHCPREQUEST,
+    OPTION_LEASE_TIME,
+    OPTION_MESSAGE_TYPE,
+    OPTION_REQUESTED_ADDRESS,
+    OPTION_SERVER_ID,
+    OPTION_SUBNET_MASK,
+    AsyncDhcpServer,
+    DhcpMessage,
+    LeasePool,
+    open_dhcp_socket,
+)
+from picast.sessions import SessionManager
+from picast.wifip2p import WifiP2PServer
+
+MAC1 = bytes.fromhex("020000000001")
+MAC2 = bytes.fromhex("020000000002")
+
+
+def request(message_type, chaddr, xid=1, ciaddr="0.0.0.0", requested=None, server_id=None):
+    options = {OPTION_MESSAGE_TYPE: bytes((message_type,))}
+    if requested is not None:
+        options[OPTION_REQUESTED_ADDRESS] = socket.inet_aton(requested)
+    if server_id is not None:
+        options[OPTION_SERVER_ID] = socket.inet_aton(server_id)
+    return DhcpMessage(BOOTREQUEST, xid, 0x8000, ciaddr, "0.0.0.0", "0.0.0.0", chaddr, options)
+
+
+@pytest.mark.unit
+def test_dhcp_message():
+    message = request(DHCPREQUEST, MAC1, xid=0x12345678, requested="192.168.173.80")
+    data = message.to_bytes()
+    assert len(data) >= 240
+    parsed = DhcpMessage.parse(data)
+    assert parsed == message
+    assert parsed.mac == "02:00:00:00:00:01"
+    assert parsed.message_type == DHCPREQUEST
+    assert parsed.address_option(OPTION_REQUESTED_ADDRESS) == "192.168.173.80"
+    assert parsed.address_option(OPTION_SERVER_ID) is None
+    with pytest.raises(ValueError):
+        DhcpMessage.parse(data[:200])
+    with pytest.raises(ValueError):
+        DhcpMessage.parse(data[:236] + b"\0\0\0\0" + data[240:])
+
+
+@pytest.mark.unit
+def test_lease_pool(tmp_path):
+    path = str(tmp_path / "leases.json")
+    pool = LeasePool("192.168.173.80", 3, 300, path=path, exclude=("192.168.173.81",))
+    assert pool.addresses == ["192.168.173.80", "192.168.173.82"]
+    assert pool.offer("mac1") == "192.168.173.80"
+    # an offer is held for its client
+    assert pool.offer("mac2") == "192.168.173.82"
+    assert pool.offer("mac3") is None
+    assert pool.grant("mac3", "192.168.173.80") is None
+    lease = pool.grant("mac1", "192.168.173.80")
+    assert lease.mac == "mac1" and lease.address == "192.168.173.80"
+    assert pool.grant("mac2", "192.168.173.99") is None
+    pool.cancel_offer("mac2")
+    with open(path) as f:
+        assert json.load(f)[0]["address"] == "192.168.173.80"
+    # a restart keeps the lease, and a released address goes back to its client first
+    pool = LeasePool("192.168.173.80", 3, 300, path=path, exclude=("192.168.173.81",))
+    assert [lease.address for lease in pool.leases()] == ["192.168.173.80"]
+    pool.release("mac1", "192.168.173.80")
+    assert pool.leases() == []
+    assert pool.offer("mac2") == "192.168.173.82"
+    assert pool.offer("mac1") == "192.168.173.80"
+    pool.decline("mac1", "192.168.173.80")
+    assert pool.offer("mac1") is None
+
+
+@pytest.mark.unit
+def test_dhcp_server_handle():
+    leases = []
+    server = AsyncDhcpServer(LeasePool("192.168.173.80", 2, 300), "192.168.173.1", "255.255.255.0")
+    server.subscribe(leases.append)
+    offer = server.handle(request(DHCPDISCOVER, MAC1))
+    assert offer.op == BOOTREPLY and offer.message_type == DHCPOFFER
+    assert offer.yiaddr == "192.168.173.80"
+    assert offer.address_option(OPTION_SUBNET_MASK) == "255.255.255.0"
+    assert offer.address_option(OPTION_SERVER_ID) == "192.168.173.1"
+    assert struct.unpack("!I", offer.options[OPTION_LEASE_TIME]) == (300,)
+    # another server was selected
+    assert server.handle(request(DHCPREQUEST, MAC1, requested="10.0.0.2", server_id="10.0.0.1")) is None
+    ack = server.handle(request(DHCPREQUEST, MAC1, requested="192.168.173.80", server_id="192.168.173.1"))
+    assert ack.message_type == DHCPACK and ack.yiaddr == "192.168.173.80"
+    assert [(lease.mac, lease.address) for lease in leases] == [("02:00:00:00:00:01", "192.168.173.80")]
+    # renewal from the leased address is answered to it, and is not a new lease
+    renew = request(DHCPREQUEST, MAC1, ciaddr="192.168.173.80")
+    ack = server.handle(renew)
+    assert ack.message_type == DHCPACK and server.destination(renew, ack) == "192.168.173.80"
+    assert len(leases) == 1
+    # an address of another client or network is refused
+    nak = server.handle(request(DHCPREQUEST, MAC2, requested="192.168.173.80"))
+    assert nak.message_type == DHCPNAK and nak.yiaddr == "0.0.0.0"
+    assert server.handle(request(DHCPREQUEST, MAC2, requested="10.0.0.2")).message_type == DHCPNAK
+    inform = server.handle(request(DHCPINFORM, MAC2, ciaddr="192.168.173.90"))
+    assert inform.message_type == DHCPACK and OPTION_LEASE_TIME not in inform.options
+    assert server.handle(request(DHCPRELEASE, MAC1, ciaddr="192.168.173.80")) is None
+    assert server.pool.leases() == []
+    assert len(leases) == 1
+    # a client rebooting into its released address is leased again
+    server.handle(request(DHCPREQUEST, MAC1, requested="192.168.173.80"))
+    assert len(leases) == 2
+
+
+@pytest.mark.connection
+@pytest.mark.asyncio
+async def test_dhcp_server_loopback(tmp_path):
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.setblocking(False)
+    pool = LeasePool("192.168.173.80", 4, 300, path=str(tmp_path / "leases.json"))
+    server = AsyncDhcpServer(
+        pool, "192.168.173.1", "255.255.255.0", client_port=client.getsockname()[1], broadcast="127.0.0.1"
+    )
+    granted = asyncio.Queue()
+    server.subscribe(granted.put_nowait)
+    sock = open_dhcp_socket(None, 0, "127.0.0.1")
+    address = sock.getsockname()
+    await server.open(sock)
+    loop = asyncio.get_event_loop()
+
+    async def exchange(message):
+        client.sendto(message.to_bytes(), address)
+        return DhcpMessage.parse(await asyncio.wait_for(loop.sock_recv(client, 1500), 5))
+
+    for xid, mac in enumerate((MAC1, MAC2)):
+        offer = await exchange(request(DHCPDISCOVER, mac, xid=xid))
+        assert offer.xid == xid and offer.chaddr == mac
+        ack = await exchange(request(DHCPREQUEST, mac, xid=xid, requested=offer.yiaddr, server_id="192.168.173.1"))
+        assert ack.message_type == DHCPACK
+        lease = await asyncio.wait_for(granted.get(), 5)
+        assert lease.address == ack.yiaddr
+    assert sorted(lease.address for lease in pool.leases()) == ["192.168.173.80", "192.168.173.81"]
+    # garbage is ignored
+    client.sendto(b"hello", address)
+    server.close()
+    client.close()
+
+
+@pytest.mark.unit
+def test_session_manager_lease_before_start():
+    class Lease:
+        address = "192.168.173.81"
+
+    manager = SessionManager(player_factory=lambda rtp_port: None)
+    manager.on_lease(Lease())
+    assert manager._leased == ["192.168.173.81"]
+
+
+@pytest.mark.unit
+def test_wifip2p_dhcpd_fallback(monkeypatch):
+    def no_privilege(*args):
+        raise PermissionError("port 67")
+
+    started = []
+    monkeypatch.setattr(WifiP2PServer, "set_p2p_interface", lambda self, *arg: None)
+    monkeypatch.setattr(dhcpd, "open_dhcp_socket", no_privilege)
+    monkeypatch.setattr(dhcpd.Dhcpd, "start", lambda self: started.append(self))
+    p2p = WifiP2PServer()
+    p2p.wlandev = "p2p-wlan0-0"
+    p2p.subscribe_leases(lambda lease: None)
+    p2p.start_dhcpd()
+    assert started == [p2p.dhcpd]
+    p2p.wpacli.close()
+
+
+@pytest.mark.unit
+def test_wifip2p_dhcpd_fallback_on_start_error(monkeypatch):
+    async def no_endpoint(self, sock):
+        raise OSError("create_datagram_endpoint")
+
+    started = []
+    monkeypatch.setattr(WifiP2PServer, "set_p2p_interface", lambda self, *arg: None)
+    monkeypatch.setattr(dhcpd, "open_dhcp_socket", lambda *args: open_dhcp_socket(None, 0, "127.0.0.1"))
+    monkeypatch.setattr(dhcpd.AsyncDhcpServer, "open", no_endpoint)
+    monkeypatch.setattr(dhcpd.Dhcpd, "start", lambda self: started.append(self))
+    p2p = WifiP2PServer()
+    p2p.wlandev = "p2p-wlan0-0"
+    p2p.subscribe_leases(lambda lease: None)
+    p2p.start_dhcpd()
+    assert started == [p2p.dhcpd]
+    p2p.wpacli.close()
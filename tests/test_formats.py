@@ -0,0 +1,45 @@
+import pytest
+
+from picast.formats import AudioFormat, SelectedFormat, VideoFormat
+
+
+@pytest.mark.unit
+def test_video_format_parse():
+    video = VideoFormat.parse("00 00 02 04 00000100 00000000 00000000 00 0000 0000 00 none none")
+    assert video.profile == 0x02
+    assert video.cea == 0x100
+    assert video.resolution == (1920, 1080, 60, True)
+    assert video.h264_profile == "high"
+    assert video.h264_level == "4"
+    assert video.max_hres is None
+    assert video.gst_caps() == "video/x-h264, width=(int)1920, height=(int)1080"
+    vesa = VideoFormat.parse("00 00 01 01 00000000 00000800 00000000 00 0000 0000 00 0780 0438")
+    assert vesa.resolution == (1360, 768, 60, True)
+    assert (vesa.max_hres, vesa.max_vres) == (1920, 1080)
+    assert VideoFormat.parse("none") is None
+    with pytest.raises(ValueError):
+        VideoFormat.parse("00 00 01")
+
+
+@pytest.mark.unit
+def test_audio_format_parse():
+    audio = AudioFormat.parse("AAC 00000001 00")
+    assert (audio.codec, audio.rate, audio.channels) == ("AAC", 48000, 2)
+    assert AudioFormat.parse("LPCM 00000002 00").rate == 48000
+    assert AudioFormat.parse("LPCM 00000001 00").rate == 44100
+    assert AudioFormat.parse("none") is None
+
+
+@pytest.mark.unit
+def test_selected_format_parse():
+    selected = SelectedFormat.parse({
+        "wfd_video_formats": "00 00 01 01 00000001 00000000 00000000 00 0000 0000 00 none none",
+        "wfd_audio_codecs": "LPCM 00000002 00",
+        "wfd_presentation_URL": "rtsp://192.168.173.80/wfd1.0/streamid=0 none",
+        "wfd_client_rtp_ports": "RTP/AVP/UDP;unicast 1028 0 mode=play",
+    })
+    assert selected.video.resolution == (640, 480, 60, True)
+    assert selected.audio.channels == 2
+    assert selected.presentation_url == "rtsp://192.168.173.80/wfd1.0/streamid=0"
+    assert selected.rtp_port == 1028
+    assert SelectedFormat.parse({}) == SelectedFormat()
@@ -0,0 +1,33 @@
+import pytest
+
+from picast.latency import PROFILES, LatencyController
+from picast.settings import Settings
+
+
+@pytest.mark.unit
+def test_latency_controller():
+    controller = LatencyController(10, 80)
+    assert controller.latency == 10
+    # quiet link stays at the minimum
+    assert controller.update(1.0) == 10
+    # jitter raises the latency at once
+    assert controller.update(5.0) == 20
+    # loss grows it by half again
+    assert controller.update(5.0, lost=2) == 30
+    assert controller.update(5.0, late=1) == 45
+    assert controller.update(100.0) == 80
+    # and it comes down slowly
+    assert controller.update(1.0) == 73
+    for _ in range(100):
+        controller.update(1.0)
+    assert controller.latency == 10
+    with pytest.raises(ValueError):
+        LatencyController(100, 10)
+
+
+@pytest.mark.unit
+def test_latency_profiles():
+    for profile in PROFILES:
+        controller = LatencyController.from_settings(profile)
+        assert controller.minimum < controller.maximum
+    assert LatencyController.from_settings().maximum == 200
@@ -0,0 +1,75 @@
+import socket
+
+import pytest
+
+from picast.metrics import MetricsRegistry, MetricsServer, parse_listen
+
+
+@pytest.mark.unit
+def test_registry_render():
+    registry = MetricsRegistry()
+    counter = registry.counter("picast_test_total", "Test counter.")
+    gauge = registry.gauge("picast_test_active", "Test gauge.")
+    histogram = registry.histogram("picast_test_seconds", "Test histogram.", (0.1, float("inf")))
+    assert registry.counter("picast_test_total", "Test counter.") is counter
+    counter.inc()
+    counter.inc(2)
+    gauge.inc()
+    gauge.dec()
+    gauge.set(4)
+    histogram.observe(0.05)
+    histogram.observe(1.0)
+    registry.add_collector(lambda: ["picast_extra 1"])
+    assert registry.render() == (
+        "# HELP picast_test_total Test counter.\n"
+        "# TYPE picast_test_total counter\n"
+        "picast_test_total 3\n"
+        "# HELP picast_test_active Test gauge.\n"
+        "# TYPE picast_test_active gauge\n"
+        "picast_test_active 4\n"
+        "# HELP picast_test_seconds Test histogram.\n"
+        "# TYPE picast_test_seconds histogram\n"
+        'picast_test_seconds_bucket{le="0.1"} 1\n'
+        'picast_test_seconds_bucket{le="+Inf"} 2\n'
+        "picast_test_seconds_sum 1.05\n"
+        "picast_test_seconds_count 2\n"
+        "picast_extra 1\n"
+    )
+
+
+@pytest.mark.unit
+def test_parse_listen():
+    assert parse_listen("") is None
+    assert parse_listen("127.0.0.1:9108") == ("127.0.0.1", 9108)
+    assert parse_listen(":9108") == ("0.0.0.0", 9108)
+    with pytest.raises(ValueError):
+        parse_listen("localhost")
+
+
+def http_get(port, path):
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode("ASCII"))
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return data.decode("UTF-8")
+            data += chunk
+
+
+@pytest.mark.connection
+def test_metrics_server():
+    server = MetricsServer("127.0.0.1", 0)
+    server.start()
+    assert server.ready.wait(5)
+    try:
+        response = http_get(server.port, "/metrics")
+        assert response.startswith("HTTP/1.1 200 OK\r\n")
+        assert "picast_sessions_active " in response
+        assert 'picast_negotiation_step_seconds_bucket{event="m1",le="+Inf"}' in response
+        assert "picast_wpa_cli_seconds_count" in response
+        assert http_get(server.port, "/").startswith("HTTP/1.1 404 Not Found\r\n")
+    finally:
+        server.stop()
+        server.join(5)
+    assert not server.is_alive()
@@ -1,9 +1,12 @@
+import asyncio
 import socket
 import threading
+import time
 
 import pytest
 
-from picast.rtspsink import RtspSink, RTSPTransport
+from picast.connector import Connector
+from picast.rtspsink import AsyncRtspSink, RTSPTransport, SessionState
 from picast.video import RasberryPiVideo
 
 
@@ -31,7 +34,8 @@ class MockServer(threading.Thread):
             m1 = b"OPTIONS * RTSP/1.0\r\nCSeq: 0\r\nRequire: org.wfa.wfd1.0\r\n\r\n"
             conn.sendall(m1)
             m1_resp = conn.recv(1000)
-            if m1_resp != b"RTSP/1.0 200 OK\r\nCSeq: 0\r\nPublic: org.wfa.wfd1.0, SET_PARAMETER, GET_PARAMETER\r\n\r\n":
+            # M2 may follow the reply in the same segment
+            if not m1_resp.startswith(b"RTSP/1.0 200 OK\r\nCSeq: 0\r\nPublic: org.wfa.wfd1.0, SET_PARAMETER, GET_PARAMETER\r\n\r\n"):
                 self.status = False
                 self.msg = "M1 response failure: {}".format(m1_resp)
         elif self.target == "m2":
@@ -82,7 +86,8 @@ class MockServer(threading.Thread):
             m5 += body
             conn.sendall(m5.encode('ASCII'))
             m5_resp = conn.recv(1000).decode('UTF-8')
-            if m5_resp != "RTSP/1.0 200 OK\r\nCSeq: 3\r\n\r\n":
+            # M6 may follow the reply in the same segment
+            if not m5_resp.startswith("RTSP/1.0 200 OK\r\nCSeq: 3\r\n\r\n"):
                 self.status = False
                 self.msg = "M5 bad response: {}".format(m5_resp)
         elif self.target == "m6":
@@ -124,188 +129,169 @@ def test_open_connection(unused_port):
     server.join()
 
 
-def test_readline(unused_port):
-    server = MockServer(unused_port, target="readline")
-    server.start()
-    transport = RTSPTransport('127.0.0.1', unused_port)
-    line = transport.readline()
-    assert line == b"OPTIONS * RTSP/1.0"
+def test_connector_waits_for_late_server(unused_port):
+    server = MockServer(unused_port, target="open")
+    timer = threading.Timer(0.3, server.start)
+    timer.start()
+    connector = Connector(deadline=5.0)
+    sock = connector.connect('127.0.0.1', unused_port)
+    assert connector.elapsed is not None and connector.elapsed >= 0.2
+    assert connector.attempts > 1
+    sock.close()
     server.join()
-    transport.close()
 
 
-def test_read_headers(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
+def test_connector_deadline(unused_port):
+    connector = Connector(deadline=0.3)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        connector.connect('127.0.0.1', unused_port)
+    assert time.monotonic() - start < 2.0
 
-    def nonemock(self, *args):
-        return
-
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
 
-    server = MockServer(unused_port, target="readline")
+def test_connector_cancel(unused_port):
+    connector = Connector(deadline=30.0)
+    threading.Timer(0.2, connector.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(ConnectionAbortedError):
+        connector.connect('127.0.0.1', unused_port)
+    assert time.monotonic() - start < 1.5
+    # a cancel aborts only the connect in progress
+    server = MockServer(unused_port, target="open")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    headers = rtspsink.read_headers()
-    assert headers == ['OPTIONS * RTSP/1.0', 'CSeq: 0', 'Require: org.wfa.wfd1.0']
+    connector.connect('127.0.0.1', unused_port).close()
     server.join()
-    rtspsink.sock.close()
+    connector.close()
 
 
-def test_get_rtsp_headers(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+@pytest.mark.asyncio
+async def test_connector_async_cancel(unused_port):
+    connector = Connector(deadline=30.0)
+    task = asyncio.ensure_future(connector.connect_async('127.0.0.1', unused_port))
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
 
-    server = MockServer(unused_port, target="readline")
+
+def test_transport_close(unused_port):
+    server = MockServer(unused_port, target="open")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    headers = rtspsink.get_rtsp_headers()
-    assert headers == {'CSeq': '0', 'Require': 'org.wfa.wfd1.0', 'cmd': 'OPTIONS', 'resp': None, 'url': '*'}
+    transport = RTSPTransport('127.0.0.1', unused_port)
     server.join()
+    transport.close()
+    assert transport.sock.fileno() == -1
+    assert transport.connector._wakeup_r.fileno() == -1
 
 
-def test_rtsp_m1(monkeypatch, unused_port):
+async def open_sink(monkeypatch, port, state=SessionState.CAPABILITY):
+    """Connect an AsyncRtspSink to the mock server, in `state` of the negotiation."""
     def videomock(self):
         return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
+
     def nonemock(self, *args):
         return
+
     monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
     monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+    rtspsink = AsyncRtspSink(None)
+    await rtspsink.open_connection('127.0.0.1', port)
+    rtspsink.state = state
+    return rtspsink
 
-    server = MockServer(unused_port, target="m1")
-    server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    rtspsink.rtsp_m1()
+
+async def exchange(rtspsink, server):
+    """Handle one message from the server and send what it queued."""
+    rtspsink.dispatch(await rtspsink.read_message(5))
+    await rtspsink.flush()
+    await rtspsink.close()
     result, msg = server.join()
     if not result:
         pytest.fail(msg)
 
 
-def test_rtsp_m2(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+@pytest.mark.asyncio
+async def test_read_message(monkeypatch, unused_port):
+    server = MockServer(unused_port, target="readline")
+    server.start()
+    rtspsink = await open_sink(monkeypatch, unused_port)
+    msg = await rtspsink.read_message(5)
+    assert msg.method == "OPTIONS" and msg.url == "*"
+    assert msg.cseq == "0"
+    assert msg.headers["Require"] == "org.wfa.wfd1.0"
+    server.join()
+    await rtspsink.close()
 
-    server = MockServer(unused_port, target="m2")
+
+@pytest.mark.asyncio
+async def test_rtsp_m1(monkeypatch, unused_port):
+    server = MockServer(unused_port, target="m1")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    rtspsink.rtsp_m2()
-    result, msg = server.join()
-    if not result:
-        pytest.fail(msg)
+    rtspsink = await open_sink(monkeypatch, unused_port, SessionState.INIT)
+    await exchange(rtspsink, server)
+    assert rtspsink.state == SessionState.CAPABILITY
 
 
-def test_rtsp_m3(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+@pytest.mark.asyncio
+async def test_rtsp_m2(monkeypatch, unused_port):
+    server = MockServer(unused_port, target="m2")
+    server.start()
+    rtspsink = await open_sink(monkeypatch, unused_port)
+    rtspsink._request("OPTIONS", rtspsink._m2_request())
+    await rtspsink.flush()
+    await exchange(rtspsink, server)
+    assert rtspsink.state == SessionState.CAPABILITY
+    assert not rtspsink.outstanding
 
+
+@pytest.mark.asyncio
+async def test_rtsp_m3(monkeypatch, unused_port):
     server = MockServer(unused_port, target="m3")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    rtspsink.rtsp_m3()
-    result, msg = server.join()
-    if not result:
-        pytest.fail(msg)
+    rtspsink = await open_sink(monkeypatch, unused_port)
+    await exchange(rtspsink, server)
 
 
-def test_rtsp_m4(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
-
+@pytest.mark.asyncio
+async def test_rtsp_m4(monkeypatch, unused_port):
     server = MockServer(unused_port, target="m4")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    rtspsink.rtsp_m4()
-    result, msg = server.join()
-    if not result:
-        pytest.fail(msg)
-
+    rtspsink = await open_sink(monkeypatch, unused_port)
+    await exchange(rtspsink, server)
+    assert rtspsink.wfd_selected["wfd_audio_codecs"] == "LPCM 00000002 00"
 
-def test_rtsp_m5(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
 
+@pytest.mark.asyncio
+async def test_rtsp_m5(monkeypatch, unused_port):
     server = MockServer(unused_port, target="m5")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    rtspsink.rtsp_m5()
-    result, msg = server.join()
-    if not result:
-        pytest.fail(msg)
-
+    rtspsink = await open_sink(monkeypatch, unused_port)
+    rtspsink.csnum = 100
+    await exchange(rtspsink, server)
+    assert rtspsink.state == SessionState.SETUP
 
-def test_rtsp_m6(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
 
+@pytest.mark.asyncio
+async def test_rtsp_m6(monkeypatch, unused_port):
     server = MockServer(unused_port, target="m6")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
+    rtspsink = await open_sink(monkeypatch, unused_port, SessionState.SETUP)
     rtspsink.csnum = 100
-    sessionid, serverport = rtspsink.rtsp_m6()
-    result, msg = server.join()
-    if not result:
-        pytest.fail(msg)
-    assert sessionid == '7C9C5678'
-    assert serverport == '5000'
-
+    rtspsink._request("SETUP", rtspsink._m6_request())
+    await rtspsink.flush()
+    await exchange(rtspsink, server)
+    assert rtspsink.sessionid == '7C9C5678'
+    assert rtspsink.rtcp_peer == ('192.168.173.80', 5001)
+    assert rtspsink.state == SessionState.PLAY
 
-def test_rtsp_m7(monkeypatch, unused_port):
-    def videomock(self):
-        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
-    def nonemock(self, *args):
-        return
-    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
-    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
 
+@pytest.mark.asyncio
+async def test_rtsp_m7(monkeypatch, unused_port):
     server = MockServer(unused_port, target="m7")
     server.start()
-    player = None
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
+    rtspsink = await open_sink(monkeypatch, unused_port, SessionState.PLAY)
     rtspsink.csnum = 101
-    sessionid = '7C9C5678'
-    rtspsink.rtsp_m7(sessionid)
-    result, msg = server.join()
-    if not result:
-        pytest.fail(msg)
+    rtspsink._request("PLAY", rtspsink._m7_request('7C9C5678'))
+    await rtspsink.flush()
+    await exchange(rtspsink, server)
+    assert rtspsink.state == SessionState.PLAYING
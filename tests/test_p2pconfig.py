@@ -0,0 +1,68 @@
+import pytest
+from fake_supplicant import FakeSupplicant
+
+from picast.exceptions import WpaException
+from picast.p2pconfig import P2PConfig
+from picast.wpactrl import WpaCtrl
+
+
+@pytest.fixture
+def supplicant(tmp_path):
+    server = FakeSupplicant(str(tmp_path))
+    server.start()
+    yield server
+    server.stop()
+
+
+def config(name="picast"):
+    return P2PConfig(
+        {"device_name": name, "device_type": "7-0050F204-4", "p2p_go_ht40": "1"},
+        {0: "00060151022A012C", 7: "00020000"},
+    )
+
+
+@pytest.mark.unit
+def test_p2p_config_diff():
+    current = {"device_name": "picast", "device_type": None, "p2p_go_ht40": "1", "wfd_subelem 0": "00060151022a012c"}
+    assert config().diff(current) == ["SET device_type 7-0050F204-4", "WFD_SUBELEM_SET 7 00020000"]
+
+
+@pytest.mark.connection
+def test_p2p_config_apply(supplicant):
+    wpa = WpaCtrl(ctrl_dir=supplicant.ctrl_dir)
+    assert len(config().apply(wpa)) == 5
+    # a restart finds everything in place and only reads
+    supplicant.requests.clear()
+    assert config().apply(wpa) == []
+    assert [command.split(" ")[0] for _, command in supplicant.requests] == ["GET"] * 3 + ["WFD_SUBELEM_GET"] * 2
+    assert config("newname").apply(wpa) == ["SET device_name newname"]
+    wpa.close()
+
+
+@pytest.mark.connection
+def test_p2p_config_errors(supplicant):
+    def reject(interface, command):
+        if command.startswith("SET device_type") or command.startswith("WFD_SUBELEM_SET 7"):
+            return "FAIL\n"
+        if command.startswith("GET"):
+            return "UNKNOWN COMMAND\n"
+        return None
+
+    supplicant.handler = reject
+    wpa = WpaCtrl(ctrl_dir=supplicant.ctrl_dir)
+    with pytest.raises(WpaException) as e:
+        config().apply(wpa)
+    # one report of every failure, after all commands were tried
+    assert "SET device_type 7-0050F204-4 (FAIL)" in str(e.value)
+    assert "WFD_SUBELEM_SET 7 00020000 (FAIL)" in str(e.value)
+    assert supplicant.values["device_name"] == "picast"
+    wpa.close()
+
+
+@pytest.mark.connection
+def test_wpactrl_request_many(supplicant):
+    wpa = WpaCtrl(ctrl_dir=supplicant.ctrl_dir)
+    commands = ["SET key{} {}".format(i, i) for i in range(50)] + ["GET key{}".format(i) for i in range(50)]
+    replies = wpa.request_many(commands, window=4)
+    assert replies == ["OK\n"] * 50 + [str(i) for i in range(50)]
+    wpa.close()
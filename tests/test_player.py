@@ -1,5 +1,6 @@
 import os
 import subprocess
+import sys
 import tempfile
 
 import pytest
@@ -16,6 +17,9 @@ class ProcessMock:
     def terminate(self):
         self.terminate_count += 1
 
+    def poll(self):
+        return None
+
 @pytest.mark.unit
 def test_nop_player_start_stop(monkeypatch):
     def mock_proc(args):
@@ -27,6 +31,21 @@ def test_nop_player_start_stop(monkeypatch):
     player.start()
     player.stop()
     assert player.proc.terminate_count == 1
+    assert player.rtp_stats() is None
+
+
+@pytest.mark.unit
+def test_nop_player_rtp_monitor(monkeypatch, unused_port):
+    def mock_proc(args):
+        return ProcessMock(args, 'echo')
+
+    monkeypatch.setattr(subprocess, 'Popen', mock_proc)
+
+    player = NopPlayer(rtp_port=unused_port, rtp_monitor=True)
+    player.start()
+    player.stop()
+    assert not player.monitor.is_alive()
+    assert player.rtp_stats()["received"] == 0
 
 @pytest.mark.unit
 def test_vlc_player_start_stop(monkeypatch):
@@ -39,3 +58,227 @@ def test_vlc_player_start_stop(monkeypatch):
     player.start()
     player.stop()
     assert player.vlc.terminate_count == 1
+
+
+class LibVlcMock:
+    """Stands in for the python-vlc module, recording calls of one instance."""
+
+    class EventType:
+        MediaPlayerPlaying = "playing"
+        MediaPlayerEncounteredError = "error"
+        MediaPlayerEndReached = "ended"
+
+    def __init__(self):
+        self.instances = 0
+        self.media = []
+        self.calls = []
+        self.callbacks = {}
+
+    def Instance(self, args):
+        self.instances += 1
+        return self
+
+    def media_player_new(self):
+        return self
+
+    def set_fullscreen(self, value):
+        pass
+
+    def event_manager(self):
+        return self
+
+    def event_attach(self, event, callback, *args):
+        self.callbacks[event] = (callback, args)
+
+    def fire(self, event):
+        callback, args = self.callbacks[event]
+        callback(event, *args)
+
+    def media_new(self, mrl):
+        media = LibVlcMediaMock(mrl)
+        self.media.append(media)
+        return media
+
+    def set_media(self, media):
+        self.calls.append("set_media")
+
+    def play(self):
+        self.calls.append("play")
+        return 0
+
+    def stop(self):
+        self.calls.append("stop")
+
+    def release(self):
+        self.calls.append("release")
+
+
+class LibVlcMediaMock:
+    def __init__(self, mrl):
+        self.mrl = mrl
+        self.options = []
+
+    def add_option(self, option):
+        self.options.append(option)
+
+    def release(self):
+        pass
+
+
+@pytest.mark.unit
+def test_libvlc_player_sessions(monkeypatch):
+    vlc = LibVlcMock()
+    monkeypatch.setitem(sys.modules, "vlc", vlc)
+    monkeypatch.delitem(sys.modules, "picast.players.libvlc", raising=False)
+    from picast.players.libvlc import LibVlcPlayer
+
+    player = LibVlcPlayer(rtp_port=1028)
+    states = []
+    player.on_state_change = states.append
+    for _ in range(2):
+        player.start()
+        vlc.fire("playing")
+        player.stop()
+    # one instance serves both sessions, each opening new media
+    assert vlc.instances == 1
+    assert vlc.calls == ["set_media", "play", "stop"] * 2
+    assert vlc.media[0].mrl == "rtp://@:1028"
+    assert ":network-caching=200" in vlc.media[0].options
+    assert states == ["playing", "playing"]
+    # events after stop are not reported
+    vlc.fire("error")
+    assert states == ["playing", "playing"]
+    player.start()
+    vlc.fire("error")
+    assert player.state == "error"
+    player.close()
+    assert vlc.calls[-3:] == ["stop", "release", "release"]
+
+
+class GstAny:
+    """Accepts any call of the GStreamer API the player makes and returns another GstAny."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: GstAny()
+
+
+class GstElementMock(GstAny):
+    def __init__(self, factory):
+        self.factory = factory
+        # udpsrc listens on 5004 unless told otherwise
+        self.props = {"port": 5004} if factory == "udpsrc" else {}
+        self.bound = None
+
+    def set_property(self, key, value):
+        self.props[key] = value
+
+    def get_property(self, key):
+        return self.props.get(key)
+
+
+class GstPipelineMock(GstAny):
+    def __init__(self):
+        self.elements = []
+        self.state = GstMock.State.NULL
+
+    def add(self, element):
+        self.elements.append(element)
+
+    def set_state(self, state):
+        # as udpsrc, bind the socket on NULL to READY and close it on READY to NULL
+        for element in self.elements:
+            if element.factory == "udpsrc":
+                if state == GstMock.State.NULL:
+                    element.bound = None
+                elif self.state == GstMock.State.NULL:
+                    element.bound = element.props["port"]
+        self.state = state
+
+    def get_state(self, timeout):
+        return None, self.state, None
+
+
+class GstMock:
+    """Stands in for gi.repository.Gst."""
+
+    class State:
+        NULL, READY, PAUSED, PLAYING = range(4)
+
+    SECOND = 1000000000
+    PadProbeType = PadProbeReturn = PadLinkReturn = Caps = GstAny()
+    Pipeline = GstPipelineMock
+
+    class ElementFactory:
+        make = GstElementMock
+
+    @staticmethod
+    def init(args):
+        pass
+
+
+class DecoderProbeMock:
+    def __init__(self, decoder="avdec_h264"):
+        self.decoder = decoder
+
+    def select(self, configured):
+        return self.decoder
+
+    def video_sink(self, configured):
+        return "fakesink"
+
+
+def import_gst_player(monkeypatch, probe):
+    """GstPlayer imported on the fake Gst, selecting decoders with `probe`."""
+    gi = type(sys)("gi")
+    gi.require_version = lambda *args: None
+    repository = type(sys)("gi.repository")
+    repository.Gst = GstMock
+    gi.repository = repository
+    monkeypatch.setitem(sys.modules, "gi", gi)
+    monkeypatch.setitem(sys.modules, "gi.repository", repository)
+    monkeypatch.delitem(sys.modules, "picast.players.gst", raising=False)
+    from picast.players.decoders import DecoderProbe
+    from picast.players.gst import GstPlayer
+
+    monkeypatch.setattr(DecoderProbe, "from_settings", classmethod(lambda cls: probe))
+    return GstPlayer
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("keep_warm", [True, False])
+def test_gst_player_ports(monkeypatch, keep_warm):
+    from picast.settings import Settings
+
+    GstPlayer = import_gst_player(monkeypatch, DecoderProbeMock())
+    monkeypatch.setattr(Settings, "rtcp_enabled", property(lambda self: True))
+    player = GstPlayer(rtp_port=1030, keep_warm=keep_warm)
+    player.release_after = 0
+
+    def bound():
+        return player.src.bound, player.rtcpsrc.bound
+
+    if keep_warm:
+        # the warm pipeline already listens on the session ports
+        assert bound() == (1030, 1031)
+    for _ in range(2):
+        player.start()
+        assert bound() == (1030, 1031)
+        player.stop()
+    if keep_warm:
+        player.release()
+        assert bound() == (None, None)
+        player.start()
+        assert bound() == (1030, 1031)
+        player.stop()
+    # closing at shutdown drops even a warm pipeline
+    player.close()
+    assert player.pipeline is None and bound() == (None, None)
+
+
+@pytest.mark.unit
+def test_gst_player_no_decoder(monkeypatch):
+    from picast.exceptions import PiCastException
+
+    GstPlayer = import_gst_player(monkeypatch, DecoderProbeMock(None))
+    with pytest.raises(PiCastException, match="No working H.264 decoder"):
+        GstPlayer(rtp_port=1030, keep_warm=True)
@@ -0,0 +1,68 @@
+import os
+import socket
+import time
+
+import pytest
+
+from picast.players import create_player
+from picast.players.recorder import MAX_DATAGRAM, RecordingPlayer
+
+TS_PACKET = b"\x47" + bytes(187)
+
+
+def rtp_packet(seq, payload):
+    return b"\x80\x21" + seq.to_bytes(2, "big") + (seq * 900).to_bytes(4, "big") + b"\x00\x00\x00\x01" + payload
+
+
+@pytest.mark.connection
+def test_recording_player(tmp_path):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    player = RecordingPlayer(rtp_port=port, directory=str(tmp_path))
+    # buffers are handed to the writer about every 50 packets
+    player.buffer_size = 2 * MAX_DATAGRAM
+    player.file_size = 100000
+    player.file_count = 2
+    player.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stream = []
+    for seq in range(300):
+        if seq == 150:
+            # a lost packet and a datagram that is no RTP
+            sender.sendto(b"junk", ("127.0.0.1", port))
+            continue
+        payload = bytes([seq & 0xFF]) + TS_PACKET[1:] + TS_PACKET * 6
+        stream.append(payload)
+        sender.sendto(rtp_packet(seq, payload), ("127.0.0.1", port))
+        if seq % 20 == 0:
+            time.sleep(0.005)
+    sender.close()
+    deadline = time.monotonic() + 5
+    while player.received < 300 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    player.stop()
+    stats = player.rtp_stats()
+    assert stats["received"] == 300
+    assert stats["invalid"] == 1
+    assert stats["lost"] == 1
+    assert stats["dropped"] == 0
+    assert stats["written"] == 299 * 1316
+    # older files are rotated away and the kept ones hold the end of the stream
+    assert stats["files"] > 2
+    kept = sorted(os.listdir(str(tmp_path)))
+    assert len(kept) == 2
+    data = b"".join(open(os.path.join(str(tmp_path), name), "rb").read() for name in kept)
+    assert all(os.path.getsize(os.path.join(str(tmp_path), name)) <= 100000 for name in kept)
+    assert b"".join(stream).endswith(data)
+    assert len(data) % 188 == 0
+
+
+@pytest.mark.unit
+def test_create_recording_player(tmp_path):
+    player = create_player("record", rtp_port=5004)
+    assert isinstance(player, RecordingPlayer)
+    assert player.buffer_count * player.buffer_size == 8 * 1024 * 1024
+    # stop before start does nothing
+    player.stop()
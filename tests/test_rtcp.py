@@ -0,0 +1,116 @@
+import asyncio
+import socket
+import struct
+
+import pytest
+
+from picast.rtcp import (
+    RTCP_BYE,
+    RTCP_RR,
+    RTCP_SDES,
+    ReceptionState,
+    ReportBlock,
+    RtcpReporter,
+    goodbye,
+    parse_sender_reports,
+    receiver_report,
+    source_description,
+)
+from picast.rtp import ReceiveStats
+
+
+def rtp_header(seq, timestamp, ssrc=0x11223344):
+    return b"\x80\x21" + seq.to_bytes(2, "big") + timestamp.to_bytes(4, "big") + ssrc.to_bytes(4, "big")
+
+
+def sender_report(ssrc, ntp_sec, ntp_frac):
+    return struct.pack("!BBHIIIIII", 0x80, 200, 6, ssrc, ntp_sec, ntp_frac, 0, 0, 0)
+
+
+def packet_types(data):
+    types = []
+    offset = 0
+    while offset < len(data):
+        first, packet_type, length = struct.unpack_from("!BBH", data, offset)
+        assert first >> 6 == 2
+        types.append(packet_type)
+        offset += (length + 1) * 4
+    assert offset == len(data)
+    return types
+
+
+@pytest.mark.unit
+def test_rtcp_packets():
+    block = ReportBlock(ssrc=1, fraction_lost=64, cumulative_lost=-1, highest_seq=65537, jitter=90)
+    rr = receiver_report(2, [block])
+    assert len(rr) == 32
+    assert struct.unpack_from("!BBHI", rr) == (0x81, RTCP_RR, 7, 2)
+    assert struct.unpack_from("!IIII", rr, 8) == (1, 64 << 24 | 0xFFFFFF, 65537, 90)
+    sdes = source_description(2, "picast@host")
+    assert len(sdes) % 4 == 0
+    assert packet_types(rr + sdes + goodbye(2)) == [RTCP_RR, RTCP_SDES, RTCP_BYE]
+
+
+@pytest.mark.unit
+def test_parse_sender_reports():
+    data = sender_report(7, 0x12345678, 0x9ABCDEF0) + goodbye(7)
+    assert parse_sender_reports(data) == [(7, 0x56789ABC)]
+    assert parse_sender_reports(data[:20]) == []
+    assert parse_sender_reports(b"garbage") == []
+
+
+@pytest.mark.unit
+def test_reception_state():
+    state = ReceptionState()
+    assert state.block(None, 0.0) is None
+    stats = ReceiveStats()
+    assert state.block(stats, 0.0) is None
+    for seq in range(10):
+        if seq not in (3, 4):
+            stats.update(rtp_header(seq, seq * 1800), 100, 10.0 + seq * 0.02)
+    block = state.block(stats, 10.2)
+    assert block.ssrc == 0x11223344
+    assert block.fraction_lost == (2 << 8) // 10
+    assert block.cumulative_lost == 2
+    assert block.highest_seq == 9
+    assert block.lsr == 0 and block.dlsr == 0
+    # the next interval has no loss; the cumulative count stays
+    for seq in range(10, 20):
+        stats.update(rtp_header(seq, seq * 1800), 100, 10.0 + seq * 0.02)
+    state.on_sender_report(0x56789ABC, 10.5)
+    block = state.block(stats, 11.0)
+    assert block.fraction_lost == 0
+    assert block.cumulative_lost == 2
+    assert block.lsr == 0x56789ABC
+    assert block.dlsr == 32768
+    # new statistics start a new interval
+    fresh = ReceiveStats()
+    fresh.update(rtp_header(100, 0), 100, 20.0)
+    assert state.block(fresh, 20.0).cumulative_lost == 0
+
+
+@pytest.mark.connection
+@pytest.mark.asyncio
+async def test_rtcp_reporter():
+    source = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    source.bind(("127.0.0.1", 0))
+    source.setblocking(False)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    stats = ReceiveStats()
+    stats.update(rtp_header(0, 0), 100, 1.0)
+    reporter = RtcpReporter(None, lambda: stats, interval=0.05)
+    await reporter.open(port, "127.0.0.1")
+    loop = asyncio.get_event_loop()
+    # the sender report of the source tells where to report
+    source.sendto(sender_report(0x11223344, 1, 0), ("127.0.0.1", port))
+    data = await asyncio.wait_for(loop.sock_recv(source, 1500), 5)
+    assert reporter.peer == source.getsockname()
+    assert packet_types(data) == [RTCP_RR, RTCP_SDES]
+    assert struct.unpack_from("!I", data, 8)[0] == 0x11223344
+    reporter.close()
+    while RTCP_BYE not in packet_types(data):
+        data = await asyncio.wait_for(loop.sock_recv(source, 1500), 5)
+    source.close()
@@ -0,0 +1,131 @@
+import socket
+import time
+
+import pytest
+
+from picast.rtp import (
+    JitterEstimator,
+    ReceiveStats,
+    RtpMonitor,
+    SequenceTracker,
+    rtp_payload,
+    rtp_sequence,
+    rtp_ssrc,
+    rtp_timestamp,
+    stats_summary,
+)
+
+
+def rtp_header(seq, timestamp):
+    return b"\x80\x21" + seq.to_bytes(2, "big") + timestamp.to_bytes(4, "big")
+
+
+@pytest.mark.unit
+def test_rtp_sequence():
+    assert rtp_sequence(b"\x80\x21\x12\x34") == 0x1234
+
+
+@pytest.mark.unit
+def test_sequence_tracker():
+    tracker = SequenceTracker()
+    assert tracker.update(65533) == 0
+    assert tracker.update(65534) == 0
+    # gap across the wrap around
+    assert tracker.update(2) == 3
+    assert tracker.lost == 3
+    # late and duplicate packets are not losses
+    assert tracker.update(0) == 0
+    assert tracker.update(2) == 0
+    assert tracker.late == 2
+    assert tracker.update(3) == 0
+    # sender restart
+    assert tracker.update(40000) == 0
+    assert tracker.update(40001) == 0
+    assert tracker.lost == 3
+
+
+@pytest.mark.unit
+def test_jitter_estimator():
+    assert rtp_timestamp(b"\x80\x21\x00\x01\x00\x01\x5f\x90") == 90000
+    estimator = JitterEstimator()
+    # packets every 20 ms without jitter
+    for i in range(10):
+        estimator.update(i * 1800, 100.0 + i * 0.02)
+    assert estimator.jitter == pytest.approx(0.0)
+    # one packet 16 ms late
+    assert estimator.update(10 * 1800, 100.0 + 10 * 0.02 + 0.016) == pytest.approx(0.001)
+
+
+@pytest.mark.unit
+def test_receive_stats():
+    stats = ReceiveStats()
+    # 1316 byte payloads every 10 ms, 10 ms of media each
+    for seq in (1, 2, 4, 5, 3, 5, 6, 9):
+        stats.update(rtp_header(seq, seq * 900), 1328, 100.0 + seq * 0.01)
+    assert stats.received == 8
+    assert stats.reordered == 1
+    assert stats.duplicates == 1
+    # 3 came late; 7 and 8 are missing
+    assert stats.lost == 2
+    assert stats.average_bitrate == pytest.approx(8 * 1328 * 8 / 0.08)
+    snapshot = stats.snapshot()
+    assert snapshot["lost"] == 2
+    assert snapshot["bytes"] == 8 * 1328
+    assert "lost 2, duplicates 1, reordered 1, jitter " in stats_summary(snapshot)
+
+
+@pytest.mark.unit
+def test_receive_stats_bitrate():
+    stats = ReceiveStats(window=1.0)
+    for i in range(201):
+        stats.update(rtp_header(i, i * 450), 1250, 10.0 + i * 0.005)
+    # 200 packets of 10000 bits in each second
+    assert stats.bitrate == pytest.approx(2e6, rel=0.01)
+    assert stats.jitter.jitter == pytest.approx(0.0)
+
+
+@pytest.mark.connection
+def test_rtp_monitor():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    monitor = RtpMonitor(port, host="127.0.0.1")
+    monitor.start()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for seq in (0, 1, 3):
+        sender.sendto(rtp_header(seq, seq * 1800) + bytes(100), ("127.0.0.1", port))
+    sender.sendto(b"short", ("127.0.0.1", port))
+    sender.close()
+    deadline = time.monotonic() + 5
+    while monitor.stats.received < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    monitor.stop()
+    assert not monitor.is_alive()
+    assert monitor.stats.received == 3
+    assert monitor.stats.lost == 1
+    assert monitor.stats.bytes == 3 * 108
+
+
+@pytest.mark.unit
+def test_rtp_payload():
+    packet = rtp_header(1, 0) + bytes(4) + b"payload"
+    assert rtp_payload(packet, 0, len(packet)) == (12, 7)
+    assert rtp_sequence(b"xx" + packet, 2) == 1
+    # two CSRC, a header extension of one word and 3 bytes of padding
+    packet = b"\xb2\x21" + bytes(10) + bytes(8) + b"\xbe\xde\x00\x01" + bytes(4) + b"payload" + b"\x00\x00\x03"
+    assert rtp_payload(b"x" + packet, 1, len(packet)) == (28, 7)
+    assert rtp_payload(b"junk", 0, 4)[1] == -1
+    assert rtp_payload(b"\x40" + bytes(20), 0, 21)[1] == -1
+
+
+@pytest.mark.unit
+def test_sequence_tracker_extended():
+    tracker = SequenceTracker()
+    assert tracker.packets_expected == 0
+    for seq in (65534, 65535, 1, 0):
+        tracker.update(seq)
+    # the highest extended sequence number counts the wrap around
+    assert tracker.highest == 65536 + 1
+    assert tracker.packets_expected == 4
+    assert rtp_ssrc(b"\x80\x21\x00\x01" + bytes(4) + b"\x12\x34\x56\x78") == 0x12345678
@@ -5,7 +5,8 @@ from time import sleep
 
 import pytest
 
-from picast.rtspsink import RtspSink, RTSPTransport
+from picast.dhcpd import Lease
+from picast.rtspsink import AsyncRtspSink, RtspSink
 from picast.video import RasberryPiVideo
 
 
@@ -150,7 +151,7 @@ class RtspSource(threading.Thread):
 
 @pytest.mark.connection
 @pytest.mark.asyncio
-async def test_rtsp_negotiation(monkeypatch, unused_port):
+async def test_async_rtsp_negotiation(monkeypatch, unused_port):
 
     def videomock(self):
         return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
@@ -163,11 +164,51 @@ async def test_rtsp_negotiation(monkeypatch, unused_port):
 
     rtsp_source = RtspSource(unused_port)
     rtsp_source.start()
-    sleep(0.5)
     player = MockPlayer()
-    rtspsink = RtspSink(player)
-    rtspsink.sock = RTSPTransport('127.0.0.1', unused_port)
-    result = rtspsink.negotiate()
+    rtspsink = AsyncRtspSink(player)
+    await rtspsink.open_connection('127.0.0.1', unused_port)
+    result = await rtspsink.negotiate()
+    await rtspsink.close()
     status, msg = rtsp_source.join()
     if not status or not result:
         pytest.fail(msg)
+
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+async def test_rtsp_sink_front_end(monkeypatch):
+
+    def videomock(self):
+        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
+
+    def nonemock(self, *args):
+        return
+
+    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
+    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+    peers = []
+
+    async def run(self):
+        peers.append(self.peeraddress)
+        await asyncio.sleep(30)
+
+    monkeypatch.setattr(AsyncRtspSink, "run", run)
+    rtspsink = RtspSink(MockPlayer())
+    # a lease before the loop runs is taken by the engine
+    rtspsink.on_lease(Lease("02:00:00:00:00:01", "192.168.173.81", 0))
+    task = asyncio.ensure_future(rtspsink._serve())
+    await asyncio.sleep(0.1)
+    assert peers == ["192.168.173.81"]
+    rtspsink.on_lease(Lease("02:00:00:00:00:01", "192.168.173.82", 0))
+    await asyncio.sleep(0.1)
+    assert rtspsink.engine.peeraddress == "192.168.173.82"
+    # the engine shares the video capabilities of the front-end
+    assert rtspsink.engine.video is rtspsink.video
+    rtspsink.stop()
+    await asyncio.wait_for(task, 5)
+    assert rtspsink.engine.connector._wakeup_r.fileno() == -1
+    # stopping a sink whose loop is gone is harmless
+    loop = asyncio.new_event_loop()
+    loop.close()
+    rtspsink._loop = loop
+    rtspsink.stop()
@@ -0,0 +1,185 @@
+import time
+
+import pytest
+
+from picast.rtspbuilder import RESPONSE_OK, session_request
+from picast.rtspparser import RtspParser
+from picast.rtspsink import RtspSink, SessionState
+from picast.timing import EVENTS, NegotiationStats
+from picast.video import RasberryPiVideo
+
+M1 = b"OPTIONS * RTSP/1.0\r\nCSeq: 0\r\nRequire: org.wfa.wfd1.0\r\n\r\n"
+M2_RESP = b"RTSP/1.0 200 OK\r\nCSeq: 100\r\nPublic: org.wfa.wfd1.0, SETUP, TEARDOWN, PLAY, GET_PARAMETER, SET_PARAMETER\r\n\r\n"
+M3_BODY = b"wfd_video_formats\r\nwfd_client_rtp_ports\r\n"
+M3 = b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 1\r\nContent-Type: text/parameters\r\n" \
+     b"Content-Length: %d\r\n\r\n%s" % (len(M3_BODY), M3_BODY)
+M4_BODY = b"wfd_video_formats: 00 00 01 01 00000001 00000000 00000000 00 0000 0000 00 none none\r\n" \
+          b"wfd_audio_codecs: LPCM 00000002 00\r\n"
+M4 = b"SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 2\r\nContent-Type: text/parameters\r\n" \
+     b"Content-Length: %d\r\n\r\n%s" % (len(M4_BODY), M4_BODY)
+KEEP_ALIVE = b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 3\r\n\r\n"
+M5_BODY = b"wfd_trigger_method: SETUP\r\n"
+M5 = b"SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 4\r\nContent-Type: text/parameters\r\n" \
+     b"Content-Length: %d\r\n\r\n%s" % (len(M5_BODY), M5_BODY)
+M6_RESP = b"RTSP/1.0 200 OK\r\nCSeq: 101\r\nSession: 7C9C5678;timeout=30\r\n" \
+          b"Transport: RTP/AVP/UDP;unicast;client_port=1028;server_port=5000\r\n\r\n"
+M7_RESP = b"RTSP/1.0 200 OK\r\nCSeq: 102\r\n\r\n"
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    def videomock(self):
+        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
+
+    def nonemock(self, *args):
+        return
+
+    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
+    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+    return RtspSink(None)
+
+
+def feed(sink, parser, data):
+    for msg in parser.feed(data):
+        sink.dispatch(msg)
+    return sink.data_to_send()
+
+
+@pytest.mark.unit
+def test_session_out_of_order(sink):
+    parser = RtspParser()
+    out = feed(sink, parser, M1)
+    assert out.endswith(b"OPTIONS * RTSP/1.0\r\nCSeq: 100\r\nRequire: org.wfa.wfd1.0\r\n\r\n")
+    assert sink.state == SessionState.CAPABILITY
+    # M3 and a keep-alive arrive before the M2 response
+    out = feed(sink, parser, M3 + KEEP_ALIVE)
+    assert out.startswith(b"RTSP/1.0 200 OK\r\nCSeq: 1\r\n")
+    assert out.endswith(b"RTSP/1.0 200 OK\r\nCSeq: 3\r\n\r\n")
+    assert sink.outstanding == {"100": "OPTIONS"}
+    out = feed(sink, parser, M2_RESP + M4 + M5)
+    assert out == b"RTSP/1.0 200 OK\r\nCSeq: 2\r\n\r\nRTSP/1.0 200 OK\r\nCSeq: 4\r\n\r\n" \
+                  b"SETUP rtsp://192.168.173.80/wfd1.0/streamid=0 RTSP/1.0\r\nCSeq: 101\r\n" \
+                  b"Transport: RTP/AVP/UDP;unicast;client_port=1028\r\n\r\n"
+    assert sink.state == SessionState.SETUP
+    out = feed(sink, parser, M6_RESP)
+    assert out == b"PLAY rtsp://192.168.173.80/wfd1.0/streamid=0 RTSP/1.0\r\nCSeq: 102\r\nSession: 7C9C5678\r\n\r\n"
+    feed(sink, parser, M7_RESP)
+    assert sink.state == SessionState.PLAYING
+    assert sink.outstanding == {}
+
+
+@pytest.mark.unit
+def test_session_teardown(sink):
+    parser = RtspParser()
+    feed(sink, parser, M1 + M2_RESP + M3 + M4 + M5 + M6_RESP + M7_RESP)
+    assert sink.state == SessionState.PLAYING
+    body = b"wfd_trigger_method: TEARDOWN\r\n"
+    trigger = b"SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 5\r\nContent-Length: %d\r\n\r\n%s" % (
+        len(body), body)
+    out = feed(sink, parser, trigger)
+    assert out == b"RTSP/1.0 200 OK\r\nCSeq: 5\r\n\r\nTEARDOWN rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 103\r\n\r\n"
+    assert sink.state == SessionState.TEARDOWN
+    feed(sink, parser, b"RTSP/1.0 200 OK\r\nCSeq: 103\r\n\r\n")
+    assert sink.state == SessionState.CLOSED
+
+
+@pytest.mark.unit
+def test_session_invalid_state(sink):
+    out = feed(sink, RtspParser(), M5)
+    assert out == b"RTSP/1.0 455 Method Not Valid In This State\r\nCSeq: 4\r\n\r\n"
+    assert sink.state == SessionState.INIT
+
+
+@pytest.mark.unit
+def test_message_template(sink):
+    assert RESPONSE_OK.render("5") == [b"RTSP/1.0 200 OK\r\nCSeq: ", b"5", b"\r\n\r\n"]
+    sink.csnum = 101
+    expected = sink._m7_request("7C9C5678").encode("ASCII")
+    assert session_request("PLAY", sink._stream_url()).to_bytes("102", "7C9C5678") == expected
+
+
+@pytest.mark.unit
+def test_session_timing(sink):
+    parser = RtspParser()
+    stats = NegotiationStats()
+    sink.stats = stats
+    sink.timer.start()
+    feed(sink, parser, M1 + M3 + M2_RESP + M4 + M5 + M6_RESP + M7_RESP)
+    sink.timer.mark("play")
+    sink.finish_timing()
+    sink.finish_timing()
+    assert [event for event, _ in sink.timer.steps()] == list(EVENTS[1:])
+    assert stats.sessions == 1
+    assert stats.time_to_play.count == 1
+    snapshot = stats.snapshot()
+    assert snapshot["steps"]["m7_reply"]["count"] == 1
+    assert snapshot["steps"]["connect"]["count"] == 0
+    assert sink.timer.summary().startswith("Negotiation timing: m1=+")
+
+
+@pytest.mark.unit
+def test_session_selected_format(sink):
+    feed(sink, RtspParser(), M1 + M2_RESP + M3 + M4)
+    assert sink.selected_format.video.resolution == (640, 480, 60, True)
+    assert sink.selected_format.audio.codec == "LPCM"
+    assert sink.selected_format.rtp_port is None
+
+
+@pytest.mark.unit
+def test_session_idr_request(sink, monkeypatch):
+    parser = RtspParser()
+    assert not sink.request_idr("loss")
+    feed(sink, parser, M1 + M2_RESP + M3 + M4 + M5 + M6_RESP + M7_RESP)
+    clock = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    sink.idr_interval = 1.0
+    assert sink.request_idr("loss")
+    assert sink.data_to_send() == b"SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 103\r\n" \
+                                  b"Session: 7C9C5678\r\nContent-Type: text/parameters\r\n" \
+                                  b"Content-Length: 17\r\n\r\nwfd_idr_request\r\n"
+    clock[0] = 100.5
+    assert not sink.request_idr("loss")
+    clock[0] = 101.5
+    assert sink.request_idr("loss")
+    feed(sink, parser, b"RTSP/1.0 200 OK\r\nCSeq: 103\r\n\r\nRTSP/1.0 200 OK\r\nCSeq: 104\r\n\r\n")
+    assert sink.outstanding == {}
+    assert sink.state == SessionState.PLAYING
+
+
+class StatsPlayer:
+    def __init__(self):
+        self.stats = {"received": 0, "lost": 0, "duplicates": 0, "reordered": 0,
+                      "jitter_ms": 0.0, "bitrate": 0.0, "average_bitrate": 0.0, "bytes": 0}
+
+    def rtp_stats(self):
+        return dict(self.stats)
+
+
+@pytest.mark.unit
+def test_session_rtp_stats(sink):
+    assert sink.rtp_stats() is None
+    sink.player = StatsPlayer()
+    sink._rtp_live = True
+    sink.player.stats["received"] = 10
+    assert sink.rtp_stats()["received"] == 10
+    sink.finish_rtp_stats()
+    # the stats of the ended session stay available
+    sink.player.stats["received"] = 0
+    assert sink.rtp_stats()["received"] == 10
+    assert sink.last_rtp_stats["received"] == 10
+
+
+@pytest.mark.unit
+def test_session_rtcp_peer(sink):
+    parser = RtspParser()
+    sink.rtcp_enabled = True
+    body = b"microsoft_rtcp_capability\r\n"
+    m3 = b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 1\r\nContent-Type: text/parameters\r\n" \
+         b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+    out = feed(sink, parser, M1 + M2_RESP + m3)
+    assert out.endswith(b"microsoft_rtcp_capability: supported\r\n")
+    feed(sink, parser, M4 + M5 + M6_RESP)
+    assert sink.rtcp_peer == ("192.168.173.80", 5001)
+    assert sink._rtcp_peer("5000-5003") == ("192.168.173.80", 5003)
+    assert sink._rtcp_peer("0") is None
+    assert sink._rtcp_peer(None) is None
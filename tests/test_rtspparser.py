@@ -0,0 +1,53 @@
+import pytest
+
+from picast.exceptions import RtspException
+from picast.rtspparser import RtspHeaders, RtspParser, RtspRequest, RtspResponse
+
+M3 = b"GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 1\r\nContent-Type: text/parameters\r\n" \
+     b"Content-Length: 37\r\n\r\nwfd_video_formats\r\nwfd_audio_codecs\r\n"
+M2_RESP = b"RTSP/1.0 200 OK\r\nCSeq: 100\r\nPublic: org.wfa.wfd1.0, SETUP, TEARDOWN, PLAY\r\n\r\n"
+
+
+@pytest.mark.unit
+def test_headers_case_insensitive():
+    headers = RtspHeaders()
+    headers["CSeq"] = "1"
+    headers["cseq"] = "2"
+    assert headers["CSEQ"] == "2"
+    assert list(headers) == ["CSeq"]
+    assert headers == {"CSeq": "2"}
+
+
+@pytest.mark.unit
+def test_parse_pipelined_messages():
+    parser = RtspParser()
+    messages = parser.feed(M2_RESP + M3)
+    assert len(messages) == 2
+    resp, req = messages
+    assert isinstance(resp, RtspResponse)
+    assert resp.status == 200
+    assert resp.reason == "OK"
+    assert resp.cseq == "100"
+    assert isinstance(req, RtspRequest)
+    assert req.method == "GET_PARAMETER"
+    assert req.url == "rtsp://localhost/wfd1.0"
+    assert req.headers["content-length"] == "37"
+    assert req.text.splitlines() == ["wfd_video_formats", "wfd_audio_codecs"]
+
+
+@pytest.mark.unit
+def test_parse_split_body():
+    parser = RtspParser()
+    data = M3 + M2_RESP
+    messages = []
+    for i in range(len(data)):
+        messages.extend(parser.feed(data[i : i + 1]))
+    assert [m.cseq for m in messages] == ["1", "100"]
+    assert messages[0].body == b"wfd_video_formats\r\nwfd_audio_codecs\r\n"
+
+
+@pytest.mark.unit
+def test_parse_malformed():
+    parser = RtspParser()
+    with pytest.raises(RtspException):
+        parser.feed(b"RTSP/1.0 OK\r\nCSeq: 1\r\n\r\n")
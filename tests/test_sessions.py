@@ -0,0 +1,215 @@
+import asyncio
+
+import pytest
+
+from picast.rtspparser import RtspParser, RtspRequest
+from picast.rtspsink import AsyncRtspSink
+from picast.sessions import RtpPortPool, SessionManager
+from picast.settings import Settings
+from picast.video import RasberryPiVideo
+
+
+class MockPlayer():
+    def __init__(self, rtp_port):
+        self.rtp_port = rtp_port
+        self.started = 0
+        self.stopped = 0
+        self.closed = 0
+
+    def start(self, selected=None):
+        self.started += 1
+        self.selected = selected
+
+    def stop(self):
+        self.stopped += 1
+
+    def close(self):
+        self.closed += 1
+
+
+class AsyncRtspSource:
+    """Minimal source: negotiates M1-M7 with one sink then closes the connection."""
+
+    def __init__(self):
+        self.client_ports = []
+
+    async def _read(self, reader, parser, pending):
+        while not pending:
+            data = await reader.read(4096)
+            if not data:
+                raise ConnectionError
+            pending.extend(parser.feed(data))
+        return pending.pop(0)
+
+    async def handle(self, reader, writer):
+        parser = RtspParser()
+        pending = []
+
+        async def request(text):
+            writer.write(text.encode('ASCII'))
+            await writer.drain()
+            return await self._read(reader, parser, pending)
+
+        await request("OPTIONS * RTSP/1.0\r\nCSeq: 0\r\nRequire: org.wfa.wfd1.0\r\n\r\n")
+        m2 = await self._read(reader, parser, pending)
+        m3_body = "wfd_video_formats\r\nwfd_client_rtp_ports\r\n"
+        m3_resp = await request("RTSP/1.0 200 OK\r\nCSeq: {}\r\nPublic: org.wfa.wfd1.0, SETUP, TEARDOWN, PLAY, "
+                                "PAUSE, GET_PARAMETER, SET_PARAMETER\r\n\r\n"
+                                "GET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 1\r\n"
+                                "Content-Type: text/parameters\r\nContent-Length: {}\r\n\r\n{}"
+                                .format(m2.cseq, len(m3_body), m3_body))
+        for line in bytes(m3_resp.body).decode('ASCII').splitlines():
+            if line.startswith("wfd_client_rtp_ports"):
+                self.client_ports.append(int(line.split()[2]))
+        m4_body = "wfd_video_formats: 00 00 01 01 00000001 00000000 00000000 00 0000 0000 00 none none\r\n"
+        await request("SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 2\r\n"
+                      "Content-Type: text/parameters\r\nContent-Length: {}\r\n\r\n{}".format(len(m4_body), m4_body))
+        m5_body = "wfd_trigger_method: SETUP\r\n"
+        await request("SET_PARAMETER rtsp://localhost/wfd1.0 RTSP/1.0\r\nCSeq: 3\r\n"
+                      "Content-Type: text/parameters\r\nContent-Length: {}\r\n\r\n{}".format(len(m5_body), m5_body))
+        m6 = await self._read(reader, parser, pending)
+        assert isinstance(m6, RtspRequest) and m6.method == "SETUP"
+        m7 = await request("RTSP/1.0 200 OK\r\nCSeq: {}\r\nSession: 7C9C5678;timeout=30\r\n"
+                           "Transport: {};server_port=5000\r\n\r\n".format(m6.cseq, m6.headers["Transport"]))
+        assert isinstance(m7, RtspRequest) and m7.method == "PLAY"
+        writer.write("RTSP/1.0 200 OK\r\nCSeq: {}\r\n\r\n".format(m7.cseq).encode('ASCII'))
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        writer.close()
+
+
+@pytest.mark.unit
+def test_rtp_port_pool():
+    pool = RtpPortPool(1028, 3)
+    assert len(pool) == 3
+    ports = [pool.acquire() for _ in range(3)]
+    assert ports == [1028, 1030, 1032]
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    pool.release(1030)
+    pool.release(1030)
+    pool.release(2000)
+    assert len(pool) == 1
+    assert pool.acquire() == 1030
+
+
+@pytest.mark.connection
+@pytest.mark.asyncio
+async def test_session_manager_two_sessions(monkeypatch, unused_port):
+
+    def videomock(self):
+        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
+
+    def nonemock(self, *args):
+        return
+
+    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
+    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+
+    sources = [AsyncRtspSource(), AsyncRtspSource()]
+    servers = [await asyncio.start_server(source.handle, '127.0.0.{}'.format(i + 1), unused_port)
+               for i, source in enumerate(sources)]
+    players = []
+
+    def factory(rtp_port):
+        player = MockPlayer(rtp_port)
+        players.append(player)
+        return player
+
+    manager = SessionManager(player_factory=factory, max_sessions=2)
+    assert await manager.add_peer('127.0.0.1', rtsp_port=unused_port)
+    assert await manager.add_peer('127.0.0.2', rtsp_port=unused_port)
+    assert not await manager.add_peer('127.0.0.3', rtsp_port=unused_port)
+    await asyncio.wait_for(manager.wait_sessions(), 10)
+    # the next session on a port reuses its player
+    assert await manager.add_peer('127.0.0.2', rtsp_port=unused_port)
+    await asyncio.wait_for(manager.wait_sessions(), 10)
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+    assert sorted(sources[0].client_ports + sources[1].client_ports) == [1028, 1028, 1030]
+    assert sorted(p.rtp_port for p in players) == [1028, 1030]
+    assert sorted(p.started for p in players) == [1, 2]
+    assert all(p.started == p.stopped for p in players)
+    assert all(p.selected.video.resolution == (640, 480, 60, True) for p in players)
+    assert len(manager.ports) == 2
+    assert not manager.sessions
+
+
+@pytest.mark.connection
+@pytest.mark.asyncio
+async def test_session_manager_closes_players(monkeypatch, unused_port):
+    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats",
+                        lambda self: "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none")
+    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", lambda self, *args: None)
+    source = AsyncRtspSource()
+    server = await asyncio.start_server(source.handle, '127.0.0.1', unused_port)
+    manager = SessionManager(player_factory=MockPlayer, max_sessions=1)
+    task = asyncio.ensure_future(manager.serve(peers=[]))
+    assert await manager.add_peer('127.0.0.1', rtsp_port=unused_port)
+    await asyncio.wait_for(manager.wait_sessions(), 10)
+    player = manager.players[1028]
+    assert player.closed == 0
+    manager.stop()
+    await asyncio.wait_for(task, 5)
+    # the player kept for the port is closed with the manager
+    assert player.closed == 1 and manager.players == {}
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.connection
+@pytest.mark.asyncio
+async def test_sink_follows_leased_address(monkeypatch, unused_port):
+
+    def videomock(self):
+        return "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none"
+
+    def nonemock(self, *args):
+        return
+
+    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats", videomock)
+    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", nonemock)
+
+    source = AsyncRtspSource()
+    server = await asyncio.start_server(source.handle, '127.0.0.2', unused_port)
+    # nothing listens on the configured address
+    sink = AsyncRtspSink(MockPlayer(1028), peeraddress='127.0.0.3', rtsp_port=unused_port)
+    task = asyncio.ensure_future(sink.run())
+    await asyncio.sleep(0.2)
+    assert not source.client_ports
+    sink.set_peer('127.0.0.2')
+    for _ in range(100):
+        if source.client_ports:
+            break
+        await asyncio.sleep(0.05)
+    assert source.client_ports == [1028]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    server.close()
+    await server.wait_closed()
+    sink.connector.close()
+
+
+@pytest.mark.connection
+@pytest.mark.asyncio
+async def test_sink_quiet_source(monkeypatch, unused_port):
+    monkeypatch.setattr(RasberryPiVideo, "get_wfd_video_formats",
+                        lambda self: "06 00 01 10 000101C3 00208006 00000000 00 0000 0000 00 none none")
+    monkeypatch.setattr(RasberryPiVideo, "_get_display_resolutions", lambda self, *args: None)
+    monkeypatch.setattr(Settings, "negotiation_timeout", property(lambda self: 0.2))
+    connections = []
+
+    async def quiet(reader, writer):
+        connections.append(writer)
+
+    server = await asyncio.start_server(quiet, '127.0.0.1', unused_port)
+    sink = AsyncRtspSink(MockPlayer(1028), peeraddress='127.0.0.1', rtsp_port=unused_port)
+    # a source that never sends M1 aborts the session instead of holding it
+    assert not await asyncio.wait_for(sink.run_session(), 5)
+    assert len(connections) == 1 and sink.writer is None
+    server.close()
+    await server.wait_closed()
+    sink.connector.close()
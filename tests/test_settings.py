@@ -113,7 +113,82 @@ def test_config_max_timeout():
     assert Settings().max_timeout == '10'
 
 
+@pytest.mark.unit
+def test_config_connect_timeout():
+    assert Settings().connect_timeout == 300.0
+    assert Settings().negotiation_timeout == 10.0
+
+
 @pytest.mark.unit
 def test_config_gst_decoder():
     assert Settings().gst_decoder == 'omxh264dec'
 
+
+
+@pytest.mark.unit
+def test_config_max_sessions():
+    assert Settings().max_sessions == 1
+
+
+@pytest.mark.unit
+def test_config_session_peers():
+    assert Settings().session_peers == ['192.168.173.80']
+
+
+@pytest.mark.unit
+def test_config_metrics_listen():
+    assert Settings().metrics_listen == ''
+
+
+@pytest.mark.unit
+def test_config_idr_interval():
+    assert Settings().idr_interval == 1.0
+
+
+@pytest.mark.unit
+def test_config_latency():
+    assert Settings().latency_profile == 'balanced'
+    assert Settings().get_latency_range('interactive') == (10, 80)
+
+
+@pytest.mark.unit
+def test_config_gst_keep_warm():
+    assert not Settings().gst_keep_warm
+    assert Settings().gst_release_after == 60.0
+
+
+@pytest.mark.unit
+def test_config_gst_decoder_cache():
+    assert Settings().gst_decoder_cache == '/var/tmp/picast-decoder.json'
+
+
+@pytest.mark.unit
+def test_config_rtp_monitor():
+    assert not Settings().rtp_monitor
+
+
+@pytest.mark.unit
+def test_config_record():
+    assert Settings().record_directory == '/var/tmp/picast'
+    assert Settings().record_file_size == 64 * 1024 * 1024
+    assert Settings().record_files == 4
+
+
+@pytest.mark.unit
+def test_config_rtcp():
+    assert not Settings().rtcp_enabled
+    assert Settings().rtcp_interval == 5.0
+
+
+@pytest.mark.unit
+def test_config_gst_sinks():
+    assert Settings().gst_video_sink == 'auto'
+    assert Settings().gst_audio_sink == 'alsasink'
+
+
+@pytest.mark.unit
+def test_config_dhcp():
+    assert Settings().dhcp_server == 'builtin'
+    assert Settings().dhcp_pool_size == 8
+    assert Settings().dhcp_lease_time == 300
+    assert Settings().dhcp_lease_file == '/var/tmp/picast-leases.json'
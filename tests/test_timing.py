@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from picast.timing import Histogram, NegotiationStats, NegotiationTimer
+
+
+@pytest.mark.unit
+def test_histogram():
+    h = Histogram((0.01, 0.1, 1.0, float("inf")))
+    for value in (0.005, 0.01, 0.05, 0.5, 3.0):
+        h.observe(value)
+    assert h.count == 5
+    assert h.sum == pytest.approx(3.565)
+    assert h.cumulative() == [(0.01, 2), (0.1, 3), (1.0, 4), (float("inf"), 5)]
+    assert h.quantile(0.5) == 0.1
+    assert Histogram().quantile(0.5) is None
+
+
+@pytest.mark.unit
+def test_histogram_threads():
+    h = Histogram((0.01, float("inf")))
+
+    def observe():
+        for _ in range(10000):
+            h.observe(0.001)
+
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert h.count == 40000
+    assert h.cumulative() == [(0.01, 40000), (float("inf"), 40000)]
+
+
+@pytest.mark.unit
+def test_negotiation_timer():
+    timer = NegotiationTimer()
+    timer.mark("connect")
+    assert timer.marks == {}
+    timer.start()
+    timer.marks = {"connect": 0.1, "m1": 0.3, "m1_reply": 0.31}
+    timer.mark("m1")
+    assert timer.marks["m1"] == 0.3
+    assert timer.steps() == [("connect", 0.1), ("m1", pytest.approx(0.2)), ("m1_reply", pytest.approx(0.01))]
+    assert timer.time_to_play is None
+    assert timer.summary() == "Negotiation timing: connect=+100ms m1=+200ms m1_reply=+10ms (not played)"
+    timer.marks["play"] = 1.5
+    stats = NegotiationStats()
+    stats.record(timer)
+    assert stats.steps["play"].sum == pytest.approx(1.19)
+    assert stats.time_to_play.sum == 1.5
+    assert stats.snapshot()["last"]["play"] == 1.5
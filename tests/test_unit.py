@@ -1,4 +1,6 @@
 
+import subprocess
+
 from picast.video import RasberryPiVideo
 from picast.wifip2p import WifiP2PServer
 from picast.wpacli import WpaCli
@@ -317,3 +319,26 @@ def test_ext_cap(monkeypatch):
     assert p2p.wfd_ext_cap(uibc=True, i2c=False) == '00020001'
     assert p2p.wfd_ext_cap(uibc=False, i2c=True) == '00020002'
 
+
+
+@pytest.mark.unit
+def test_wpacli_request_many_command(monkeypatch):
+    calls = []
+
+    class PopenMock:
+        def __init__(self, args, stdout=None):
+            calls.append(args)
+
+        def communicate(self):
+            return b"OK\n", None
+
+    monkeypatch.setattr(subprocess, "Popen", PopenMock)
+    wpacli = WpaCli()
+    wpacli.use_command = True
+    replies = wpacli.request_many(["SET device_name My Display", "GET device_name"], "p2p-dev-wlan0")
+    assert replies == ["OK\n", "OK\n"]
+    # a value with spaces is one argument of wpa_cli
+    assert calls == [
+        ["sudo", "wpa_cli", "-i", "p2p-dev-wlan0", "SET", "device_name", "My Display"],
+        ["sudo", "wpa_cli", "-i", "p2p-dev-wlan0", "GET", "device_name"],
+    ]
@@ -0,0 +1,231 @@
+import os
+import time
+
+import pytest
+from fake_supplicant import FakeSupplicant
+
+from picast.exceptions import WpaException
+from picast.settings import Settings
+from picast.wifip2p import WifiP2PServer
+from picast.wpacli import WpaCli
+from picast.wpactrl import WpaCtrl, WpaEvent, WpaMonitor
+
+
+@pytest.fixture
+def supplicant(tmp_path):
+    server = FakeSupplicant(str(tmp_path))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.connection
+def test_wpactrl_request(supplicant):
+    with WpaCtrl(ctrl_dir=supplicant.ctrl_dir) as wpa:
+        assert wpa.interfaces() == ["p2p-dev-wlan0", "wlan0"]
+        assert wpa.request("PING") == "PONG\n"
+        wpa.set_device_name("picast")
+        wpa.wfd_subelem_set(0, "000600111c4400c8")
+        wpa.set_wps_pin("wlan0", "12345678", 300)
+        assert wpa.cmd("get", "device_name") == ["picast"]
+        # one connection per interface serves every request
+        assert len(wpa._connections) == 2
+    assert supplicant.requests == [
+        ("p2p-dev-wlan0", "PING"),
+        ("p2p-dev-wlan0", "SET device_name picast"),
+        ("p2p-dev-wlan0", "WFD_SUBELEM_SET 0 000600111c4400c8"),
+        ("wlan0", "WPS_PIN any 12345678 300"),
+        ("p2p-dev-wlan0", "GET device_name"),
+    ]
+    assert wpa._connections == {}
+
+
+@pytest.mark.connection
+def test_wpactrl_compatible(supplicant):
+    supplicant.add_interface("p2p-wlan0-0")
+    supplicant.networks = ["0\tSome_wifi\tany\t", "1\tDIRECT-3E_picast\taa:22:cc:33:dd:44\t[DISABLED][P2P-PERSISTENT]"]
+    wpa = WpaCli(ctrl_dir=supplicant.ctrl_dir)
+    assert wpa.get_interfaces() == ("p2p-dev-wlan0", ["p2p-dev-wlan0", "p2p-wlan0-0", "wlan0"])
+    assert wpa.get_p2p_interface() == "p2p-wlan0-0"
+    assert wpa.get_persistent_group_network_id("picast") == "1"
+    supplicant.replies["P2P_FIND"] = "FAIL\n"
+    with pytest.raises(WpaException):
+        wpa.start_p2p_find()
+    wpa.close()
+
+
+@pytest.mark.connection
+def test_wpactrl_late_reply(supplicant):
+    calls = []
+
+    def slow(interface, command):
+        calls.append(command)
+        if len(calls) == 1:
+            time.sleep(0.3)
+            return "FAIL\n"
+        return None
+
+    supplicant.handler = slow
+    wpa = WpaCtrl(ctrl_dir=supplicant.ctrl_dir, timeout=0.1)
+    with pytest.raises(WpaException):
+        wpa.start_p2p_find()
+    time.sleep(0.4)
+    # the late FAIL of the first request is not taken for the reply of the second
+    wpa.timeout = 5.0
+    wpa.start_p2p_find()
+    wpa.close()
+
+
+@pytest.mark.connection
+def test_wpactrl_no_socket(tmp_path):
+    wpa = WpaCtrl(ctrl_dir=str(tmp_path))
+    with pytest.raises(WpaException):
+        wpa.request("PING")
+    with pytest.raises(OSError):
+        wpa.request("PING", "wlan0")
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.connection
+def test_wpactrl_reconnect(tmp_path):
+    supplicant = FakeSupplicant(str(tmp_path))
+    supplicant.start()
+    wpa = WpaCtrl(ctrl_dir=str(tmp_path))
+    assert wpa.request("PING") == "PONG\n"
+    sock = wpa._connections["p2p-dev-wlan0"][0]
+    # wpa_supplicant restarts and binds its sockets again
+    supplicant.stop()
+    supplicant = FakeSupplicant(str(tmp_path))
+    supplicant.start()
+    assert wpa.request("PING") == "PONG\n"
+    assert wpa._connections["p2p-dev-wlan0"][0] is not sock and sock.fileno() == -1
+    # a dead socket is dropped when it cannot reconnect
+    supplicant.stop()
+    with pytest.raises(OSError):
+        wpa.request("PING", "p2p-dev-wlan0")
+    assert wpa._connections == {}
+    assert os.listdir(str(tmp_path)) == []
+    wpa.close()
+
+
+@pytest.mark.unit
+def test_wpa_event_parse():
+    event = WpaEvent.parse(
+        "p2p-dev-wlan0",
+        '<3>P2P-GROUP-STARTED p2p-wlan0-0 GO ssid="DIRECT-3E picast" freq=2437 go_dev_addr=aa:bb:cc:dd:ee:ff',
+    )
+    assert event.level == 3
+    assert event.name == "P2P-GROUP-STARTED"
+    assert event.args == ["p2p-wlan0-0", "GO"]
+    assert event.params["ssid"] == "DIRECT-3E picast"
+    assert event.matches(("P2P-GROUP-STARTED",))
+    assert event.matches(("P2P-GROUP-",))
+    event = WpaEvent.parse("wlan0", '<3>WPS-FAIL msg=8 config_error=18 passphrase="a"b')
+    assert event.name == "WPS-FAIL"
+    assert event.matches(("WPS-",))
+    assert not event.matches(("WPS-SUCCESS",))
+
+
+@pytest.mark.connection
+def test_wpa_monitor(supplicant):
+    monitor = WpaMonitor(ctrl_dir=supplicant.ctrl_dir)
+    monitor.attach("p2p-dev-wlan0")
+    monitor.start()
+    seen = []
+    monitor.subscribe(seen.append, "AP-STA-CONNECTED", "WPS-")
+    waiter = monitor.expect("AP-STA-CONNECTED", predicate=lambda e: e.args == ["02:00:00:00:00:02"])
+    supplicant.event("CTRL-EVENT-SCAN-STARTED")
+    supplicant.event("AP-STA-CONNECTED 02:00:00:00:00:01 p2p_dev_addr=02:00:00:00:00:11")
+    supplicant.event("AP-STA-CONNECTED 02:00:00:00:00:02 p2p_dev_addr=02:00:00:00:00:12")
+    supplicant.event("WPS-SUCCESS")
+    event = waiter.wait(5)
+    assert event.params["p2p_dev_addr"] == "02:00:00:00:00:12"
+    deadline = time.monotonic() + 5
+    while len(seen) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [e.name for e in seen] == ["AP-STA-CONNECTED", "AP-STA-CONNECTED", "WPS-SUCCESS"]
+    waiter = monitor.expect("P2P-GROUP-STARTED")
+    assert waiter.wait(0.05) is None
+    # a waiter that timed out is dropped
+    monitor.discard(waiter)
+    assert monitor._waiters == []
+    monitor.stop()
+    assert not monitor.is_alive()
+    deadline = time.monotonic() + 5
+    while ("p2p-dev-wlan0", "DETACH") not in supplicant.requests and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ("p2p-dev-wlan0", "DETACH") in supplicant.requests
+
+
+@pytest.mark.connection
+def test_wpa_monitor_reattach(tmp_path):
+    supplicant = FakeSupplicant(str(tmp_path))
+    supplicant.start()
+    monitor = WpaMonitor(ctrl_dir=str(tmp_path), timeout=1.0, ping_interval=0.1)
+    monitor.attach("p2p-dev-wlan0")
+    monitor.start()
+    seen = []
+    monitor.subscribe(seen.append, "CTRL-EVENT-TERMINATING", "AP-STA-CONNECTED")
+    # a quiet socket is pinged
+    deadline = time.monotonic() + 5
+    while ("p2p-dev-wlan0", "PING") not in supplicant.requests and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ("p2p-dev-wlan0", "PING") in supplicant.requests
+    # wpa_supplicant restarts without telling the attached clients
+    attached = list(monitor._sockets)
+    supplicant.stop()
+    supplicant = FakeSupplicant(str(tmp_path))
+    supplicant.start()
+    deadline = time.monotonic() + 5
+    while list(monitor._sockets) in ([], attached) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert monitor.interfaces == ["p2p-dev-wlan0"]
+    assert ("p2p-dev-wlan0", "ATTACH") in supplicant.requests
+    assert [e.name for e in seen] == ["CTRL-EVENT-TERMINATING"]
+    # events of the new wpa_supplicant are received
+    waiter = monitor.expect("AP-STA-CONNECTED")
+    supplicant.event("AP-STA-CONNECTED 02:00:00:00:00:01")
+    assert waiter.wait(5) is not None
+    monitor.stop()
+    supplicant.stop()
+
+
+@pytest.mark.connection
+def test_wifip2p_group_started_event(supplicant, monkeypatch):
+    def group_add(interface, command):
+        if command.startswith("P2P_GROUP_ADD"):
+            supplicant.add_interface("p2p-wlan0-0")
+            supplicant.event('P2P-GROUP-STARTED p2p-wlan0-0 GO ssid="DIRECT-3E_picast" freq=2437')
+        return None
+
+    supplicant.handler = group_add
+    monkeypatch.setattr(Settings, "ctrl_interface", property(lambda self: supplicant.ctrl_dir))
+    monkeypatch.setattr(os, "system", lambda command: 0)
+    start = time.monotonic()
+    server = WifiP2PServer()
+    # the group is used as soon as it started, without the fixed wait
+    assert time.monotonic() - start < 2
+    assert server.events_ready
+    assert server.wlandev == "p2p-wlan0-0"
+    assert server.events.interfaces == ["p2p-dev-wlan0", "p2p-wlan0-0"]
+    server.events.stop()
+    server.wpacli.close()
+
+
+@pytest.mark.connection
+def test_wifip2p_group_started_timeout(supplicant, monkeypatch):
+    def group_add(interface, command):
+        if command.startswith("P2P_GROUP_ADD"):
+            # the group starts, but its event is lost
+            supplicant.add_interface("p2p-wlan0-0")
+        return None
+
+    supplicant.handler = group_add
+    monkeypatch.setattr(Settings, "ctrl_interface", property(lambda self: supplicant.ctrl_dir))
+    monkeypatch.setattr(os, "system", lambda command: 0)
+    monkeypatch.setattr(WifiP2PServer, "group_timeout", 0.1)
+    server = WifiP2PServer()
+    assert server.wlandev == "p2p-wlan0-0"
+    assert server.events._waiters == []
+    server.events.stop()
+    server.wpacli.close()
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+from fake_supplicant import FakeSupplicant
+
+from picast.wpactrl import WpaCtrl, WpaEvent, WpaMonitor
+from picast.wpastate import WpaState, parse_networks
+
+
+@pytest.fixture
+def supplicant(tmp_path):
+    server = FakeSupplicant(str(tmp_path))
+    server.networks = ["0\tSome_wifi\tany\t", "1\tDIRECT-3E_picast\taa:22:cc:33:dd:44\t[DISABLED][P2P-PERSISTENT]"]
+    server.start()
+    yield server
+    server.stop()
+
+
+def list_requests(supplicant):
+    return [command for _, command in supplicant.requests if command == "LIST_NETWORKS"]
+
+
+@pytest.mark.unit
+def test_parse_networks():
+    networks = parse_networks(
+        [
+            "network id / ssid / bssid / flags",
+            "0\tSome wifi\tany\t[CURRENT]",
+            "1\tDIRECT-3E_picast\taa:22:cc:33:dd:44\t[DISABLED][P2P-PERSISTENT]",
+            "2 other",
+        ]
+    )
+    assert list(networks) == ["0", "1", "2"]
+    assert networks["0"].ssid == "Some wifi"
+    assert not networks["0"].persistent
+    assert networks["1"].persistent
+    assert networks["2"].bssid == ""
+
+
+@pytest.mark.connection
+def test_wpa_state_cache(supplicant):
+    wpa = WpaCtrl(ctrl_dir=supplicant.ctrl_dir)
+    state = WpaState(wpa)
+    assert state.persistent_group_network_id("picast") == "1"
+    assert state.persistent_group_network_id("other") is None
+    assert list(state.networks()) == ["0", "1"]
+    assert len(list_requests(supplicant)) == 1
+    assert state.interfaces() == ["p2p-dev-wlan0", "wlan0"]
+    assert state.p2p_interface() is None
+    supplicant.add_interface("p2p-wlan0-0")
+    # served from memory until invalidated or expired
+    assert state.p2p_interface() is None
+    state.invalidate()
+    assert state.p2p_interface() == "p2p-wlan0-0"
+    assert state.groups() == {"p2p-wlan0-0": ""}
+    state.ttl = 0.0
+    state.networks()
+    state.networks()
+    assert len(list_requests(supplicant)) == 3
+    wpa.close()
+
+
+@pytest.mark.connection
+def test_wpa_state_events(supplicant):
+    wpa = WpaCtrl(ctrl_dir=supplicant.ctrl_dir)
+    monitor = WpaMonitor(ctrl_dir=supplicant.ctrl_dir)
+    monitor.attach("p2p-dev-wlan0")
+    monitor.start()
+    state = WpaState(wpa, monitor)
+    state.networks()
+    assert state.p2p_interface() is None
+    # a group event is applied without asking wpa_supplicant again
+    supplicant.add_interface("p2p-wlan0-0")
+    waiter = monitor.expect("P2P-GROUP-STARTED")
+    supplicant.event('P2P-GROUP-STARTED p2p-wlan0-0 GO ssid="DIRECT-3E_picast" freq=2437')
+    assert waiter.wait(5) is not None
+    deadline = time.monotonic() + 5
+    while state.p2p_interface() is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert state.groups() == {"p2p-wlan0-0": "GO"}
+    assert "p2p-wlan0-0" in state.interfaces()
+    # an added network is read on the next lookup
+    supplicant.networks.append("2\tDIRECT-xy_picast\tbb:22:cc:33:dd:44\t[P2P-PERSISTENT]")
+    state.on_event(WpaEvent.parse("p2p-dev-wlan0", "<2>CTRL-EVENT-NETWORK-ADDED 2"))
+    assert state.persistent_group_network_id("picast") == "2"
+    state.on_event(WpaEvent.parse("p2p-dev-wlan0", "<3>P2P-GROUP-REMOVED p2p-wlan0-0 GO reason=REQUESTED"))
+    assert state.p2p_interface() is None
+    monitor.stop()
+    wpa.close()